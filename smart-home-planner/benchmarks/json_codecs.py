@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Compare the JSON codecs server.py can use on large synthetic homes.
+
+Usage: python3 benchmarks/json_codecs.py [--devices 500 2000 10000] [--repeat 5]
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "sample", "data.json")
+
+
+def build_home(device_count):
+    with open(SAMPLE_FILE, "r", encoding="utf-8") as handle:
+        sample = json.load(handle)
+    templates = [device for device in sample.get("devices") or [] if isinstance(device, dict)]
+    devices = []
+    for index in range(device_count):
+        device = copy.deepcopy(templates[index % len(templates)])
+        device["id"] = f"bench-device-{index}"
+        device["name"] = f"{device.get('name') or 'Device'} {index}"
+        devices.append(device)
+    runs = []
+    for index in range(device_count * 2):
+        runs.append(
+            {
+                "id": f"bench-run-{index}",
+                "testCaseId": f"tc-{index % 20}",
+                "status": "pass" if index % 7 else "fail",
+                "notes": "Synthetic run generated by the codec benchmark.",
+                "executedAt": "2026-01-01T10:00:00.000Z",
+                "createdAt": "2026-01-01T10:05:00.000Z",
+            }
+        )
+    home = dict(sample)
+    home["devices"] = devices
+    home["testCaseRuns"] = runs
+    return home
+
+
+def best_of(repeat, fn):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, nargs="+", default=[500, 2000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    codecs = ["stdlib"] + (["orjson"] if server.orjson is not None else [])
+    print(f"{'devices':>8} {'codec':>7} {'format':>8} {'size MB':>8} {'encode MB/s':>12} {'decode MB/s':>12}")
+    for device_count in args.devices:
+        home = build_home(device_count)
+        for codec in codecs:
+            for indent in (True, False):
+                encoded = server._json_encode(home, indent=indent, codec=codec)
+                assert server._json_decode(encoded, codec=codec) == home
+                size_mb = len(encoded) / (1024 * 1024)
+                encode_time = best_of(args.repeat, lambda: server._json_encode(home, indent=indent, codec=codec))
+                decode_time = best_of(args.repeat, lambda: server._json_decode(encoded, codec=codec))
+                print(
+                    f"{device_count:>8} {codec:>7} {'indent' if indent else 'compact':>8} {size_mb:>8.2f} "
+                    f"{size_mb / encode_time:>12.1f} {size_mb / decode_time:>12.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
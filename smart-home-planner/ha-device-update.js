@@ -1,4 +1,5 @@
 import process from "node:process";
+import readline from "node:readline";
 import WebSocket from "ws";
 import { createConnection } from "home-assistant-js-websocket";
 
@@ -63,8 +64,7 @@ function parseArgs(argv) {
   return args;
 }
 
-async function main() {
-  const { id, name, areaId, labels, hasName, hasAreaId, hasLabels } = parseArgs(process.argv.slice(2));
+function buildUpdatePayload({ id, name, areaId, labels, hasName, hasAreaId, hasLabels }) {
   if (!id) {
     throw new Error("Missing required argument: --id");
   }
@@ -74,7 +74,23 @@ async function main() {
   if (hasName && !name) {
     throw new Error("Missing required argument: --name");
   }
+  const payload = {
+    type: "config/device_registry/update",
+    device_id: id,
+  };
+  if (hasName) {
+    payload.name_by_user = name;
+  }
+  if (hasAreaId) {
+    payload.area_id = areaId || null;
+  }
+  if (hasLabels) {
+    payload.labels = Array.isArray(labels) ? labels : [];
+  }
+  return payload;
+}
 
+async function openConnection() {
   const token = String(SUPERVISOR_TOKEN || "").trim();
   if (!token) {
     throw new Error("SUPERVISOR_TOKEN is not defined.");
@@ -90,25 +106,17 @@ async function main() {
     },
   };
 
-  const conn = await createConnection({
+  return createConnection({
     auth,
     setupRetry: 0,
   });
+}
+
+async function main() {
+  const payload = buildUpdatePayload(parseArgs(process.argv.slice(2)));
+  const conn = await openConnection();
 
   try {
-    const payload = {
-      type: "config/device_registry/update",
-      device_id: id,
-    };
-    if (hasName) {
-      payload.name_by_user = name;
-    }
-    if (hasAreaId) {
-      payload.area_id = areaId || null;
-    }
-    if (hasLabels) {
-      payload.labels = Array.isArray(labels) ? labels : [];
-    }
     const result = await conn.sendMessagePromise(payload);
     process.stdout.write(`${JSON.stringify(result)}\n`);
   } finally {
@@ -116,7 +124,142 @@ async function main() {
   }
 }
 
-main().catch((error) => {
+// --serve: long-lived worker used by server.py. Reads newline-delimited
+// JSON-RPC requests ({"id", "method", "params"}) from stdin and writes one
+// response line per request to stdout, sharing a single authenticated
+// connection. Requests are handled concurrently and may complete out of order.
+async function serve() {
+  const startedAt = Date.now();
+  let connectionPromise = null;
+  let connected = false;
+
+  // Forget a connection that has failed so the next request opens a fresh one
+  // instead of waiting on the library's reconnect loop.
+  function dropConnection(promise) {
+    if (connectionPromise !== promise) return;
+    connectionPromise = null;
+    connected = false;
+    promise.then(
+      (conn) => conn.close(),
+      () => {}
+    );
+  }
+
+  function getConnection() {
+    if (!connectionPromise) {
+      const promise = openConnection().then((conn) => {
+        connected = true;
+        conn.addEventListener("disconnected", () => {
+          connected = false;
+          dropConnection(promise);
+        });
+        conn.addEventListener("ready", () => {
+          connected = true;
+        });
+        return conn;
+      });
+      promise.catch(() => dropConnection(promise));
+      connectionPromise = promise;
+    }
+    return connectionPromise;
+  }
+
+  // HA rejects with either {code, message} or a whole result message whose
+  // error is ERR_CONNECTION_LOST; normalise both into an Error.
+  function toError(error) {
+    if (error instanceof Error) return error;
+    const detail = error?.error || error;
+    return new Error(detail?.message || String(detail));
+  }
+
+  function withTimeout(promise, ms, message) {
+    let timer;
+    const timeout = new Promise((_resolve, reject) => {
+      timer = setTimeout(() => reject(new Error(message)), ms);
+    });
+    return Promise.race([promise, timeout]).finally(() => clearTimeout(timer));
+  }
+
+  async function sendToHomeAssistant(payload) {
+    const promise = getConnection();
+    const conn = await promise;
+    try {
+      return await conn.sendMessagePromise(payload);
+    } catch (error) {
+      if (!conn.connected) {
+        dropConnection(promise);
+      }
+      throw toError(error);
+    }
+  }
+
+  function respond(id, body) {
+    process.stdout.write(`${JSON.stringify({ id, ...body })}\n`);
+  }
+
+  async function handle(request) {
+    const { method, params = {} } = request;
+    if (method === "ping") {
+      // Round-trip to HA when a connection is open so a dead socket is found
+      // and replaced here rather than on the next device update.
+      let haError = null;
+      const promise = connectionPromise;
+      if (promise) {
+        try {
+          const conn = await promise;
+          await withTimeout(conn.ping(), 5000, "Home Assistant did not answer ping");
+          connected = true;
+        } catch (error) {
+          haError = toError(error).message;
+          dropConnection(promise);
+        }
+      }
+      return { ok: true, connected, haError, uptimeMs: Date.now() - startedAt };
+    }
+    if (method === "device.update") {
+      const payload = buildUpdatePayload({
+        id: String(params.deviceId || "").trim(),
+        name: String(params.name || "").trim(),
+        areaId: String(params.areaId || "").trim(),
+        labels: Array.isArray(params.labels) ? params.labels.map((value) => String(value || "").trim()).filter(Boolean) : [],
+        hasName: Object.prototype.hasOwnProperty.call(params, "name"),
+        hasAreaId: Object.prototype.hasOwnProperty.call(params, "areaId"),
+        hasLabels: Object.prototype.hasOwnProperty.call(params, "labels"),
+      });
+      return sendToHomeAssistant(payload);
+    }
+    throw new Error(`Unknown method: ${method}`);
+  }
+
+  const input = readline.createInterface({ input: process.stdin, crlfDelay: Infinity });
+  input.on("line", (line) => {
+    if (!line.trim()) return;
+    let request;
+    try {
+      request = JSON.parse(line);
+    } catch (_error) {
+      respond(null, { error: { message: "Invalid JSON request" } });
+      return;
+    }
+    handle(request).then(
+      (result) => respond(request.id, { result: result ?? null }),
+      (error) => respond(request.id, { error: { message: error?.message || String(error) } })
+    );
+  });
+  input.on("close", async () => {
+    if (connectionPromise) {
+      try {
+        (await connectionPromise).close();
+      } catch (_error) {
+        // Nothing to close.
+      }
+    }
+    process.exit(0);
+  });
+}
+
+const run = process.argv.includes("--serve") ? serve : main;
+run().catch((error) => {
   const message = error?.message || String(error);
   process.stderr.write(`${message}\n`);
   process.exit(1);
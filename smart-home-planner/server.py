@@ -1,59 +1,864 @@
 #!/usr/bin/env python3
+import bisect
+import bz2
+import copy
+import ctypes
 import datetime
+import errno
+import gzip
 import hashlib
+import heapq
+import http.client
 import io
+import itertools
 import json
+import lzma
 import math
 import mimetypes
 import os
 import re
 import secrets
 import shutil
+import struct
 import subprocess
 import tarfile
 import tempfile
 import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from email.utils import formatdate, parsedate_to_datetime
 from functools import partial
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 from urllib.parse import parse_qs, unquote, urlparse
-from urllib.request import Request, urlopen
+
+try:
+    import orjson
+except ImportError:  # Optional: stdlib json is used when orjson is not installed.
+    orjson = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Optional: without Pillow, size= serves the original image.
+    Image = None
+    ImageOps = None
 
 DATA_FILE = os.environ.get("SHP_DATA_FILE", "/data/data.json")
 DATA_DIR = os.path.dirname(DATA_FILE) or "/data"
 DEVICE_FILES_DIR = os.path.join(DATA_DIR, "device-files")
+DEVICE_BLOBS_DIR = os.path.join(DATA_DIR, "device-blobs")
+DEVICE_UPLOADS_DIR = os.path.join(DATA_DIR, "device-uploads")
+DEVICE_DERIVATIVES_DIR = os.path.join(DATA_DIR, "device-derivatives")
 AREAS_FILE = os.path.join(DATA_DIR, "areas.json")
 FLOORS_FILE = os.path.join(DATA_DIR, "floors.json")
 DEVICES_FILE = os.path.join(DATA_DIR, "devices.json")
 LABELS_FILE = os.path.join(DATA_DIR, "labels.json")
+REGISTRY_FILES = {"areas": AREAS_FILE, "floors": FLOORS_FILE, "devices": DEVICES_FILE, "labels": LABELS_FILE}
 BACKUPS_DEBUG_FILE = os.path.join(DATA_DIR, "backups.json")
+STORAGE_VERSION_FILE = f"{DATA_FILE}.version"
+STORAGE_JOURNAL_FILE = f"{DATA_FILE}.journal"
+FILE_DIGESTS_FILE = os.path.join(DATA_DIR, "device-file-digests.json")
+NOTIFICATION_SCHEDULE_FILE = os.path.join(DATA_DIR, "notification-schedule.json")
+EXPORT_MANIFESTS_DIR = os.path.join(DATA_DIR, "export-manifests")
+EXPORT_MANIFEST_MEMBER = "export-manifest.json"
+MAX_STORED_EXPORT_MANIFESTS = 10
 WEB_ROOT = os.environ.get("SHP_WEB_ROOT", "/srv")
 HOST = os.environ.get("SHP_HOST", "")
 PORT = int(os.environ.get("SHP_PORT", "80"))
 NODE_BIN = os.environ.get("SHP_NODE_BIN", "node")
 HA_DEVICE_UPDATE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ha-device-update.js")
+HA_BATCH_CONCURRENCY = max(1, int(os.environ.get("SHP_HA_BATCH_CONCURRENCY", "8")))
+MAX_HA_BATCH_OPERATIONS = max(1, int(os.environ.get("SHP_MAX_HA_BATCH_OPERATIONS", "2000")))
 SUPERVISOR_TOKEN = os.environ.get("SUPERVISOR_TOKEN", "")
 SUPERVISOR_CORE_URL = os.environ.get("SUPERVISOR_CORE_URL", "http://supervisor/core")
 SUPERVISOR_API_URL = os.environ.get("SUPERVISOR_API_URL", "http://supervisor")
+# GET results from Supervisor/Core are served from memory for the TTL, then
+# served stale for up to SUPERVISOR_STALE_SECONDS while a refresh runs. A TTL
+# of 0 disables the cache, stale window included.
+HA_CONFIG_CACHE_SECONDS = max(0.0, float(os.environ.get("SHP_HA_CONFIG_CACHE_SECONDS", "300")))
+SUPERVISOR_CACHE_SECONDS = max(0.0, float(os.environ.get("SHP_SUPERVISOR_CACHE_SECONDS", "15")))
+SUPERVISOR_STALE_SECONDS = max(0.0, float(os.environ.get("SHP_SUPERVISOR_STALE_SECONDS", "300")))
+SUPERVISOR_REQUEST_RETRIES = max(0, int(os.environ.get("SHP_SUPERVISOR_REQUEST_RETRIES", "2")))
+BACKUP_STATUS_REFRESH_SECONDS = max(10.0, float(os.environ.get("SHP_BACKUP_STATUS_REFRESH_SECONDS", "120")))
 HOSTNAME = os.environ.get("HOSTNAME", "unknown")
 HOSTNAME_NORMALIZED = HOSTNAME.strip().lower()
 IS_LOCAL_RUNTIME = HOSTNAME_NORMALIZED.startswith("local_") or HOSTNAME_NORMALIZED.startswith("local-")
 MAX_DEBUG_FILE_BYTES = 1024 * 1024 * 2
 MAX_UPLOAD_FILE_BYTES = int(os.environ.get("SHP_MAX_UPLOAD_FILE_BYTES", str(20 * 1024 * 1024)))
 MAX_IMPORT_ARCHIVE_BYTES = int(os.environ.get("SHP_MAX_IMPORT_ARCHIVE_BYTES", str(300 * 1024 * 1024)))
+MAX_IMPORT_EXTRACTED_BYTES = int(os.environ.get("SHP_MAX_IMPORT_EXTRACTED_BYTES", str(4 * MAX_IMPORT_ARCHIVE_BYTES)))
+IMPORT_CHUNK_BYTES = 1024 * 1024
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+UPLOAD_SESSION_TTL_SECONDS = max(60.0, float(os.environ.get("SHP_UPLOAD_SESSION_TTL_SECONDS", str(24 * 3600))))
+DEVICE_UPLOAD_PATH_PATTERN = re.compile(r"^/api/device-files/uploads/([0-9a-f]{32})$")
+# Names generated by _publish_device_file (<stem>-<unix time>-<6 hex>) are never
+# reused for different content, so responses for them can be cached forever.
+UNIQUE_DEVICE_FILE_NAME_PATTERN = re.compile(r"-\d{9,}-[0-9a-f]{6}(\.[^./]*)?$")
+MAX_DEVICE_FILE_RANGES = 16
+# Longest edge in pixels for each rendition served via ?size=.
+DERIVATIVE_SIZES = {"thumb": 256, "preview": 1024}
+DERIVATIVE_CACHE_MAX_BYTES = max(0, int(os.environ.get("SHP_DERIVATIVE_CACHE_MAX_BYTES", str(256 * 1024 * 1024))))
+DERIVATIVE_WORKERS = max(1, int(os.environ.get("SHP_DERIVATIVE_WORKERS", "2")))
+# A failed render is retried after this long; at most this many failures are remembered.
+DERIVATIVE_FAILURE_RETRY_SECONDS = 600.0
+DERIVATIVE_MAX_FAILURES = 1024
+# Formats Pillow can read that are worth scaling down; SVG and icons are served as is.
+DERIVATIVE_SOURCE_TYPES = {"image/jpeg", "image/png", "image/webp", "image/gif", "image/bmp", "image/tiff"}
+IMPORT_STAGING_PREFIX = ".import-"
 FILENAME_SAFE_PATTERN = re.compile(r"[^A-Za-z0-9._-]+")
 SMART_HOME_PLANNER_ADDON_SLUG = "1750ef26_smart-home-planner"
+STORAGE_JOURNAL_ENABLED = os.environ.get("SHP_STORAGE_JOURNAL", "").strip().lower() in {"1", "true", "yes"}
+STORAGE_JOURNAL_MAX_BYTES = max(1, int(os.environ.get("SHP_STORAGE_JOURNAL_MAX_BYTES", str(4 * 1024 * 1024))))
+STORAGE_JOURNAL_MAX_AGE_SECONDS = max(0.0, float(os.environ.get("SHP_STORAGE_JOURNAL_MAX_AGE_SECONDS", "10")))
+STORAGE_JOURNAL_CHECK_SECONDS = 1.0
+# Appended change sets kept in memory for rebasing stale full-document writes.
+STORAGE_REBASE_HISTORY = 64
+STORAGE_COMPACT_JSON = os.environ.get("SHP_STORAGE_COMPACT_JSON", "").strip().lower() in {"1", "true", "yes"}
+JSON_CODEC = os.environ.get("SHP_JSON_CODEC", "auto").strip().lower()
+JSON_GZIP_MIN_BYTES = max(0, int(os.environ.get("SHP_JSON_GZIP_MIN_BYTES", "2048")))
+JSON_GZIP_LEVEL = min(9, max(1, int(os.environ.get("SHP_JSON_GZIP_LEVEL", "6"))))
+SERVER_MODE = os.environ.get("SHP_SERVER_MODE", "threaded").strip().lower()
+SERVER_WORKERS = max(1, int(os.environ.get("SHP_SERVER_WORKERS", "8")))
+SERVER_MAX_QUEUED = max(0, int(os.environ.get("SHP_SERVER_MAX_QUEUED", "32")))
+SERVER_LISTEN_BACKLOG = max(1, int(os.environ.get("SHP_SERVER_LISTEN_BACKLOG", "64")))
+SERVER_BULK_WORKERS = max(1, int(os.environ.get("SHP_SERVER_BULK_WORKERS", str(max(1, SERVER_WORKERS // 2)))))
+# Long-running routes (archive transfers, uploads, node subprocess calls) share a
+# smaller slot pool so they can never occupy every worker.
+BULK_REQUEST_ROUTES = {
+    "/api/import",
+    "/api/export",
+    "/api/device-files/upload",
+    "/api/device-files/uploads/{id}",
+    "/api/ha/device-name",
+    "/api/ha/device-area",
+    "/api/ha/device-labels",
+    "/api/ha/devices/batch",
+}
+# Exact /api paths reported individually in request stats; anything else is
+# counted under "/api/*" so probing clients cannot grow the table without bound.
+KNOWN_API_ROUTES = BULK_REQUEST_ROUTES | {
+    "/api/runtime",
+    "/api/storage",
+    "/api/server/requests",
+    "/api/device-files",
+    "/api/device-files/content",
+    "/api/device-files/rename",
+    "/api/device-files/uploads",
+    "/api/export/manifest",
+    "/api/import/status",
+    "/api/ha/config",
+    "/api/ha/registries",
+    "/api/ha/backups-status",
+    "/api/ha/{registry}",
+    "/api/maintenance/upcoming",
+    "/api/notifications/check",
+    "/api/notifications/schedule",
+    "/api/debug/file",
+    "/api/debug/files",
+    "/api/debug/test-notification",
+}
+
+EMPTY_STORAGE_ETAG = "\"0-empty\""
+# Re-reads of data.json when it is replaced mid-read or fails to parse.
+STORAGE_READ_ATTEMPTS = 3
+# Cache key for a document rebuilt from the journal while data.json is missing.
+MISSING_STORAGE_KEY = ("missing",)
 
 _lock = threading.Lock()
 
 
-def _read_storage():
-    if not os.path.exists(DATA_FILE):
-        return {}
+def _resolve_json_codec(requested):
+    if requested in {"auto", "orjson"} and orjson is not None:
+        return "orjson"
+    return "stdlib"
+
+
+ACTIVE_JSON_CODEC = _resolve_json_codec(JSON_CODEC)
+
+
+def _reject_non_finite_numbers(value, label="Storage"):
+    """Raise ValueError if ``value`` holds NaN or Infinity anywhere.
+
+    Stored documents are checked once on their way in (PUT, PATCH, entity
+    writes, imports) so the encoders never have to look for them.
+    """
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, float):
+            if not math.isfinite(item):
+                raise ValueError(f"{label} cannot contain NaN or Infinity")
+        elif isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+
+
+def _json_encode(payload, indent=False, codec=None):
+    """Encode to UTF-8 JSON bytes with the fastest available codec.
+
+    orjson rejects integers beyond 64 bits, so those fall back to stdlib. It
+    also writes NaN/Infinity as null; storage documents cannot contain them
+    (see _reject_non_finite_numbers), so the two codecs agree on everything
+    the server stores.
+    """
+    if (codec or ACTIVE_JSON_CODEC) == "orjson":
+        options = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            return orjson.dumps(payload, option=options)
+        except TypeError:
+            pass
+    if indent:
+        return json.dumps(payload, indent=2).encode("utf-8")
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def _json_decode(raw, codec=None):
+    """Decode JSON bytes or text; raises json.JSONDecodeError like stdlib."""
+    if (codec or ACTIVE_JSON_CODEC) == "orjson":
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        raw = bytes(raw).decode("utf-8")
+    return json.loads(raw)
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _fsync_directory(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_file_atomic(path, raw):
+    # A unique temp name keeps concurrent writers of the same file (snapshot
+    # commits, journal compaction) from clobbering each other's temp file.
+    tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    with open(tmp_path, "wb") as handle:
+        handle.write(raw)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(tmp_path, path)
+    _fsync_directory(os.path.dirname(path) or ".")
+
+
+class _StorageCache:
+    """Process-wide parsed copy of data.json keyed on (inode, mtime_ns, size).
+
+    Writers (this server and registry-sync.js) always replace data.json through a
+    rename, so any external change shows up as a new key and forces a re-parse.
+    Cached documents are shared between requests and must be treated as read-only.
+
+    The cache also owns the storage version: a counter bumped on every commit plus
+    a digest, persisted in STORAGE_VERSION_FILE. The ETag is derived from both, so
+    GET and If-Match checks never re-hash the document.
+
+    In journal mode a commit appends its changes to STORAGE_JOURNAL_FILE instead
+    of rewriting data.json; the in-memory document stays authoritative and
+    ``compact`` folds the journal back into a fresh snapshot. Entity writes use
+    the journal in every mode.
+
+    The last STORAGE_REBASE_HISTORY appended change sets are kept with the ETag
+    they were applied to, so a full-document write based on a slightly older
+    ETag can be rebased instead of rejected (see ``changes_since``).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._payload = None
+        self._version = None
+        self._digest = None
+        self._index = None
+        self._encoded = None
+        self._snapshot_seq = 0
+        self._journal_seq = 0
+        self._journal_records = []
+        self._journal_bytes = 0
+        self._journal_started_at = None
+        self._compaction_requested = False
+        self._history = []
+        self.hits = 0
+        self.misses = 0
+        self.compactions = 0
+
+    def _etag_locked(self):
+        if self._version is None or self._digest is None:
+            return EMPTY_STORAGE_ETAG
+        return f"\"{self._version}-{self._digest[:24]}\""
+
+    def get(self):
+        key = _stat_key(DATA_FILE)
+        with self._lock:
+            if key == self._key and key is not None:
+                self.hits += 1
+                return self._payload, True, self._etag_locked()
+            if key is None and self._key == MISSING_STORAGE_KEY:
+                self.hits += 1
+                return self._payload, True, self._etag_locked()
+        if key is None:
+            # A journal without its snapshot still holds committed changes:
+            # replay it onto an empty document rather than dropping it.
+            if not _read_storage_journal():
+                return {}, False, EMPTY_STORAGE_ETAG
+            with self._lock:
+                self.misses += 1
+                self._load_locked(MISSING_STORAGE_KEY, b"{}", {})
+                return self._payload, False, self._etag_locked()
+        for attempt in range(STORAGE_READ_ATTEMPTS):
+            if attempt:
+                time.sleep(0.05 * attempt)
+                key = _stat_key(DATA_FILE)
+                if key is None:
+                    return self.get()
+            try:
+                with open(DATA_FILE, "rb") as handle:
+                    raw = handle.read()
+                payload = _json_decode(raw)
+            except Exception:
+                raw = None
+                payload = {}
+            # Only trust the parse if nobody swapped the file while we were reading it.
+            if raw is not None and _stat_key(DATA_FILE) == key:
+                break
+        else:
+            # Never hand out EMPTY_STORAGE_ETAG here: a client could send it
+            # back as If-Match and overwrite a document it never saw. A fresh
+            # tag per read cannot match any later one.
+            with self._lock:
+                self.misses += 1
+            return payload, False, f"\"0-unreadable-{secrets.token_hex(8)}\""
+        with self._lock:
+            self.misses += 1
+            self._load_locked(key, raw, payload)
+            return self._payload, False, self._etag_locked()
+
+    def _load_locked(self, key, raw, payload):
+        """Adopt a freshly read data.json (cold start or an external writer)."""
+        meta = _read_storage_version_file()
+        snapshot_digest = hashlib.sha256(raw).hexdigest()
+        if self._version is None:
+            self._version = meta.get("version", 0)
+            self._digest = meta.get("etagDigest") or meta.get("digest")
+            self._snapshot_seq = meta.get("journalSeq", 0)
+            self._journal_seq = self._snapshot_seq
+        external_change = snapshot_digest != meta.get("digest")
+
+        pending = [record for record in _read_storage_journal() if record["seq"] > self._snapshot_seq]
+        if self._journal_records:
+            # Records this process appended but never compacted are the freshest copy.
+            known = {record["seq"] for record in pending}
+            pending.extend(record for record in self._journal_records if record["seq"] not in known)
+            pending.sort(key=lambda record: record["seq"])
+        for record in pending:
+            if external_change:
+                payload = _rebase_journal_changes(payload, record["changes"])
+            else:
+                payload = _apply_journal_changes(payload, record["changes"])
+            self._journal_seq = max(self._journal_seq, record["seq"])
+            self._version = max(self._version, record.get("version", 0))
+            if not external_change:
+                self._digest = record.get("etag") or self._digest
+
+        if external_change:
+            # Changes on disk we did not write (registry-sync.js rewrites
+            # data.json from a snapshot that may predate pending records): bump
+            # the version once; the records were merged field by field above.
+            self._version += 1
+            self._digest = snapshot_digest
+            self._history = []
+        self._key = key
+        self._payload = payload
+        if pending or external_change or meta.get("statKey") != list(key):
+            self._journal_records = pending
+            self._journal_bytes = sum(record.get("size", 0) for record in pending)
+            if pending:
+                # data.json is only rewritten under _lock (see compact()); the
+                # replayed records stay in the journal until then.
+                self._compaction_requested = True
+                if self._journal_started_at is None:
+                    self._journal_started_at = time.monotonic()
+            else:
+                _write_storage_version_file(
+                    self._version, snapshot_digest, self._digest, self._snapshot_seq, key
+                )
+
+    def commit(self, payload, raw):
+        """Record a snapshot write made by this server and return the new ETag."""
+        key = _stat_key(DATA_FILE)
+        digest = hashlib.sha256(raw).hexdigest()
+        with self._lock:
+            if self._version is None:
+                meta = _read_storage_version_file()
+                self._version = meta.get("version", 0)
+                self._digest = meta.get("etagDigest") or meta.get("digest")
+            if digest != self._digest:
+                self._version += 1
+                self._digest = digest
+                # A snapshot write carries no change records to rebase over.
+                self._history = []
+            self._snapshot_seq = self._journal_seq
+            self._journal_records = []
+            self._journal_bytes = 0
+            self._journal_started_at = None
+            self._compaction_requested = False
+            _write_storage_version_file(self._version, digest, self._digest, self._snapshot_seq, key)
+            _truncate_storage_journal()
+            self._key = key
+            self._payload = payload if key is not None else None
+            return self._etag_locked()
+
+    def append(self, payload, changes):
+        """Journal a commit: fsync a change record and adopt ``payload`` in memory."""
+        with self._lock:
+            if not changes:
+                return self._etag_locked()
+            self._history.append((self._etag_locked(), changes))
+            del self._history[:-STORAGE_REBASE_HISTORY]
+            changes_json = _json_encode(changes).decode("utf-8")
+            seq = self._journal_seq + 1
+            version = self._version + 1
+            digest = hashlib.sha256(f"{self._digest}:{changes_json}".encode("utf-8")).hexdigest()
+            line = f'{{"seq":{seq},"version":{version},"etag":"{digest}","changes":{changes_json}}}\n'.encode("utf-8")
+            _append_storage_journal(line)
+            self._journal_seq = seq
+            self._version = version
+            self._digest = digest
+            self._journal_records.append({"seq": seq, "version": version, "etag": digest, "changes": changes, "size": len(line)})
+            self._journal_bytes += len(line)
+            if self._journal_started_at is None:
+                self._journal_started_at = time.monotonic()
+            self._payload = payload
+            return self._etag_locked()
+
+    def changes_since(self, etag):
+        """Change records committed after ``etag``, oldest first; None if ``etag`` is too old."""
+        with self._lock:
+            changes = []
+            for previous_etag, record_changes in reversed(self._history):
+                changes[:0] = record_changes
+                if previous_etag == etag:
+                    return changes
+            return None
+
+    def needs_compaction(self):
+        with self._lock:
+            if not self._journal_records:
+                return False
+            if self._compaction_requested:
+                return True
+            if self._journal_bytes >= STORAGE_JOURNAL_MAX_BYTES:
+                return True
+            return time.monotonic() - (self._journal_started_at or 0) >= STORAGE_JOURNAL_MAX_AGE_SECONDS
+
+    def compact(self):
+        """Fold pending journal records into data.json. Callers must hold ``_lock``."""
+        with self._lock:
+            if self._journal_records and self._payload is not None:
+                self._compact_locked(self._payload)
+
+    def _compact_locked(self, payload):
+        raw = _encode_storage_snapshot(payload)
+        _write_file_atomic(DATA_FILE, raw)
+        key = _stat_key(DATA_FILE)
+        self._snapshot_seq = self._journal_seq
+        _write_storage_version_file(
+            self._version, hashlib.sha256(raw).hexdigest(), self._digest, self._snapshot_seq, key
+        )
+        _truncate_storage_journal()
+        self._journal_records = []
+        self._journal_bytes = 0
+        self._journal_started_at = None
+        self._compaction_requested = False
+        self._key = key
+        self._payload = payload
+        self.compactions += 1
+
+    def has_document(self):
+        with self._lock:
+            return self._key is not None
+
+    def encoded(self, payload):
+        """JSON bytes of ``payload``, encoded once per cached document."""
+        with self._lock:
+            if self._encoded is not None and self._encoded[0] is payload:
+                return self._encoded[1]
+        body = _json_encode(payload)
+        with self._lock:
+            if self._payload is payload:
+                self._encoded = (payload, body)
+        return body
+
+    def entity_index(self, payload):
+        with self._lock:
+            if self._index is None or self._index.payload is not payload:
+                self._index = _EntityIndex(payload)
+            return self._index
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": round(self.hits / total, 4) if total else None,
+                "version": self._version,
+                "codec": ACTIVE_JSON_CODEC,
+                "compactOnDisk": STORAGE_COMPACT_JSON,
+                "journal": {
+                    "enabled": STORAGE_JOURNAL_ENABLED,
+                    "pendingRecords": len(self._journal_records),
+                    "pendingBytes": self._journal_bytes,
+                    "seq": self._journal_seq,
+                    "compactions": self.compactions,
+                },
+            }
+
+
+def _read_storage_version_file():
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as handle:
-            return json.load(handle)
+        with open(STORAGE_VERSION_FILE, "r", encoding="utf-8") as handle:
+            meta = json.load(handle)
     except Exception:
         return {}
+    if not isinstance(meta, dict):
+        return {}
+    version = meta.get("version")
+    if not isinstance(version, int) or version < 0:
+        return {}
+    if not isinstance(meta.get("journalSeq"), int):
+        meta["journalSeq"] = 0
+    return meta
+
+
+def _write_storage_version_file(version, digest, etag_digest, journal_seq, stat_key):
+    meta = {
+        "version": version,
+        "digest": digest,
+        "etagDigest": etag_digest,
+        "journalSeq": journal_seq,
+        "statKey": list(stat_key or []),
+    }
+    try:
+        _write_file_atomic(STORAGE_VERSION_FILE, json.dumps(meta).encode("utf-8"))
+    except OSError:
+        pass
+
+
+def _read_storage_journal():
+    try:
+        with open(STORAGE_JOURNAL_FILE, "rb") as handle:
+            lines = handle.readlines()
+    except OSError:
+        return []
+    records = []
+    for line in lines:
+        try:
+            record = _json_decode(line)
+        except Exception:
+            # A torn trailing record from a crash mid-append is simply dropped.
+            break
+        if not isinstance(record, dict) or not isinstance(record.get("seq"), int):
+            break
+        if not isinstance(record.get("changes"), list):
+            break
+        record["size"] = len(line)
+        records.append(record)
+    return records
+
+
+_journal_handle = None
+
+
+def _append_storage_journal(line):
+    global _journal_handle
+    if _journal_handle is None:
+        _journal_handle = open(STORAGE_JOURNAL_FILE, "ab")
+        _fsync_directory(os.path.dirname(STORAGE_JOURNAL_FILE) or ".")
+    _journal_handle.write(line)
+    _journal_handle.flush()
+    os.fsync(_journal_handle.fileno())
+
+
+def _truncate_storage_journal():
+    global _journal_handle
+    if _journal_handle is not None:
+        _journal_handle.close()
+        _journal_handle = None
+    try:
+        os.remove(STORAGE_JOURNAL_FILE)
+    except FileNotFoundError:
+        return
+    _fsync_directory(os.path.dirname(STORAGE_JOURNAL_FILE) or ".")
+
+
+def _diff_entity_list(old_items, new_items, kind):
+    """Per-id changes between two entity lists, or None when only a full set fits.
+
+    Entity records replay as upsert-by-id (new ids are appended), so the diff
+    only applies when existing entities keep their relative order.
+    """
+    def index_by_id(items):
+        result = {}
+        for item in items:
+            if not isinstance(item, dict):
+                return None
+            item_id = str(item.get("id") or "").strip()
+            if not item_id or item_id in result:
+                return None
+            result[item_id] = item
+        return result
+
+    old_by_id = index_by_id(old_items)
+    new_by_id = index_by_id(new_items)
+    if old_by_id is None or new_by_id is None:
+        return None
+    new_ids = list(new_by_id)
+    kept_old_order = [item_id for item_id in old_by_id if item_id in new_by_id]
+    if new_ids[: len(kept_old_order)] != kept_old_order:
+        return None
+
+    # ``before`` lets a rebase onto a foreign data.json merge per field.
+    changes = []
+    for item_id, item in old_by_id.items():
+        if item_id not in new_by_id:
+            changes.append({"op": "entity", "kind": kind, "id": item_id, "value": None, "before": item})
+    for item_id, item in new_by_id.items():
+        previous = old_by_id.get(item_id)
+        if previous is item or previous == item:
+            continue
+        changes.append({"op": "entity", "kind": kind, "id": item_id, "value": item, "before": previous})
+    return changes
+
+
+def _diff_storage_changes(current, payload):
+    """Idempotent change records that turn ``current`` into ``payload``."""
+    current = current if isinstance(current, dict) else {}
+    changes = [{"op": "unset", "key": key, "before": current[key]} for key in current if key not in payload]
+    for key, value in payload.items():
+        if key not in current:
+            changes.append({"op": "set", "key": key, "value": value, "before": None})
+            continue
+        previous = current[key]
+        if previous is value:
+            continue
+        if key in STORAGE_ENTITY_COLLECTIONS and isinstance(previous, list) and isinstance(value, list):
+            entity_changes = _diff_entity_list(previous, value, key)
+            if entity_changes is not None:
+                changes.extend(entity_changes)
+                continue
+        if previous != value:
+            changes.append({"op": "set", "key": key, "value": value, "before": previous})
+    return changes
+
+
+def _merge_entity_fields(theirs, before, ours):
+    """Three-way merge of one entity: fields this server changed win, others keep ``theirs``."""
+    if not isinstance(theirs, dict) or not isinstance(ours, dict):
+        return ours
+    if not isinstance(before, dict):
+        return {**theirs, **ours}
+    merged = dict(theirs)
+    for field in set(before) | set(ours):
+        if field not in ours:
+            if field in before:
+                merged.pop(field, None)
+        elif field not in before or before[field] != ours[field]:
+            merged[field] = ours[field]
+    return merged
+
+
+def _merge_entity_lists(theirs, before, ours):
+    """Three-way merge of an entity collection by id; falls back to ``ours``."""
+    def index_by_id(items):
+        result = {}
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict) or not str(item.get("id") or "").strip():
+                return None
+            result[str(item.get("id")).strip()] = item
+        return result
+
+    theirs_by_id, before_by_id, ours_by_id = index_by_id(theirs), index_by_id(before), index_by_id(ours)
+    if theirs_by_id is None or before_by_id is None or ours_by_id is None:
+        return ours
+    merged = []
+    for item_id, item in theirs_by_id.items():
+        if item_id in ours_by_id:
+            merged.append(_merge_entity_fields(item, before_by_id.get(item_id), ours_by_id[item_id]))
+        elif item_id not in before_by_id:
+            merged.append(item)
+    for item_id, item in ours_by_id.items():
+        if item_id in theirs_by_id:
+            continue
+        previous = before_by_id.get(item_id)
+        # Deleted by the other writer: keep it only if this server changed it.
+        if previous is None or previous != item:
+            merged.append(item)
+    return merged
+
+
+def _rebase_journal_changes(payload, changes):
+    """Replay journal ``changes`` onto a data.json that another writer replaced.
+
+    Records carry the value they replaced (``before``), so each change is
+    merged field by field: the other writer's edits survive unless this
+    server changed the same field. Records written before ``before`` existed
+    replay as plain upserts.
+    """
+    next_payload = dict(payload) if isinstance(payload, dict) else {}
+    for change in changes:
+        if "before" not in change:
+            next_payload = _apply_journal_changes(next_payload, [change])
+            continue
+        op = change.get("op")
+        before = change.get("before")
+        if op == "unset":
+            next_payload.pop(change["key"], None)
+        elif op == "set":
+            key = change["key"]
+            theirs = next_payload.get(key)
+            ours = change.get("value")
+            if theirs == before:
+                next_payload[key] = ours
+            elif key in STORAGE_ENTITY_COLLECTIONS:
+                next_payload[key] = _merge_entity_lists(theirs, before, ours)
+            else:
+                next_payload[key] = _merge_entity_fields(theirs, before, ours)
+        elif op == "entity":
+            value = change.get("value")
+            if value is not None:
+                items = next_payload.get(change["kind"])
+                theirs = next(
+                    (
+                        item
+                        for item in (items if isinstance(items, list) else [])
+                        if isinstance(item, dict) and str(item.get("id") or "").strip() == change["id"]
+                    ),
+                    None,
+                )
+                if theirs is not None:
+                    value = _merge_entity_fields(theirs, before, value)
+            next_payload = _apply_journal_changes(next_payload, [{**change, "value": value}])
+    return next_payload
+
+
+def _apply_journal_changes(payload, changes):
+    next_payload = dict(payload) if isinstance(payload, dict) else {}
+    copied_kinds = set()
+    for change in changes:
+        op = change.get("op")
+        if op == "set":
+            next_payload[change["key"]] = change.get("value")
+            copied_kinds.discard(change["key"])
+        elif op == "unset":
+            next_payload.pop(change["key"], None)
+        elif op == "entity":
+            kind = change["kind"]
+            items = next_payload.get(kind)
+            if kind not in copied_kinds:
+                items = list(items) if isinstance(items, list) else []
+                next_payload[kind] = items
+                copied_kinds.add(kind)
+            position = next(
+                (i for i, item in enumerate(items) if isinstance(item, dict) and str(item.get("id") or "").strip() == change["id"]),
+                None,
+            )
+            value = change.get("value")
+            if value is None:
+                if position is not None:
+                    del items[position]
+            elif position is None:
+                items.append(value)
+            else:
+                items[position] = value
+    return next_payload
+
+
+def _revert_journal_changes(payload, changes):
+    """Undo ``changes`` (records carrying ``before``) to recover the document they were applied to."""
+    reverted = []
+    for change in reversed(changes):
+        op = change.get("op")
+        before = change.get("before")
+        if op == "entity":
+            reverted.append({"op": "entity", "kind": change["kind"], "id": change["id"], "value": before})
+        elif op == "set" and before is None:
+            reverted.append({"op": "unset", "key": change["key"]})
+        else:
+            reverted.append({"op": "set", "key": change["key"], "value": before})
+    return _apply_journal_changes(payload, reverted)
+
+
+def _rebase_storage_write(current, base, payload, concurrent):
+    """Apply the edits ``payload`` makes to ``base`` on top of ``current``.
+
+    ``concurrent`` are the changes that turned ``base`` into ``current``.
+    Returns None when both sides touched the same entity, or the same
+    top-level key outside an entity collection.
+    """
+    touched_keys = set()
+    touched_entities = set()
+    for change in concurrent:
+        if change.get("op") == "entity":
+            touched_entities.add((change["kind"], change["id"]))
+        else:
+            touched_keys.add(change["key"])
+    touched_kinds = {kind for kind, _entity_id in touched_entities}
+
+    ours = _diff_storage_changes(base, payload)
+    for change in ours:
+        if change.get("op") == "entity":
+            if (change["kind"], change["id"]) in touched_entities or change["kind"] in touched_keys:
+                return None
+        elif change["key"] in touched_keys or change["key"] in touched_kinds:
+            return None
+    return _apply_journal_changes(current, ours)
+
+
+def _storage_base_for_if_match(if_match_header, current):
+    """Return (base document, concurrent changes) for an If-Match naming an older ETag, or None."""
+    for raw_token in str(if_match_header or "").split(","):
+        token = raw_token.strip()
+        if token.startswith("W/"):
+            token = token[2:].strip()
+        if not token or token == "*":
+            continue
+        concurrent = _storage_cache.changes_since(token)
+        if concurrent is not None:
+            return _revert_journal_changes(current, concurrent), concurrent
+    return None
+
+
+def _encode_storage_snapshot(payload):
+    return _json_encode(payload, indent=not STORAGE_COMPACT_JSON)
+
+
+_storage_cache = _StorageCache()
+
+
+def _read_storage_cached():
+    return _storage_cache.get()
+
+
+def _read_storage():
+    return _read_storage_cached()[0]
 
 
 def _read_registry(path):
@@ -67,26 +872,78 @@ def _read_registry(path):
     return payload if isinstance(payload, list) else []
 
 
-def _write_storage(payload):
-    os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
-    tmp_path = f"{DATA_FILE}.tmp"
-    with open(tmp_path, "w", encoding="utf-8") as handle:
-        json.dump(payload, handle, indent=2)
-    os.replace(tmp_path, DATA_FILE)
+class _RegistryCache:
+    """Parsed and encoded HA registry files, re-read only when their stat key changes.
+
+    registry-sync.js replaces these files by rename, so a changed file always
+    shows up as a new (inode, mtime, size) key and never needs ``_lock``.
+    """
+
+    def __init__(self, files):
+        self._files = files
+        self._mutex = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        path = self._files[name]
+        key = _stat_key(path)
+        with self._mutex:
+            entry = self._entries.get(name)
+            if entry is not None and entry["key"] == key:
+                self.hits += 1
+                return entry
+        payload = _read_registry(path)
+        body = _json_encode(payload)
+        entry = {
+            "key": key,
+            "payload": payload,
+            "body": body,
+            "etag": f"\"r-{name}-{hashlib.sha256(body).hexdigest()[:20]}\"",
+        }
+        with self._mutex:
+            self.misses += 1
+            self._entries[name] = entry
+        return entry
 
+    def stats(self):
+        with self._mutex:
+            return {"hits": self.hits, "misses": self.misses, "cached": sorted(self._entries)}
 
-def _build_storage_etag(payload):
-    try:
-        canonical = json.dumps(
-            payload if isinstance(payload, dict) else {},
-            sort_keys=True,
-            separators=(",", ":"),
-            ensure_ascii=False,
-        )
-    except Exception:
-        canonical = "{}"
-    digest = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
-    return f"\"{digest}\""
+
+_registry_cache = _RegistryCache(REGISTRY_FILES)
+
+
+def _write_storage(payload, snapshot=False, changes=None):
+    """Commit ``payload`` and return its ETag. Callers must hold ``_lock``.
+
+    ``changes`` are the records that turn the current document into
+    ``payload`` (entity writes know theirs). They are journaled in every mode,
+    so saving one entity never rewrites data.json; the compactor folds them in.
+    """
+    os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
+    current, _, _ = _storage_cache.get()
+    _notification_scheduler.storage_changed(current, payload)
+    if not snapshot and (changes is not None or STORAGE_JOURNAL_ENABLED):
+        if _storage_cache.has_document():
+            if changes is None:
+                changes = _diff_storage_changes(current, payload)
+            return _storage_cache.append(payload, changes)
+    raw = _encode_storage_snapshot(payload)
+    _write_file_atomic(DATA_FILE, raw)
+    return _storage_cache.commit(payload, raw)
+
+
+def _storage_compactor_loop(stop_event):
+    while not stop_event.wait(STORAGE_JOURNAL_CHECK_SECONDS):
+        if not _storage_cache.needs_compaction():
+            continue
+        try:
+            with _lock:
+                _storage_cache.compact()
+        except Exception as error:
+            print(f"[storage] journal compaction failed: {error}", flush=True)
 
 
 def _if_match_allows_current(if_match_header, current_etag):
@@ -151,6 +1008,233 @@ def _validate_storage_payload(payload):
                 raise ValueError(f"{label} cannot be negative (device: {device_name})")
 
 
+class StoragePatchError(ValueError):
+    pass
+
+
+def _apply_merge_patch(target, patch):
+    """RFC 7396 merge patch. Returns a new value and never mutates ``target``."""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = _apply_merge_patch(result.get(key), value)
+    return result
+
+
+def _parse_json_pointer(pointer):
+    raw = str(pointer if pointer is not None else "")
+    if raw == "":
+        return []
+    if not raw.startswith("/"):
+        raise StoragePatchError(f"Invalid JSON pointer: {raw}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in raw[1:].split("/")]
+
+
+def _json_pointer_index(container, token, allow_end=False):
+    if token == "-" and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith("0")):
+        raise StoragePatchError(f"Invalid array index: {token}")
+    index = int(token)
+    limit = len(container) if allow_end else len(container) - 1
+    if index > limit:
+        raise StoragePatchError(f"Array index out of range: {token}")
+    return index
+
+
+class _JsonPatchDocument:
+    """Applies RFC 6902 operations with copy-on-write along the touched paths.
+
+    The source document is the shared storage cache entry, so every container on
+    a written path is shallow-copied once before it is modified.
+    """
+
+    def __init__(self, document):
+        self.root = document
+        self._owned = set()
+
+    def _own(self, value):
+        if isinstance(value, dict):
+            value = dict(value)
+        elif isinstance(value, list):
+            value = list(value)
+        else:
+            return value
+        self._owned.add(id(value))
+        return value
+
+    def _writable_parent(self, tokens):
+        if id(self.root) not in self._owned:
+            self.root = self._own(self.root)
+        node = self.root
+        for token in tokens[:-1]:
+            if isinstance(node, dict):
+                if token not in node:
+                    raise StoragePatchError(f"Path not found: /{'/'.join(tokens)}")
+                key = token
+            elif isinstance(node, list):
+                key = _json_pointer_index(node, token)
+            else:
+                raise StoragePatchError(f"Path not found: /{'/'.join(tokens)}")
+            child = node[key]
+            if not isinstance(child, (dict, list)):
+                raise StoragePatchError(f"Path not found: /{'/'.join(tokens)}")
+            if id(child) not in self._owned:
+                child = self._own(child)
+                node[key] = child
+            node = child
+        return node
+
+    def get(self, tokens):
+        node = self.root
+        for token in tokens:
+            if isinstance(node, dict):
+                if token not in node:
+                    raise StoragePatchError(f"Path not found: /{'/'.join(tokens)}")
+                node = node[token]
+            elif isinstance(node, list):
+                node = node[_json_pointer_index(node, token)]
+            else:
+                raise StoragePatchError(f"Path not found: /{'/'.join(tokens)}")
+        return node
+
+    def add(self, tokens, value):
+        if not tokens:
+            self.root = value
+            return
+        parent = self._writable_parent(tokens)
+        if isinstance(parent, dict):
+            parent[tokens[-1]] = value
+        else:
+            parent.insert(_json_pointer_index(parent, tokens[-1], allow_end=True), value)
+
+    def remove(self, tokens):
+        if not tokens:
+            raise StoragePatchError("Cannot remove the document root")
+        parent = self._writable_parent(tokens)
+        if isinstance(parent, dict):
+            if tokens[-1] not in parent:
+                raise StoragePatchError(f"Path not found: /{'/'.join(tokens)}")
+            return parent.pop(tokens[-1])
+        return parent.pop(_json_pointer_index(parent, tokens[-1]))
+
+    def replace(self, tokens, value):
+        if not tokens:
+            self.root = value
+            return
+        self.get(tokens)
+        parent = self._writable_parent(tokens)
+        if isinstance(parent, dict):
+            parent[tokens[-1]] = value
+        else:
+            parent[_json_pointer_index(parent, tokens[-1])] = value
+
+
+def _apply_json_patch(document, operations):
+    """RFC 6902 JSON Patch. Returns a new document and never mutates ``document``."""
+    if not isinstance(operations, list):
+        raise StoragePatchError("JSON Patch must be a list of operations")
+    patched = _JsonPatchDocument(document)
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise StoragePatchError("Invalid JSON Patch operation")
+        op = operation.get("op")
+        tokens = _parse_json_pointer(operation.get("path"))
+        if op in {"add", "replace", "test"} and "value" not in operation:
+            raise StoragePatchError(f"Missing value for {op} operation")
+        if op == "add":
+            patched.add(tokens, operation["value"])
+        elif op == "remove":
+            patched.remove(tokens)
+        elif op == "replace":
+            patched.replace(tokens, operation["value"])
+        elif op in {"move", "copy"}:
+            from_tokens = _parse_json_pointer(operation.get("from"))
+            if op == "move":
+                if tokens[: len(from_tokens)] == from_tokens and len(tokens) > len(from_tokens):
+                    raise StoragePatchError("Cannot move a value into one of its children")
+                value = patched.remove(from_tokens)
+            else:
+                value = copy.deepcopy(patched.get(from_tokens))
+            patched.add(tokens, value)
+        elif op == "test":
+            if patched.get(tokens) != operation["value"]:
+                raise StoragePatchError(f"Test failed for path: {operation.get('path')}")
+        else:
+            raise StoragePatchError(f"Unsupported JSON Patch operation: {op}")
+    return patched.root
+
+
+STORAGE_ENTITY_COLLECTIONS = ("devices", "testCases", "testCaseRuns", "networks")
+STORAGE_ENTITY_PATH_PATTERN = re.compile(r"^/api/storage/(devices|testCases|testCaseRuns|networks)(?:/([^/]+))?$")
+
+
+def _build_entity_etag(entity):
+    canonical = json.dumps(entity, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return f"\"e-{hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:24]}\""
+
+
+class _EntityIndex:
+    """Id -> list position maps over one cached storage document.
+
+    Built lazily per collection and dropped as soon as the cache holds a new
+    document, so lookups never go stale.
+    """
+
+    def __init__(self, payload):
+        self.payload = payload
+        self._positions = {}
+        self._etags = {}
+
+    def items(self, kind):
+        items = self.payload.get(kind) if isinstance(self.payload, dict) else None
+        return items if isinstance(items, list) else []
+
+    def position(self, kind, entity_id):
+        positions = self._positions.get(kind)
+        if positions is None:
+            positions = {}
+            for position, item in enumerate(self.items(kind)):
+                if isinstance(item, dict):
+                    item_id = str(item.get("id") or "").strip()
+                    if item_id:
+                        positions.setdefault(item_id, position)
+            self._positions[kind] = positions
+        return positions.get(entity_id)
+
+    def get(self, kind, entity_id):
+        position = self.position(kind, entity_id)
+        if position is None:
+            return None, None
+        cache_key = (kind, entity_id)
+        etag = self._etags.get(cache_key)
+        entity = self.items(kind)[position]
+        if etag is None:
+            etag = _build_entity_etag(entity)
+            self._etags[cache_key] = etag
+        return entity, etag
+
+
+def _storage_with_entity(current, index, kind, entity_id, entity):
+    """Copy-on-write replacement of one entity; ``entity=None`` removes it."""
+    items = list(index.items(kind))
+    position = index.position(kind, entity_id)
+    if entity is None:
+        if position is not None:
+            del items[position]
+    elif position is None:
+        items.append(entity)
+    else:
+        items[position] = entity
+    next_payload = dict(current) if isinstance(current, dict) else {}
+    next_payload[kind] = items
+    return next_payload
+
+
 def _write_backups_debug(payload):
     os.makedirs(os.path.dirname(BACKUPS_DEBUG_FILE), exist_ok=True)
     tmp_path = f"{BACKUPS_DEBUG_FILE}.tmp"
@@ -241,7 +1325,21 @@ def _build_file_reference(relative_path, original_name, content_type, size):
     }
 
 
-def _save_device_file(device_id, file_name, content_type, file_bytes):
+def _stream_to_file(source, handle, length, hasher):
+    """Copy up to ``length`` bytes in chunks; returns how many actually arrived."""
+    written = 0
+    while written < length:
+        chunk = source.read(min(UPLOAD_CHUNK_BYTES, length - written))
+        if not chunk:
+            break
+        handle.write(chunk)
+        hasher.update(chunk)
+        written += len(chunk)
+    return written
+
+
+def _publish_device_file(device_id, file_name, content_type, temp_path, digest, size):
+    """Link a fully received upload into device-files; only this step takes ``_lock``."""
     safe_device_id = _sanitize_device_id(device_id)
     original_name = str(file_name or "").strip()
     safe_file_name = _sanitize_file_name(original_name)
@@ -249,14 +1347,175 @@ def _save_device_file(device_id, file_name, content_type, file_bytes):
     unique_name = f"{stem}-{int(datetime.datetime.utcnow().timestamp())}-{secrets.token_hex(3)}{extension}"
 
     target_dir = os.path.join(DEVICE_FILES_DIR, safe_device_id)
-    os.makedirs(target_dir, exist_ok=True)
     target_path = os.path.join(target_dir, unique_name)
-
-    with open(target_path, "wb") as handle:
-        handle.write(file_bytes)
+    with _lock:
+        blob_path = _store_device_blob(temp_path, digest)
+        os.makedirs(target_dir, exist_ok=True)
+        _link_device_blob(blob_path, target_path)
+    _remember_file_sha256(target_path, digest)
 
     relative_path = os.path.relpath(target_path, DATA_DIR).replace(os.sep, "/")
-    return _build_file_reference(relative_path, original_name or safe_file_name, content_type, len(file_bytes))
+    _derivative_store.schedule(target_path)
+    return _build_file_reference(relative_path, original_name or safe_file_name, content_type, size)
+
+
+def _save_device_file(device_id, file_name, content_type, source, length):
+    """Stream ``length`` bytes from ``source`` to a temp file, hashing as they arrive."""
+    _sanitize_device_id(device_id)
+    os.makedirs(DEVICE_BLOBS_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".upload-", suffix=".tmp", dir=DEVICE_BLOBS_DIR)
+    try:
+        hasher = hashlib.sha256()
+        with os.fdopen(fd, "wb") as handle:
+            received = _stream_to_file(source, handle, length, hasher)
+        if received != length:
+            raise ValueError("Upload was interrupted before the whole file arrived")
+        return _publish_device_file(device_id, file_name, content_type, temp_path, hasher.hexdigest(), length)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class DeviceUploadOffsetError(ValueError):
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+
+class _ResumableUploads:
+    """Offset-based resumable uploads kept in DEVICE_UPLOADS_DIR until complete.
+
+    Each session is ``<id>.json`` (metadata) plus ``<id>.part`` (bytes so far).
+    The running SHA-256 is kept in memory and rebuilt from the part file after
+    a restart, so the finished upload is never read back twice.
+    """
+
+    def __init__(self, root):
+        self._root = root
+        self._mutex = threading.Lock()
+        self._busy = set()
+        self._hashers = {}
+
+    def _paths(self, upload_id):
+        return os.path.join(self._root, f"{upload_id}.json"), os.path.join(self._root, f"{upload_id}.part")
+
+    def _load(self, upload_id):
+        meta_path, part_path = self._paths(upload_id)
+        with open(meta_path, "rb") as handle:
+            meta = _json_decode(handle.read())
+        return meta, os.path.getsize(part_path)
+
+    @staticmethod
+    def _describe(meta, offset):
+        return {
+            "uploadId": meta["uploadId"],
+            "deviceId": meta["deviceId"],
+            "name": meta["name"],
+            "length": meta["length"],
+            "offset": offset,
+        }
+
+    def _hasher_at(self, upload_id, part_path, offset):
+        cached = self._hashers.get(upload_id)
+        if cached is not None and cached[0] == offset:
+            return cached[1]
+        hasher = hashlib.sha256()
+        with open(part_path, "rb") as handle:
+            while True:
+                chunk = handle.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+        return hasher
+
+    def create(self, device_id, file_name, content_type, length):
+        _sanitize_device_id(device_id)
+        if length <= 0:
+            raise ValueError("Missing or invalid upload length")
+        self.expire()
+        os.makedirs(self._root, exist_ok=True)
+        upload_id = secrets.token_hex(16)
+        meta = {
+            "uploadId": upload_id,
+            "deviceId": str(device_id),
+            "name": str(file_name or "").strip() or "file",
+            "contentType": str(content_type or ""),
+            "length": int(length),
+            "createdAt": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        }
+        meta_path, part_path = self._paths(upload_id)
+        open(part_path, "wb").close()
+        _write_file_atomic(meta_path, _json_encode(meta))
+        return self._describe(meta, 0)
+
+    def status(self, upload_id):
+        meta, offset = self._load(upload_id)
+        return self._describe(meta, offset)
+
+    def append(self, upload_id, offset, source, length):
+        """Append a chunk at ``offset``; returns (status, file reference once complete)."""
+        with self._mutex:
+            if upload_id in self._busy:
+                raise DeviceUploadOffsetError("Upload is already receiving data", None)
+            self._busy.add(upload_id)
+        try:
+            meta, current = self._load(upload_id)
+            if offset != current:
+                raise DeviceUploadOffsetError(f"Upload offset is {current}, not {offset}", current)
+            if current + length > meta["length"]:
+                raise ValueError("Chunk goes past the declared upload length")
+            _meta_path, part_path = self._paths(upload_id)
+            hasher = self._hasher_at(upload_id, part_path, current)
+            with open(part_path, "ab") as handle:
+                received = _stream_to_file(source, handle, length, hasher)
+                handle.flush()
+                os.fsync(handle.fileno())
+            current += received
+            self._hashers[upload_id] = (current, hasher)
+            if received != length:
+                raise DeviceUploadOffsetError(f"Chunk was interrupted; resume from offset {current}", current)
+            if current < meta["length"]:
+                return self._describe(meta, current), None
+            reference = _publish_device_file(
+                meta["deviceId"], meta["name"], meta["contentType"], part_path, hasher.hexdigest(), current
+            )
+            self.abort(upload_id)
+            return self._describe(meta, current), reference
+        finally:
+            with self._mutex:
+                self._busy.discard(upload_id)
+
+    def abort(self, upload_id):
+        self._hashers.pop(upload_id, None)
+        found = False
+        for path in self._paths(upload_id):
+            try:
+                os.remove(path)
+                found = True
+            except FileNotFoundError:
+                pass
+        if not found:
+            raise FileNotFoundError(upload_id)
+
+    def expire(self):
+        """Drop sessions that have not received data for UPLOAD_SESSION_TTL_SECONDS."""
+        try:
+            names = os.listdir(self._root)
+        except OSError:
+            return
+        cutoff = time.time() - UPLOAD_SESSION_TTL_SECONDS
+        for name in names:
+            upload_id, extension = os.path.splitext(name)
+            if extension != ".part" or upload_id in self._busy:
+                continue
+            try:
+                if os.path.getmtime(os.path.join(self._root, name)) < cutoff:
+                    self.abort(upload_id)
+            except OSError:
+                continue
+
+
+_resumable_uploads = _ResumableUploads(DEVICE_UPLOADS_DIR)
 
 
 def _resolve_device_file(relative_path):
@@ -277,161 +1536,1469 @@ def _resolve_device_file(relative_path):
     return full_path, normalized
 
 
-def _iter_device_files_for_export():
-    if not os.path.isdir(DEVICE_FILES_DIR):
-        return []
-    entries = []
-    for root, _dirs, files in os.walk(DEVICE_FILES_DIR):
-        for filename in files:
-            if filename.endswith(".tmp"):
-                continue
-            full_path = os.path.join(root, filename)
-            rel_path = os.path.relpath(full_path, DATA_DIR).replace(os.sep, "/")
-            entries.append((full_path, rel_path))
-    return sorted(entries, key=lambda item: item[1].lower())
+def _device_file_etag(stat):
+    return f"\"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}\""
 
 
-def _create_export_archive():
-    timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S")
-    archive_name = f"smart-home-planner-{timestamp}.tar"
-    archive_file = tempfile.NamedTemporaryFile(prefix="smart-home-export-", suffix=".tar", delete=False)
-    archive_path = archive_file.name
-    archive_file.close()
+def _parse_byte_ranges(header, size):
+    """Parse a ``Range`` header into inclusive (start, end) pairs.
 
-    data_file_real = os.path.realpath(DATA_FILE)
-    try:
-        with tarfile.open(archive_path, "w") as tar_handle:
-            if os.path.isfile(data_file_real):
-                tar_handle.add(data_file_real, arcname="data.json", recursive=False)
-            for full_path, rel_path in _iter_device_files_for_export():
-                full_real = os.path.realpath(full_path)
-                tar_handle.add(full_real, arcname=rel_path, recursive=False)
-    except Exception:
+    Returns ``None`` when the header should be ignored and the whole file sent;
+    raises ValueError when no range is satisfiable.
+    """
+    value = str(header or "").strip()
+    if not value.lower().startswith("bytes="):
+        return None
+    specs = [spec.strip() for spec in value[6:].split(",") if spec.strip()]
+    if not specs or len(specs) > MAX_DEVICE_FILE_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        start_text, separator, end_text = spec.partition("-")
+        if not separator:
+            return None
         try:
-            os.remove(archive_path)
-        except OSError:
-            pass
-        raise
-
-    return archive_path, archive_name
+            if not start_text:
+                suffix_length = int(end_text)
+                if suffix_length <= 0:
+                    continue
+                start, end = max(0, size - suffix_length), size - 1
+            else:
+                start = int(start_text)
+                end = int(end_text) if end_text else max(start, size - 1)
+        except ValueError:
+            return None
+        if start < 0 or end < start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    if not ranges:
+        raise ValueError("Range not satisfiable")
+    return ranges
 
 
-def _normalize_archive_member_path(value):
-    normalized = os.path.normpath(str(value or "").replace("\\", "/")).replace("\\", "/")
-    normalized = normalized.lstrip("/")
-    if not normalized or normalized in {".", ".."}:
-        raise ValueError("Invalid archive entry path")
-    if normalized.startswith("..") or "/../" in f"/{normalized}/":
-        raise ValueError("Invalid archive entry path")
-    return normalized
+def _if_range_allows(if_range_header, etag, mtime):
+    value = str(if_range_header or "").strip()
+    if not value:
+        return True
+    if value.startswith("\"") or value.startswith("W/"):
+        return value == etag
+    try:
+        return int(parsedate_to_datetime(value).timestamp()) == int(mtime)
+    except (TypeError, ValueError):
+        return False
 
 
-def _import_archive_bytes(archive_bytes):
-    if not archive_bytes:
-        raise ValueError("Missing archive payload")
+def _not_modified_since(if_modified_since_header, mtime):
+    value = str(if_modified_since_header or "").strip()
+    if not value:
+        return False
+    try:
+        return int(mtime) <= int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError):
+        return False
 
-    with tempfile.TemporaryDirectory(prefix="smart-home-import-") as temp_dir:
-        stage_root = os.path.join(temp_dir, "stage")
-        os.makedirs(stage_root, exist_ok=True)
-        stage_root_real = os.path.realpath(stage_root)
 
-        imported_storage = None
-        imported_files = 0
+_file_digest_cache = {}
+_file_digest_cache_lock = threading.Lock()
+_file_digest_cache_state = {"loaded": False, "dirty": False}
 
-        with tarfile.open(fileobj=io.BytesIO(archive_bytes), mode="r:*") as tar_handle:
-            for member in tar_handle.getmembers():
-                if not member.isfile():
-                    continue
-                safe_path = _normalize_archive_member_path(member.name)
-                if safe_path == "data.json":
-                    extracted = tar_handle.extractfile(member)
-                    if extracted is None:
-                        raise ValueError("Invalid data.json entry in archive")
-                    raw_payload = extracted.read()
-                    try:
-                        parsed_storage = json.loads(raw_payload.decode("utf-8"))
-                    except Exception as error:
-                        raise ValueError("Invalid data.json in archive") from error
-                    if not isinstance(parsed_storage, dict):
-                        raise ValueError("Invalid data.json in archive")
-                    imported_storage = parsed_storage
-                    continue
 
-                if not safe_path.startswith("device-files/"):
-                    # Ignore non-device-files payloads in import archives.
-                    continue
+def _load_file_digest_cache_locked():
+    _file_digest_cache_state["loaded"] = True
+    try:
+        with open(FILE_DIGESTS_FILE, "rb") as handle:
+            persisted = _json_decode(handle.read())
+    except Exception:
+        return
+    if not isinstance(persisted, dict):
+        return
+    for rel_path, entry in persisted.items():
+        if isinstance(entry, list) and len(entry) == 4:
+            full_path = os.path.join(DATA_DIR, rel_path)
+            _file_digest_cache[full_path] = (tuple(entry[:3]), entry[3])
 
-                extracted = tar_handle.extractfile(member)
-                if extracted is None:
-                    continue
-                target_path = os.path.realpath(os.path.join(stage_root, safe_path))
-                if target_path != stage_root_real and not target_path.startswith(f"{stage_root_real}{os.sep}"):
-                    raise ValueError("Invalid archive entry path")
-                os.makedirs(os.path.dirname(target_path), exist_ok=True)
-                with open(target_path, "wb") as handle:
-                    handle.write(extracted.read())
-                imported_files += 1
 
-        if imported_storage is None:
-            raise ValueError("Archive must contain data.json")
+def _save_file_digest_cache():
+    """Persist digests so a restart does not re-hash every attachment."""
+    with _file_digest_cache_lock:
+        if not _file_digest_cache_state["dirty"]:
+            return
+        persisted = {}
+        for full_path, (key, digest) in _file_digest_cache.items():
+            if os.path.exists(full_path):
+                rel_path = os.path.relpath(full_path, DATA_DIR).replace(os.sep, "/")
+                persisted[rel_path] = [*key, digest]
+        _file_digest_cache_state["dirty"] = False
+    try:
+        _write_file_atomic(FILE_DIGESTS_FILE, _json_encode(persisted))
+    except OSError:
+        pass
 
-        _write_storage(imported_storage)
 
-        staged_device_files = os.path.join(stage_root, "device-files")
-        if os.path.isdir(DEVICE_FILES_DIR):
-            shutil.rmtree(DEVICE_FILES_DIR, ignore_errors=True)
-        if os.path.isdir(staged_device_files):
-            shutil.copytree(staged_device_files, DEVICE_FILES_DIR)
-        else:
-            os.makedirs(DEVICE_FILES_DIR, exist_ok=True)
+def _file_sha256(full_path, stat=None):
+    """SHA-256 of a file, cached per (inode, mtime_ns, size)."""
+    stat = stat or os.stat(full_path)
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with _file_digest_cache_lock:
+        if not _file_digest_cache_state["loaded"]:
+            _load_file_digest_cache_locked()
+        cached = _file_digest_cache.get(full_path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(full_path, "rb") as handle:
+        while True:
+            chunk = handle.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    hex_digest = digest.hexdigest()
+    with _file_digest_cache_lock:
+        _file_digest_cache[full_path] = (key, hex_digest)
+        _file_digest_cache_state["dirty"] = True
+    return hex_digest
 
-        imported_devices = imported_storage.get("devices")
-        imported_device_count = len(imported_devices) if isinstance(imported_devices, list) else 0
-        return {"devices": imported_device_count, "files": imported_files}
 
+def _remember_file_sha256(full_path, digest):
+    stat = os.stat(full_path)
+    with _file_digest_cache_lock:
+        _file_digest_cache[full_path] = ((stat.st_ino, stat.st_mtime_ns, stat.st_size), digest)
+        _file_digest_cache_state["dirty"] = True
 
-def _remove_file_and_empty_parents(full_path):
-    os.remove(full_path)
-    root_dir = os.path.realpath(DEVICE_FILES_DIR)
-    parent = os.path.dirname(full_path)
-    while parent and parent.startswith(f"{root_dir}{os.sep}"):
-        try:
-            if os.listdir(parent):
-                break
-            os.rmdir(parent)
-        except OSError:
-            break
-        parent = os.path.dirname(parent)
 
+# Device files are hardlinks into a content-addressed blob store:
+# device-files/<deviceId>/<name> -> device-blobs/<sha[:2]>/<sha>. The blob's
+# link count is its reference count, so renames and deletes only touch the
+# reference and a blob is freed when its last reference goes away.
+_blob_maintenance_lock = threading.Lock()
 
-def _rename_device_file(relative_path, new_name):
-    full_path, _ = _resolve_device_file(relative_path)
-    requested_name = os.path.basename(str(new_name or "").replace("\\", "/")).strip()
-    if not requested_name:
-        raise ValueError("Missing new file name")
 
-    current_dir = os.path.dirname(full_path)
-    current_base = os.path.basename(full_path)
-    _, current_ext = os.path.splitext(current_base)
+def _blob_path(digest):
+    return os.path.join(DEVICE_BLOBS_DIR, digest[:2], digest)
 
-    safe_base = _sanitize_file_name(requested_name)
-    safe_stem, safe_ext = os.path.splitext(safe_base)
-    if not safe_ext and current_ext:
-        safe_base = f"{safe_base}{current_ext}"
-    if not safe_stem:
-        safe_base = f"file{current_ext or ''}"
 
-    target_path = os.path.join(current_dir, safe_base)
-    if os.path.realpath(target_path) != os.path.realpath(full_path) and os.path.exists(target_path):
-        suffix = secrets.token_hex(2)
-        stem, ext = os.path.splitext(safe_base)
-        target_path = os.path.join(current_dir, f"{stem}-{suffix}{ext}")
+def _store_device_blob(temp_path, digest):
+    """Move ``temp_path`` into the blob store unless that content is already there."""
+    blob_path = _blob_path(digest)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    if os.path.isfile(blob_path):
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, blob_path)
+    return blob_path
 
-    if os.path.realpath(target_path) != os.path.realpath(full_path):
-        os.replace(full_path, target_path)
-    file_size = os.path.getsize(target_path)
-    relative = os.path.relpath(target_path, DATA_DIR).replace(os.sep, "/")
-    return _build_file_reference(relative, requested_name, "", file_size)
+
+def _link_device_blob(blob_path, target_path):
+    try:
+        os.link(blob_path, target_path)
+    except OSError as error:
+        # Filesystems without hardlinks (or a blob at the link limit) get a
+        # private copy; it is simply not shared.
+        if error.errno not in {errno.EPERM, errno.EXDEV, errno.ENOTSUP, errno.EMLINK}:
+            raise
+        shutil.copyfile(blob_path, target_path)
+
+
+def _device_file_blob(full_path, stat=None):
+    """Return the blob backing ``full_path``, or ``None`` for an unshared file."""
+    stat = stat or os.stat(full_path)
+    if stat.st_nlink < 2:
+        return None
+    blob_path = _blob_path(_file_sha256(full_path, stat))
+    try:
+        blob_stat = os.stat(blob_path)
+    except FileNotFoundError:
+        return None
+    if (blob_stat.st_dev, blob_stat.st_ino) != (stat.st_dev, stat.st_ino):
+        return None
+    return blob_path
+
+
+def _release_device_blob(blob_path):
+    try:
+        if os.stat(blob_path).st_nlink <= 1:
+            os.remove(blob_path)
+            _derivative_store.discard(os.path.basename(blob_path))
+    except FileNotFoundError:
+        pass
+
+
+def _adopt_device_file(full_path):
+    """Move an unshared device file (legacy or imported) into the blob store."""
+    stat = os.stat(full_path)
+    if stat.st_nlink > 1:
+        return
+    digest = _file_sha256(full_path, stat)
+    blob_path = _blob_path(digest)
+    with _lock:
+        current = os.stat(full_path)
+        if (current.st_ino, current.st_mtime_ns, current.st_size) != (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+            return
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if not os.path.isfile(blob_path):
+            os.link(full_path, blob_path)
+            return
+        temp_path = f"{full_path}.{secrets.token_hex(4)}.tmp"
+        os.link(blob_path, temp_path)
+        os.replace(temp_path, full_path)
+        _remember_file_sha256(full_path, digest)
+
+
+def _maintain_device_blobs(remove_temp_files=False):
+    """Adopt unshared device files and free blobs that lost their last reference."""
+    with _blob_maintenance_lock:
+        adopted_errors = 0
+        for full_path, _rel_path in _iter_device_files_for_export():
+            try:
+                _adopt_device_file(full_path)
+            except FileNotFoundError:
+                continue
+            except OSError as error:
+                adopted_errors += 1
+                if adopted_errors == 1:
+                    print(f"[blobs] unable to adopt {full_path}: {error}", flush=True)
+        if not os.path.isdir(DEVICE_BLOBS_DIR):
+            return
+        # Uploads keep writing to their temp file, so only ones idle past the
+        # session TTL are leftovers from a crash rather than in-flight data.
+        temp_cutoff = time.time() - UPLOAD_SESSION_TTL_SECONDS
+        for root, _dirs, files in os.walk(DEVICE_BLOBS_DIR):
+            for filename in files:
+                full_path = os.path.join(root, filename)
+                try:
+                    if filename.endswith(".tmp"):
+                        if remove_temp_files and os.path.getmtime(full_path) < temp_cutoff:
+                            os.remove(full_path)
+                        continue
+                    with _lock:
+                        _release_device_blob(full_path)
+                except OSError as error:
+                    print(f"[blobs] unable to clean {full_path}: {error}", flush=True)
+        _save_file_digest_cache()
+
+
+def _start_blob_maintenance(remove_temp_files=False):
+    thread = threading.Thread(
+        target=_maintain_device_blobs,
+        kwargs={"remove_temp_files": remove_temp_files},
+        name="shp-blob-maintenance",
+        daemon=True,
+    )
+    thread.start()
+
+
+class _DerivativeStore:
+    """Scaled renditions of image attachments, keyed by content digest.
+
+    Renditions live in DEVICE_DERIVATIVES_DIR/<sha[:2]>/<sha>.<size>.<ext>, so
+    renaming an original keeps them valid and freeing its blob drops them. They
+    are rendered by a small worker pool, ahead of time after uploads and imports
+    or on first request, and evicted least recently used (by atime, which reads
+    bump) once the store grows past DERIVATIVE_CACHE_MAX_BYTES. A request never
+    waits for a render: until the rendition exists the original is served.
+    """
+
+    def __init__(self, root, max_bytes, workers):
+        self._root = root
+        self._max_bytes = max_bytes
+        self._workers = workers
+        self._mutex = threading.Lock()
+        self._executor = None
+        self._pending = {}
+        # (digest, size name) -> monotonic time of the failed render, oldest first.
+        self._failed = {}
+        self._total_bytes = None
+
+    @property
+    def enabled(self):
+        return Image is not None and self._max_bytes > 0
+
+    @staticmethod
+    def is_source(full_path):
+        return (mimetypes.guess_type(full_path)[0] or "") in DERIVATIVE_SOURCE_TYPES
+
+    def _path(self, digest, size_name, extension):
+        return os.path.join(self._root, digest[:2], f"{digest}.{size_name}.{extension}")
+
+    def find(self, digest, size_name):
+        for extension in ("jpg", "png"):
+            path = self._path(digest, size_name, extension)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # Record the access for LRU eviction without touching mtime (the ETag).
+            os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+            return path
+        return None
+
+    def _executor_locked(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="shp-derivatives")
+        return self._executor
+
+    def _submit(self, full_path, digest, size_name):
+        key = (digest, size_name)
+        with self._mutex:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._executor_locked().submit(self._render, full_path, digest, size_name)
+                self._pending[key] = future
+                future.add_done_callback(lambda _future: self._forget(key))
+        return future
+
+    def _forget(self, key):
+        with self._mutex:
+            self._pending.pop(key, None)
+
+    def _recently_failed(self, key):
+        with self._mutex:
+            failed_at = self._failed.get(key)
+            if failed_at is None:
+                return False
+            if time.monotonic() - failed_at < DERIVATIVE_FAILURE_RETRY_SECONDS:
+                return True
+            del self._failed[key]
+            return False
+
+    def _record_failure(self, key):
+        with self._mutex:
+            self._failed.pop(key, None)
+            self._failed[key] = time.monotonic()
+            while len(self._failed) > DERIVATIVE_MAX_FAILURES:
+                del self._failed[next(iter(self._failed))]
+
+    def get(self, full_path, size_name):
+        """Return the rendition path for ``full_path``, or ``None`` to serve the original.
+
+        A missing rendition is queued and left to the worker pool, so the
+        request thread is never held while Pillow runs.
+        """
+        if not self.enabled or size_name not in DERIVATIVE_SIZES or not self.is_source(full_path):
+            return None
+        digest = _file_sha256(full_path)
+        if self._recently_failed((digest, size_name)):
+            return None
+        cached = self.find(digest, size_name)
+        if cached is None:
+            self._submit(full_path, digest, size_name)
+        return cached
+
+    def schedule(self, full_path):
+        """Queue every rendition of ``full_path`` in the background."""
+        if not self.enabled or not self.is_source(full_path):
+            return
+
+        def queue():
+            try:
+                digest = _file_sha256(full_path)
+            except OSError:
+                return
+            for size_name in DERIVATIVE_SIZES:
+                if self.find(digest, size_name) is None and not self._recently_failed((digest, size_name)):
+                    self._submit(full_path, digest, size_name)
+
+        with self._mutex:
+            self._executor_locked().submit(queue)
+
+    def schedule_tree(self):
+        for full_path, _rel_path in _iter_device_files_for_export():
+            self.schedule(full_path)
+
+    def _render(self, full_path, digest, size_name):
+        existing = self.find(digest, size_name)
+        if existing is not None:
+            return existing
+        edge = DERIVATIVE_SIZES[size_name]
+        try:
+            with Image.open(full_path) as source:
+                source.draft("RGB", (edge, edge))
+                image = ImageOps.exif_transpose(source)
+                image.thumbnail((edge, edge))
+                has_alpha = image.mode in {"RGBA", "LA", "PA"} or (
+                    image.mode == "P" and "transparency" in image.info
+                )
+                buffer = io.BytesIO()
+                if has_alpha:
+                    extension = "png"
+                    image.save(buffer, format="PNG", optimize=True)
+                else:
+                    extension = "jpg"
+                    image.convert("RGB").save(buffer, format="JPEG", quality=82, optimize=True, progressive=True)
+        except Exception as error:
+            self._record_failure((digest, size_name))
+            print(f"[derivatives] unable to render {size_name} for {full_path}: {error}", flush=True)
+            return None
+        target_path = self._path(digest, size_name, extension)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        temp_path = f"{target_path}.{secrets.token_hex(4)}.tmp"
+        with open(temp_path, "wb") as handle:
+            handle.write(buffer.getvalue())
+        os.replace(temp_path, target_path)
+        self._account(buffer.tell())
+        return target_path
+
+    def _scan(self):
+        entries = []
+        for root, _dirs, files in os.walk(self._root):
+            for filename in files:
+                full_path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_atime_ns, stat.st_size, full_path))
+        return entries
+
+    def _account(self, added_bytes):
+        with self._mutex:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _atime, size, _path in self._scan())
+            else:
+                self._total_bytes += added_bytes
+            if self._total_bytes <= self._max_bytes:
+                return
+            # Evict down to 90% of the cap so every render does not trigger a scan.
+            entries = sorted(self._scan())
+            total = sum(size for _atime, size, _path in entries)
+            target = int(self._max_bytes * 0.9)
+            for _atime, size, full_path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(full_path)
+                    total -= size
+                except OSError:
+                    continue
+            self._total_bytes = total
+
+    def discard(self, digest):
+        directory = os.path.join(self._root, digest[:2])
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(f"{digest}."):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    continue
+        with self._mutex:
+            self._total_bytes = None
+
+
+_derivative_store = _DerivativeStore(DEVICE_DERIVATIVES_DIR, DERIVATIVE_CACHE_MAX_BYTES, DERIVATIVE_WORKERS)
+
+
+def _iter_device_files_for_export():
+    if not os.path.isdir(DEVICE_FILES_DIR):
+        return []
+    entries = []
+    for root, _dirs, files in os.walk(DEVICE_FILES_DIR):
+        for filename in files:
+            if filename.endswith(".tmp"):
+                continue
+            full_path = os.path.join(root, filename)
+            rel_path = os.path.relpath(full_path, DATA_DIR).replace(os.sep, "/")
+            entries.append((full_path, rel_path))
+    return sorted(entries, key=lambda item: item[1].lower())
+
+
+class _ChunkedWriter:
+    """File-like wrapper that frames writes as HTTP/1.1 chunked transfer encoding."""
+
+    def __init__(self, wfile, buffer_size=1024 * 64):
+        self._wfile = wfile
+        self._buffer = bytearray()
+        self._buffer_size = buffer_size
+        self.bytes_written = 0
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        self._wfile.write(f"{len(self._buffer):X}\r\n".encode("ascii"))
+        self._wfile.write(self._buffer)
+        self._wfile.write(b"\r\n")
+        self.bytes_written += len(self._buffer)
+        self._buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self._wfile.write(b"0\r\n\r\n")
+        self._wfile.flush()
+
+
+class _SizedReader:
+    """Reads exactly ``size`` bytes; a file that shrank after it was listed fails the export.
+
+    The tar header already promised ``size`` bytes, so padding would ship a
+    silently corrupted member.
+    """
+
+    def __init__(self, handle, size, name):
+        self._handle = handle
+        self._remaining = size
+        self._name = name
+
+    def read(self, size=-1):
+        if self._remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        chunk = self._handle.read(size)
+        if not chunk:
+            raise OSError(f"{self._name} shrank while it was being exported")
+        self._remaining -= len(chunk)
+        return chunk
+
+
+EXPORT_FORMATS = {
+    "tar": {"extension": "tar", "contentType": "application/x-tar", "defaultLevel": None},
+    "tar.gz": {"extension": "tar.gz", "contentType": "application/gzip", "defaultLevel": 6},
+    "tar.xz": {"extension": "tar.xz", "contentType": "application/x-xz", "defaultLevel": 6},
+}
+# Formats that are already compressed: recompressing them burns CPU for no gain.
+PRECOMPRESSED_EXTENSIONS = {
+    ".webp", ".jpg", ".jpeg", ".png", ".gif", ".avif", ".heic", ".pdf",
+    ".zip", ".gz", ".tgz", ".xz", ".bz2", ".7z", ".rar", ".zst",
+    ".mp3", ".mp4", ".m4a", ".mov", ".webm", ".docx", ".xlsx", ".pptx", ".odt",
+}
+
+
+def _xz_varint(value):
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+class _XzStoredStream:
+    """An .xz stream whose LZMA2 data is all uncompressed chunks.
+
+    liblzma has no copy filter, and even preset 0 runs the match finder over
+    every byte. Precompressed members are instead framed by hand: one block of
+    LZMA2 "uncompressed" chunks with a CRC32 check, which any xz decoder reads
+    as an ordinary stream. Mirrors the compress()/flush() API of LZMACompressor.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    STREAM_FLAGS = b"\x00\x01"  # check type CRC32
+
+    def __init__(self):
+        self._header_sent = False
+        self._crc = 0
+        self._uncompressed_size = 0
+        self._compressed_size = 0
+        self._pending = bytearray()
+
+    def _block_header(self):
+        # Block flags 0 (one filter, no sizes); LZMA2 (0x21) with a 4 KiB dictionary.
+        body = b"\x00\x21\x01\x00"
+        body += b"\x00" * (-(len(body) + 1) % 4)
+        header = bytes([(len(body) + 1 + 4) // 4 - 1]) + body
+        return header + struct.pack("<I", zlib.crc32(header))
+
+    def _chunks(self, final):
+        output = bytearray()
+        while len(self._pending) >= self.CHUNK_SIZE or (final and self._pending):
+            chunk = bytes(self._pending[: self.CHUNK_SIZE])
+            del self._pending[: self.CHUNK_SIZE]
+            control = 0x01 if self._compressed_size == 0 else 0x02
+            framed = bytes([control]) + struct.pack(">H", len(chunk) - 1) + chunk
+            self._compressed_size += len(framed)
+            output += framed
+        return bytes(output)
+
+    def compress(self, data):
+        output = b""
+        if not self._header_sent and data:
+            self._header_sent = True
+            output = b"\xfd7zXZ\x00" + self.STREAM_FLAGS + struct.pack("<I", zlib.crc32(self.STREAM_FLAGS))
+            output += self._block_header()
+        self._crc = zlib.crc32(data, self._crc)
+        self._uncompressed_size += len(data)
+        self._pending += data
+        return output + self._chunks(final=False)
+
+    def flush(self):
+        if not self._header_sent:
+            return b""
+        output = self._chunks(final=True) + b"\x00"
+        self._compressed_size += 1
+        output += b"\x00" * (-self._compressed_size % 4) + struct.pack("<I", self._crc)
+        unpadded = len(self._block_header()) + self._compressed_size + 4
+        index = b"\x00" + _xz_varint(1) + _xz_varint(unpadded) + _xz_varint(self._uncompressed_size)
+        index += b"\x00" * (-len(index) % 4)
+        index += struct.pack("<I", zlib.crc32(index))
+        backward = struct.pack("<I", len(index) // 4 - 1) + self.STREAM_FLAGS
+        return output + index + struct.pack("<I", zlib.crc32(backward)) + backward + b"YZ"
+
+
+class _MultiMemberCompressor:
+    """Compressing writer that can switch to stored/fastest mode between tar members.
+
+    Each switch closes the current gzip member (or xz stream) and opens a new one;
+    concatenated members decompress to one continuous tar stream.
+    """
+
+    def __init__(self, out, archive_format, level):
+        self._out = out
+        self._format = archive_format
+        self._level = level
+        self._compressible = None
+        self._compressor = None
+
+    def _new_compressor(self, compressible):
+        if self._format == "tar.gz":
+            return zlib.compressobj(self._level if compressible else 0, zlib.DEFLATED, 31)
+        if not compressible:
+            return _XzStoredStream()
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=self._level)
+
+    def set_compressible(self, compressible):
+        if compressible == self._compressible:
+            return
+        self._finish_member()
+        self._compressible = compressible
+
+    def _finish_member(self):
+        if self._compressor is not None:
+            if self._format == "tar.gz":
+                self._out.write(self._compressor.flush(zlib.Z_FINISH))
+            else:
+                self._out.write(self._compressor.flush())
+            self._compressor = None
+
+    def write(self, data):
+        if self._compressor is None:
+            self._compressor = self._new_compressor(self._compressible is not False)
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self._out.write(compressed)
+        return len(data)
+
+    def close(self):
+        self._finish_member()
+
+
+def _parse_export_options(query):
+    archive_format = ((query.get("format") or ["tar"])[0]).strip().lower() or "tar"
+    if archive_format == "tgz":
+        archive_format = "tar.gz"
+    if archive_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {archive_format}")
+    level = EXPORT_FORMATS[archive_format]["defaultLevel"]
+    raw_level = ((query.get("level") or [""])[0]).strip()
+    if raw_level and level is not None:
+        try:
+            level = int(raw_level)
+        except ValueError as error:
+            raise ValueError("Invalid compression level") from error
+        # Both codecs take 0-9; stored members never borrow a user-selectable level.
+        if not 0 <= level <= 9:
+            raise ValueError("Compression level must be between 0 and 9")
+    return archive_format, level
+
+
+def _snapshot_export():
+    """Capture data.json bytes and the device file list under a brief lock."""
+    with _lock:
+        payload, _, storage_etag = _read_storage_cached()
+        listed = _iter_device_files_for_export()
+    files = []
+    for full_path, rel_path in listed:
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            continue
+        files.append((full_path, rel_path, stat))
+    return _encode_storage_snapshot(payload), files, storage_etag
+
+
+def _build_export_manifest(files, storage_etag):
+    entries = []
+    for full_path, rel_path, stat in files:
+        try:
+            digest = _file_sha256(full_path, stat)
+        except OSError:
+            continue
+        entries.append({"path": rel_path, "size": stat.st_size, "mtime": int(stat.st_mtime), "sha256": digest})
+    _save_file_digest_cache()
+    fingerprint = hashlib.sha256(
+        _json_encode([storage_etag, [[entry["path"], entry["sha256"]] for entry in entries]])
+    ).hexdigest()
+    return {
+        "id": fingerprint[:32],
+        "storageVersion": storage_etag,
+        "generatedAt": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "files": entries,
+    }
+
+
+def _store_export_manifest(manifest):
+    """Keep the manifests of the latest exports so ``/api/export?since=<id>`` can refer to them.
+
+    Only exports store manifests; the oldest by mtime are evicted, and using
+    one as a ``since`` base refreshes its mtime.
+    """
+    os.makedirs(EXPORT_MANIFESTS_DIR, exist_ok=True)
+    _write_file_atomic(os.path.join(EXPORT_MANIFESTS_DIR, f"{manifest['id']}.json"), _json_encode(manifest))
+    stored = []
+    for name in os.listdir(EXPORT_MANIFESTS_DIR):
+        if name.endswith(".json"):
+            full_path = os.path.join(EXPORT_MANIFESTS_DIR, name)
+            try:
+                stored.append((os.path.getmtime(full_path), full_path))
+            except OSError:
+                continue
+    for _mtime, full_path in sorted(stored, reverse=True)[MAX_STORED_EXPORT_MANIFESTS:]:
+        try:
+            os.remove(full_path)
+        except OSError:
+            pass
+
+
+def _load_export_manifest(manifest_id):
+    normalized = str(manifest_id or "").strip()
+    if not re.fullmatch(r"[0-9a-f]{32}", normalized):
+        raise ValueError("Invalid manifest id")
+    manifest_path = os.path.join(EXPORT_MANIFESTS_DIR, f"{normalized}.json")
+    try:
+        with open(manifest_path, "rb") as handle:
+            manifest = _json_decode(handle.read())
+    except FileNotFoundError as error:
+        raise ValueError("Unknown manifest id; run a full export to get a new one") from error
+    try:
+        os.utime(manifest_path)
+    except OSError:
+        pass
+    return manifest
+
+
+def _plan_incremental_export(files, base_manifest, storage_etag):
+    """Select the files that changed since ``base_manifest`` and list the deleted ones."""
+    base_files = base_manifest.get("files") if isinstance(base_manifest, dict) else None
+    if not isinstance(base_files, list):
+        raise ValueError("Invalid base manifest")
+    base_digests = {}
+    for entry in base_files:
+        if isinstance(entry, dict) and entry.get("path"):
+            base_digests[str(entry["path"])] = str(entry.get("sha256") or "")
+    manifest = _build_export_manifest(files, storage_etag)
+    current_digests = {entry["path"]: entry["sha256"] for entry in manifest["files"]}
+    changed = [item for item in files if base_digests.get(item[1]) != current_digests.get(item[1], "")]
+    deleted = sorted(path for path in base_digests if path not in current_digests)
+    descriptor = {
+        "type": "incremental",
+        "baseManifest": base_manifest.get("id"),
+        "manifest": manifest["id"],
+        "deleted": deleted,
+        "files": manifest["files"],
+    }
+    return changed, descriptor, manifest
+
+
+def _find_duplicate_export_files(files):
+    """Map rel_path -> rel_path of the first file with identical content.
+
+    Only files sharing a size with another file are hashed.
+    """
+    by_size = {}
+    for full_path, rel_path, stat in files:
+        if stat.st_size > 0:
+            by_size.setdefault(stat.st_size, []).append((full_path, rel_path, stat))
+    duplicates = {}
+    for candidates in by_size.values():
+        if len(candidates) < 2:
+            continue
+        first_by_digest = {}
+        for full_path, rel_path, stat in candidates:
+            try:
+                digest = _file_sha256(full_path, stat)
+            except OSError:
+                continue
+            first = first_by_digest.setdefault(digest, rel_path)
+            if first != rel_path:
+                duplicates[rel_path] = first
+    return duplicates
+
+
+def _estimate_export_tar_size(storage_raw, files, duplicates, extra_members=None):
+    def padded(size):
+        return 512 + ((size + 511) // 512) * 512
+
+    total = padded(len(storage_raw))
+    for _member_name, member_raw in extra_members or []:
+        total += padded(len(member_raw))
+    for _full_path, rel_path, stat in files:
+        total += 512 if rel_path in duplicates else padded(stat.st_size)
+    total += 1024
+    return ((total + tarfile.RECORDSIZE - 1) // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+def _build_export_archive_name(extension="tar"):
+    timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S")
+    return f"smart-home-planner-{timestamp}.{extension}"
+
+
+def _write_export_archive(out, storage_raw, files, duplicates=None, compressor=None, extra_members=None):
+    """Stream a tar of ``storage_raw`` plus ``files`` into the writable ``out``.
+
+    Files are opened one at a time while streaming; a file removed after the
+    snapshot is skipped, so memory use does not depend on the archive size.
+    Paths in ``duplicates`` become hardlinks to the first copy of their content.
+    """
+    duplicates = duplicates or {}
+    written = set()
+    exported_at = int(time.time())
+    with tarfile.open(fileobj=out, mode="w|") as tar_handle:
+        info = tarfile.TarInfo("data.json")
+        info.size = len(storage_raw)
+        info.mtime = exported_at
+        info.mode = 0o644
+        tar_handle.addfile(info, io.BytesIO(storage_raw))
+        for member_name, member_raw in extra_members or []:
+            info = tarfile.TarInfo(member_name)
+            info.size = len(member_raw)
+            info.mtime = exported_at
+            info.mode = 0o644
+            tar_handle.addfile(info, io.BytesIO(member_raw))
+        for full_path, rel_path, listed_stat in files:
+            link_target = duplicates.get(rel_path)
+            if link_target in written:
+                info = tarfile.TarInfo(rel_path)
+                info.type = tarfile.LNKTYPE
+                info.linkname = link_target
+                info.mtime = int(listed_stat.st_mtime)
+                info.mode = 0o644
+                tar_handle.addfile(info)
+                continue
+            try:
+                handle = open(full_path, "rb")
+            except OSError:
+                continue
+            with handle:
+                stat = os.fstat(handle.fileno())
+                info = tarfile.TarInfo(rel_path)
+                info.size = stat.st_size
+                info.mtime = int(stat.st_mtime)
+                info.mode = 0o644
+                if compressor is not None:
+                    extension = os.path.splitext(rel_path)[1].lower()
+                    compressor.set_compressible(extension not in PRECOMPRESSED_EXTENSIONS)
+                tar_handle.addfile(info, _SizedReader(handle, stat.st_size, rel_path))
+            written.add(rel_path)
+        if compressor is not None:
+            compressor.set_compressible(True)
+
+
+def _normalize_archive_member_path(value):
+    normalized = os.path.normpath(str(value or "").replace("\\", "/")).replace("\\", "/")
+    normalized = normalized.lstrip("/")
+    if not normalized or normalized in {".", ".."}:
+        raise ValueError("Invalid archive entry path")
+    if normalized.startswith("..") or "/../" in f"/{normalized}/":
+        raise ValueError("Invalid archive entry path")
+    return normalized
+
+
+class _ImportProgress:
+    """Progress of the running (or last) archive import, for GET /api/import/status."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {"state": "idle"}
+
+    def start(self, total_bytes):
+        with self._lock:
+            self._state = {
+                "state": "receiving",
+                "totalBytes": total_bytes,
+                "bytesRead": 0,
+                "files": 0,
+                "extractedBytes": 0,
+                "currentEntry": None,
+                "startedAt": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z",
+                "error": None,
+            }
+
+    def update(self, **values):
+        with self._lock:
+            self._state.update(values)
+
+    def add(self, key, amount):
+        with self._lock:
+            self._state[key] = self._state.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._state)
+
+
+class _CountingReader:
+    """Reads at most ``limit`` bytes from ``stream`` and reports them to ``progress``.
+
+    The first few bytes can be peeked (to sniff the compression format) and are
+    replayed on the next read.
+    """
+
+    def __init__(self, stream, limit, progress):
+        self._stream = stream
+        self._remaining = limit
+        self._progress = progress
+        self._prefix = b""
+
+    def peek(self, size):
+        if len(self._prefix) < size:
+            self._prefix += self._read_stream(size - len(self._prefix))
+        return self._prefix[:size]
+
+    def _read_stream(self, size):
+        if self._remaining <= 0:
+            return b""
+        chunk = self._stream.read(min(size, self._remaining))
+        self._remaining -= len(chunk)
+        self._progress.add("bytesRead", len(chunk))
+        return chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._remaining + len(self._prefix)
+        if self._prefix:
+            chunk, self._prefix = self._prefix[:size], self._prefix[size:]
+            return chunk
+        return self._read_stream(size)
+
+
+def _open_import_stream(reader):
+    """Wrap ``reader`` in a decompressor matching its magic bytes.
+
+    The gzip and xz readers accept concatenated members, which compressed
+    exports use to store already-compressed attachments without recompression.
+    """
+    magic = reader.peek(6)
+    if magic.startswith(b"\x1f\x8b"):
+        return gzip.GzipFile(fileobj=reader, mode="rb")
+    if magic.startswith(b"\xfd7zXZ\x00"):
+        return lzma.LZMAFile(reader, mode="rb")
+    if magic.startswith(b"BZh"):
+        return bz2.BZ2File(reader, mode="rb")
+    return reader
+
+
+def _unlink_staged(target_path):
+    # Incremental imports seed the stage with hardlinks to the live tree, so
+    # replace staged entries instead of truncating the shared inode.
+    try:
+        os.remove(target_path)
+    except FileNotFoundError:
+        pass
+
+
+def _copy_import_member(source, target_path, size, progress):
+    written = 0
+    _unlink_staged(target_path)
+    with open(target_path, "wb") as handle:
+        while True:
+            chunk = source.read(IMPORT_CHUNK_BYTES)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > size:
+                raise ValueError("Archive entry is larger than declared")
+            handle.write(chunk)
+            progress.add("extractedBytes", len(chunk))
+    return written
+
+
+def _stage_import_archive(stream, stage_root, progress):
+    """Extract ``stream`` into ``stage_root`` one member at a time.
+
+    Returns the parsed data.json, the number of device files staged and the
+    incremental export descriptor (``None`` for full archives).
+    """
+    stage_root_real = os.path.realpath(stage_root)
+    imported_storage = None
+    imported_files = 0
+    extracted_total = 0
+    incremental = None
+
+    def staged_path(safe_path):
+        target_path = os.path.realpath(os.path.join(stage_root, safe_path))
+        if not target_path.startswith(f"{stage_root_real}{os.sep}"):
+            raise ValueError("Invalid archive entry path")
+        return target_path
+
+    with tarfile.open(fileobj=stream, mode="r|") as tar_handle:
+        for member in tar_handle:
+            if member.islnk():
+                # Deduplicated exports store repeated device files as hardlinks.
+                safe_path = _normalize_archive_member_path(member.name)
+                link_source = _normalize_archive_member_path(member.linkname)
+                if not safe_path.startswith("device-files/") or not link_source.startswith("device-files/"):
+                    continue
+                source_path = staged_path(link_source)
+                target_path = staged_path(safe_path)
+                if not os.path.isfile(source_path):
+                    raise ValueError("Invalid hardlink entry in archive")
+                extracted_total += os.path.getsize(source_path)
+                if extracted_total > MAX_IMPORT_EXTRACTED_BYTES:
+                    raise ValueError(f"Archive expands beyond {MAX_IMPORT_EXTRACTED_BYTES} bytes")
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                _unlink_staged(target_path)
+                shutil.copyfile(source_path, target_path)
+                imported_files += 1
+                progress.update(files=imported_files, currentEntry=safe_path)
+                continue
+            if not member.isfile():
+                continue
+            safe_path = _normalize_archive_member_path(member.name)
+            if safe_path == EXPORT_MANIFEST_MEMBER:
+                incremental = _read_incremental_descriptor(_read_small_member(tar_handle, member))
+                if incremental is not None:
+                    _seed_incremental_stage(os.path.join(stage_root, "device-files"))
+                continue
+            if safe_path != "data.json" and not safe_path.startswith("device-files/"):
+                # Ignore non-device-files payloads in import archives.
+                continue
+            extracted_total += member.size
+            if extracted_total > MAX_IMPORT_EXTRACTED_BYTES:
+                raise ValueError(f"Archive expands beyond {MAX_IMPORT_EXTRACTED_BYTES} bytes")
+            extracted = tar_handle.extractfile(member)
+            if extracted is None:
+                continue
+            progress.update(currentEntry=safe_path)
+
+            if safe_path == "data.json":
+                if member.size > MAX_IMPORT_ARCHIVE_BYTES:
+                    raise ValueError("data.json in archive is too large")
+                target_path = os.path.join(stage_root, "data.json")
+                _copy_import_member(extracted, target_path, member.size, progress)
+                try:
+                    with open(target_path, "rb") as handle:
+                        parsed_storage = _json_decode(handle.read())
+                except Exception as error:
+                    raise ValueError("Invalid data.json in archive") from error
+                if not isinstance(parsed_storage, dict):
+                    raise ValueError("Invalid data.json in archive")
+                _reject_non_finite_numbers(parsed_storage, "data.json in archive")
+                imported_storage = parsed_storage
+                continue
+
+            target_path = staged_path(safe_path)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            _copy_import_member(extracted, target_path, member.size, progress)
+            imported_files += 1
+            progress.update(files=imported_files)
+
+    if imported_storage is None:
+        raise ValueError("Archive must contain data.json")
+    if incremental is not None:
+        _finish_incremental_stage(stage_root, staged_path, incremental)
+    return imported_storage, imported_files, incremental
+
+
+def _read_small_member(tar_handle, member):
+    if member.size > MAX_IMPORT_ARCHIVE_BYTES:
+        raise ValueError(f"{EXPORT_MANIFEST_MEMBER} in archive is too large")
+    extracted = tar_handle.extractfile(member)
+    return extracted.read() if extracted is not None else b""
+
+
+def _read_incremental_descriptor(raw):
+    try:
+        descriptor = _json_decode(raw)
+    except Exception as error:
+        raise ValueError(f"Invalid {EXPORT_MANIFEST_MEMBER} in archive") from error
+    if not isinstance(descriptor, dict) or descriptor.get("type") != "incremental":
+        return None
+    if not isinstance(descriptor.get("files"), list) or not isinstance(descriptor.get("deleted"), list):
+        raise ValueError(f"Invalid {EXPORT_MANIFEST_MEMBER} in archive")
+    return descriptor
+
+
+def _seed_incremental_stage(staged_device_files):
+    """Start an incremental import from hardlinks to the current device files."""
+    if os.path.isdir(staged_device_files):
+        raise ValueError(f"{EXPORT_MANIFEST_MEMBER} must precede device files in the archive")
+    if os.path.isdir(DEVICE_FILES_DIR):
+        shutil.copytree(DEVICE_FILES_DIR, staged_device_files, copy_function=os.link)
+    else:
+        os.makedirs(staged_device_files)
+
+
+def _finish_incremental_stage(stage_root, staged_path, descriptor):
+    """Drop deleted files and check the staged tree matches the target manifest."""
+    for deleted_path in descriptor["deleted"]:
+        safe_path = _normalize_archive_member_path(str(deleted_path))
+        if not safe_path.startswith("device-files/"):
+            continue
+        target_path = staged_path(safe_path)
+        if os.path.isfile(target_path):
+            os.remove(target_path)
+            staged_root = os.path.realpath(os.path.join(stage_root, "device-files"))
+            parent = os.path.dirname(target_path)
+            while parent.startswith(f"{staged_root}{os.sep}") and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+    missing = []
+    for entry in descriptor["files"]:
+        rel_path = _normalize_archive_member_path(str(entry.get("path") or "")) if isinstance(entry, dict) else ""
+        if not rel_path.startswith("device-files/"):
+            continue
+        target_path = staged_path(rel_path)
+        if not os.path.isfile(target_path) or os.path.getsize(target_path) != entry.get("size"):
+            missing.append(rel_path)
+    if missing:
+        raise ValueError(
+            f"Incremental archive does not apply to the current device files "
+            f"({len(missing)} missing or different, e.g. {missing[0]}); import a full export instead"
+        )
+
+
+def _exchange_paths(first, second):
+    """Atomically swap two paths with renameat2(RENAME_EXCHANGE); False if unsupported."""
+    if _renameat2 is None:
+        return False
+    result = _renameat2(
+        AT_FDCWD, os.fsencode(first), AT_FDCWD, os.fsencode(second), RENAME_EXCHANGE
+    )
+    if result != 0:
+        errno_value = ctypes.get_errno()
+        if errno_value in {errno.ENOSYS, errno.EINVAL, errno.ENOTSUP}:
+            return False
+        raise OSError(errno_value, os.strerror(errno_value), first)
+    return True
+
+
+def _load_renameat2():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        function = libc.renameat2
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    function.restype = ctypes.c_int
+    return function
+
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+_renameat2 = _load_renameat2()
+
+
+def _remove_tree_in_background(path, then=None):
+    def remove():
+        shutil.rmtree(path, ignore_errors=True)
+        if then is not None:
+            then()
+
+    thread = threading.Thread(
+        target=remove,
+        name="shp-remove-tree",
+        daemon=True,
+    )
+    thread.start()
+
+
+def _cleanup_import_staging():
+    """Remove staging trees left behind by an interrupted import."""
+    try:
+        names = os.listdir(DATA_DIR)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith(IMPORT_STAGING_PREFIX):
+            _remove_tree_in_background(os.path.join(DATA_DIR, name))
+
+
+def _after_import_commit():
+    _maintain_device_blobs()
+    _derivative_store.schedule_tree()
+
+
+def _swap_in_device_files(staged_device_files, retired_path):
+    """Replace DEVICE_FILES_DIR with ``staged_device_files``; the old tree ends up at ``retired_path``."""
+    if not os.path.isdir(DEVICE_FILES_DIR):
+        os.replace(staged_device_files, DEVICE_FILES_DIR)
+        return
+    if _exchange_paths(staged_device_files, DEVICE_FILES_DIR):
+        os.replace(staged_device_files, retired_path)
+        return
+    os.replace(DEVICE_FILES_DIR, retired_path)
+    os.replace(staged_device_files, DEVICE_FILES_DIR)
+
+
+def _swap_back_device_files(retired_path, rejected_path):
+    """Undo _swap_in_device_files: restore ``retired_path`` and move the imported tree to ``rejected_path``."""
+    if not os.path.isdir(retired_path):
+        # There was no previous tree; just take the imported one out again.
+        os.replace(DEVICE_FILES_DIR, rejected_path)
+        return
+    if _exchange_paths(retired_path, DEVICE_FILES_DIR):
+        os.replace(retired_path, rejected_path)
+        return
+    os.replace(DEVICE_FILES_DIR, rejected_path)
+    os.replace(retired_path, DEVICE_FILES_DIR)
+
+
+def _import_archive_stream(stream, progress):
+    """Stage an archive inside DATA_DIR without holding ``_lock``, then commit it.
+
+    The commit swaps the staged device-files tree in by rename and writes
+    data.json under ``_lock``, so storage readers never see a half-imported
+    state. The previous tree is deleted in the background.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=IMPORT_STAGING_PREFIX, dir=DATA_DIR)
+    try:
+        stage_root = os.path.join(staging_dir, "stage")
+        os.makedirs(stage_root, exist_ok=True)
+        imported_storage, imported_files, incremental = _stage_import_archive(stream, stage_root, progress)
+        progress.update(state="committing", currentEntry=None)
+
+        staged_device_files = os.path.join(stage_root, "device-files")
+        os.makedirs(staged_device_files, exist_ok=True)
+        retired_device_files = os.path.join(staging_dir, "retired-device-files")
+        with _lock:
+            _swap_in_device_files(staged_device_files, retired_device_files)
+            try:
+                _write_storage(imported_storage, snapshot=True)
+            except BaseException:
+                # Keep device-files/ in step with the data.json that is still live.
+                _swap_back_device_files(retired_device_files, os.path.join(staging_dir, "rejected-device-files"))
+                raise
+    finally:
+        # Imported files arrive unshared; fold them into the blob store once
+        # the retired tree (and its references) are gone.
+        _remove_tree_in_background(staging_dir, then=_after_import_commit)
+
+    imported_devices = imported_storage.get("devices")
+    imported_device_count = len(imported_devices) if isinstance(imported_devices, list) else 0
+    result = {"devices": imported_device_count, "files": imported_files}
+    if incremental is not None:
+        result["incremental"] = True
+        result["deleted"] = len(incremental["deleted"])
+    return result
+
+
+_import_progress = _ImportProgress()
+_import_running = threading.Lock()
+
+
+def _remove_file_and_empty_parents(full_path):
+    blob_path = _device_file_blob(full_path)
+    os.remove(full_path)
+    if blob_path is not None:
+        _release_device_blob(blob_path)
+    root_dir = os.path.realpath(DEVICE_FILES_DIR)
+    parent = os.path.dirname(full_path)
+    while parent and parent.startswith(f"{root_dir}{os.sep}"):
+        try:
+            if os.listdir(parent):
+                break
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+def _rename_device_file(relative_path, new_name):
+    full_path, _ = _resolve_device_file(relative_path)
+    requested_name = os.path.basename(str(new_name or "").replace("\\", "/")).strip()
+    if not requested_name:
+        raise ValueError("Missing new file name")
+
+    current_dir = os.path.dirname(full_path)
+    current_base = os.path.basename(full_path)
+    _, current_ext = os.path.splitext(current_base)
+
+    safe_base = _sanitize_file_name(requested_name)
+    safe_stem, safe_ext = os.path.splitext(safe_base)
+    if not safe_ext and current_ext:
+        safe_base = f"{safe_base}{current_ext}"
+    if not safe_stem:
+        safe_base = f"file{current_ext or ''}"
+
+    target_path = os.path.join(current_dir, safe_base)
+    if os.path.realpath(target_path) != os.path.realpath(full_path) and os.path.exists(target_path):
+        suffix = secrets.token_hex(2)
+        stem, ext = os.path.splitext(safe_base)
+        target_path = os.path.join(current_dir, f"{stem}-{suffix}{ext}")
+
+    if os.path.realpath(target_path) != os.path.realpath(full_path):
+        os.replace(full_path, target_path)
+    file_size = os.path.getsize(target_path)
+    relative = os.path.relpath(target_path, DATA_DIR).replace(os.sep, "/")
+    return _build_file_reference(relative, requested_name, "", file_size)
+
+
+class _HaUpdateWorker:
+    """Supervised ``ha-device-update.js --serve`` process speaking JSON-RPC over stdio.
+
+    One node process keeps a single authenticated Home Assistant connection.
+    Requests are tagged with ids, so concurrent callers share the pipe and
+    responses may arrive in any order. A dead worker fails its in-flight calls
+    and is restarted on the next call; the health thread pings it and recycles
+    a worker that stops answering.
+    """
+
+    def __init__(self, script, restart_delay=1.0, health_interval=60.0):
+        self._script = script
+        self._restart_delay = restart_delay
+        self._health_interval = health_interval
+        self._mutex = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._process = None
+        self._pending = {}
+        self._next_id = 0
+        self._started_at = None
+        self._last_exit = 0.0
+        self._health_thread = None
+        self.restarts = 0
+        self.last_error = None
+
+    def _restart_wait_locked(self):
+        """Seconds to hold off before (re)starting the worker; 0 when it is running or may start."""
+        if self._process is not None and self._process.poll() is None:
+            return 0.0
+        # Back off briefly after a crash so a broken worker cannot spin.
+        return max(0.0, self._last_exit + self._restart_delay - time.monotonic())
+
+    def _ensure_process_locked(self):
+        if self._process is not None and self._process.poll() is None:
+            return self._process
+        if not os.path.isfile(self._script):
+            raise RuntimeError("Home Assistant device update script is missing")
+        if self._process is not None:
+            self.restarts += 1
+        try:
+            process = subprocess.Popen(
+                [NODE_BIN, self._script, "--serve"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+                bufsize=1,
+            )
+        except OSError as error:
+            raise RuntimeError(f"Unable to start Home Assistant update worker: {error}") from error
+        self._process = process
+        self._started_at = time.time()
+        threading.Thread(
+            target=self._read_responses, args=(process,), name="shp-ha-worker-reader", daemon=True
+        ).start()
+        if self._health_thread is None:
+            self._health_thread = threading.Thread(target=self._health_loop, name="shp-ha-worker-health", daemon=True)
+            self._health_thread.start()
+        return process
+
+    def _read_responses(self, process):
+        for line in process.stdout:
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(message, dict):
+                continue
+            with self._mutex:
+                future = self._pending.pop(message.get("id"), None)
+            if future is None:
+                continue
+            error = message.get("error")
+            if error:
+                future.set_exception(RuntimeError(str(error.get("message") or error)))
+            else:
+                future.set_result(message.get("result"))
+        process.wait()
+        with self._mutex:
+            if self._process is process:
+                self._last_exit = time.monotonic()
+            orphaned = [future for future in self._pending.values() if not future.done()]
+            self._pending.clear()
+        if orphaned:
+            self.last_error = f"Worker exited with code {process.returncode}"
+        for future in orphaned:
+            future.set_exception(RuntimeError("Home Assistant update worker exited"))
+
+    def call(self, method, params=None, timeout=20.0):
+        future = Future()
+        while True:
+            with self._mutex:
+                wait = self._restart_wait_locked()
+                if not wait:
+                    process = self._ensure_process_locked()
+                    self._next_id += 1
+                    request_id = self._next_id
+                    self._pending[request_id] = future
+                    break
+            # Sleep without the mutex so stats() and the reader thread are not held up.
+            time.sleep(wait)
+        line = json.dumps({"id": request_id, "method": method, "params": params or {}})
+        try:
+            with self._write_lock:
+                process.stdin.write(f"{line}\n")
+                process.stdin.flush()
+        except (BrokenPipeError, OSError) as error:
+            with self._mutex:
+                self._pending.pop(request_id, None)
+            raise RuntimeError("Home Assistant update worker is not accepting requests") from error
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError as error:
+            with self._mutex:
+                self._pending.pop(request_id, None)
+            raise TimeoutError(method) from error
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self._health_interval)
+            with self._mutex:
+                process = self._process
+            if process is None or process.poll() is not None:
+                continue
+            try:
+                result = self.call("ping", timeout=10.0)
+            except Exception as error:
+                self.last_error = f"Health check failed: {error}"
+                process.kill()
+                continue
+            # The worker itself is fine; it has already dropped a dead HA connection.
+            if isinstance(result, dict) and result.get("haError"):
+                self.last_error = f"Home Assistant ping failed: {result['haError']}"
+
+    def stats(self):
+        with self._mutex:
+            running = self._process is not None and self._process.poll() is None
+            return {
+                "running": running,
+                "pid": self._process.pid if running else None,
+                "startedAt": self._started_at if running else None,
+                "inFlight": len(self._pending),
+                "restarts": self.restarts,
+                "lastError": self.last_error,
+            }
+
+
+_ha_update_worker = _HaUpdateWorker(HA_DEVICE_UPDATE_SCRIPT)
+
+
+def _run_ha_device_update(params, description):
+    try:
+        result = _ha_update_worker.call("device.update", params, timeout=20.0)
+    except TimeoutError as error:
+        raise RuntimeError(f"Timed out while updating Home Assistant device {description}") from error
+    return result if result is not None else {}
 
 
 def _update_ha_device_name(device_id, device_name):
@@ -441,41 +3008,7 @@ def _update_ha_device_name(device_id, device_name):
         raise ValueError("Missing device id")
     if not normalized_name:
         raise ValueError("Missing device name")
-    if not os.path.isfile(HA_DEVICE_UPDATE_SCRIPT):
-        raise RuntimeError("Home Assistant device update script is missing")
-
-    command = [
-        NODE_BIN,
-        HA_DEVICE_UPDATE_SCRIPT,
-        "--id",
-        normalized_id,
-        "--name",
-        normalized_name,
-    ]
-
-    try:
-        completed = subprocess.run(
-            command,
-            check=True,
-            capture_output=True,
-            text=True,
-            timeout=20,
-        )
-    except subprocess.TimeoutExpired as error:
-        raise RuntimeError("Timed out while updating Home Assistant device name") from error
-    except subprocess.CalledProcessError as error:
-        stderr = (error.stderr or "").strip()
-        stdout = (error.stdout or "").strip()
-        detail = stderr or stdout or str(error)
-        raise RuntimeError(detail) from error
-
-    output = (completed.stdout or "").strip()
-    if not output:
-        return {}
-    try:
-        return json.loads(output)
-    except json.JSONDecodeError:
-        return {"raw": output}
+    return _run_ha_device_update({"deviceId": normalized_id, "name": normalized_name}, "name")
 
 
 def _update_ha_device_area(device_id, area_id):
@@ -483,86 +3016,299 @@ def _update_ha_device_area(device_id, area_id):
     normalized_area = str(area_id or "").strip()
     if not normalized_id:
         raise ValueError("Missing device id")
-    if not os.path.isfile(HA_DEVICE_UPDATE_SCRIPT):
-        raise RuntimeError("Home Assistant device update script is missing")
-
-    command = [
-        NODE_BIN,
-        HA_DEVICE_UPDATE_SCRIPT,
-        "--id",
-        normalized_id,
-        "--area-id",
-        normalized_area,
-    ]
-
-    try:
-        completed = subprocess.run(
-            command,
-            check=True,
-            capture_output=True,
-            text=True,
-            timeout=20,
-        )
-    except subprocess.TimeoutExpired as error:
-        raise RuntimeError("Timed out while updating Home Assistant device area") from error
-    except subprocess.CalledProcessError as error:
-        stderr = (error.stderr or "").strip()
-        stdout = (error.stdout or "").strip()
-        detail = stderr or stdout or str(error)
-        raise RuntimeError(detail) from error
-
-    output = (completed.stdout or "").strip()
-    if not output:
-        return {}
-    try:
-        return json.loads(output)
-    except json.JSONDecodeError:
-        return {"raw": output}
+    return _run_ha_device_update({"deviceId": normalized_id, "areaId": normalized_area}, "area")
 
 
 def _update_ha_device_labels(device_id, labels):
     normalized_id = str(device_id or "").strip()
     if not normalized_id:
         raise ValueError("Missing device id")
-    if not os.path.isfile(HA_DEVICE_UPDATE_SCRIPT):
-        raise RuntimeError("Home Assistant device update script is missing")
 
     label_list = labels if isinstance(labels, list) else []
     normalized_labels = [str(value or "").strip() for value in label_list]
     normalized_labels = [value for value in normalized_labels if value]
+    return _run_ha_device_update({"deviceId": normalized_id, "labels": normalized_labels}, "labels")
 
-    command = [
-        NODE_BIN,
-        HA_DEVICE_UPDATE_SCRIPT,
-        "--id",
-        normalized_id,
-        "--labels",
-        json.dumps(normalized_labels),
-    ]
 
+def _ha_update_error_status(message):
+    return 503 if "SUPERVISOR_TOKEN" in message else 502
+
+
+def _coalesce_ha_device_operations(operations):
+    """Merge batch operations into one worker update per device.
+
+    Returns ``(updates, rejected)``. ``updates`` keeps the order in which
+    devices first appear; fields from later operations for the same device
+    override earlier ones. ``rejected`` holds results for malformed items.
+    """
+    updates = {}
+    rejected = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            rejected.append({"index": index, "ok": False, "status": 400, "error": "Operation must be an object"})
+            continue
+        device_id = str(operation.get("id") or "").strip()
+        if not device_id:
+            rejected.append({"index": index, "ok": False, "status": 400, "error": "Missing required field: id"})
+            continue
+        params = {}
+        if "name" in operation:
+            name = str(operation.get("name") or "").strip()
+            if not name:
+                rejected.append(
+                    {"index": index, "id": device_id, "ok": False, "status": 400, "error": "Missing device name"}
+                )
+                continue
+            params["name"] = name
+        if "areaId" in operation:
+            params["areaId"] = str(operation.get("areaId") or "").strip()
+        if "labels" in operation:
+            label_list = operation.get("labels") if isinstance(operation.get("labels"), list) else []
+            params["labels"] = [value for value in (str(item or "").strip() for item in label_list) if value]
+        if not params:
+            rejected.append(
+                {
+                    "index": index,
+                    "id": device_id,
+                    "ok": False,
+                    "status": 400,
+                    "error": "Nothing to update: expected name, areaId or labels",
+                }
+            )
+            continue
+        entry = updates.setdefault(device_id, {"params": {"deviceId": device_id}, "indexes": []})
+        entry["params"].update(params)
+        entry["indexes"].append(index)
+    return updates, rejected
+
+
+_ha_batch_executor = ThreadPoolExecutor(max_workers=HA_BATCH_CONCURRENCY, thread_name_prefix="shp-ha-batch")
+
+
+def _run_ha_device_batch(updates):
+    """Yield one result per device as its update finishes.
+
+    All batches share ``HA_BATCH_CONCURRENCY`` executor threads, so a large
+    re-sync cannot flood the update worker with more in-flight calls.
+    """
+    futures = {
+        _ha_batch_executor.submit(_run_ha_device_update, entry["params"], "batch"): device_id
+        for device_id, entry in updates.items()
+    }
+    for future in as_completed(futures):
+        device_id = futures[future]
+        item = {"id": device_id, "operations": updates[device_id]["indexes"]}
+        try:
+            item.update({"ok": True, "result": future.result()})
+        except (RuntimeError, ValueError) as error:
+            message = str(error)
+            item.update({"ok": False, "status": _ha_update_error_status(message), "error": message})
+        yield item
+
+
+class _SupervisorClient:
+    """Keep-alive HTTP client for the Supervisor and Home Assistant Core APIs.
+
+    Connections are pooled per origin and reused across requests. ``get_cached``
+    adds a per-URL TTL cache: fresh entries are returned directly, stale ones
+    are returned while one background refresh runs, and concurrent misses for
+    the same URL wait on a single upstream fetch. GETs are retried with
+    exponential backoff on connection errors and 502/503/504.
+    """
+
+    RETRY_STATUSES = {502, 503, 504}
+    STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+    IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+    def __init__(self, timeout=10.0, retries=2, backoff=0.25, max_idle_per_origin=4):
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._max_idle = max_idle_per_origin
+        self._mutex = threading.Lock()
+        self._idle = {}
+        self._cache = {}
+        self._inflight = {}
+        self._endpoints = {}
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def _endpoint_locked(self, path):
+        counters = self._endpoints.get(path)
+        if counters is None:
+            counters = self._endpoints[path] = {
+                "hits": 0,
+                "staleHits": 0,
+                "misses": 0,
+                "coalesced": 0,
+                "upstreamRequests": 0,
+                "upstreamErrors": 0,
+                "retries": 0,
+                "totalMs": 0.0,
+                "maxMs": 0.0,
+                "lastMs": None,
+            }
+        return counters
+
+    def _acquire(self, origin, reuse=True):
+        with self._mutex:
+            idle = self._idle.get(origin) if reuse else None
+            if idle:
+                self.connections_reused += 1
+                return idle.pop(), True
+            self.connections_opened += 1
+        scheme, host, port = origin
+        factory = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return factory(host, port, timeout=self._timeout), False
+
+    def _release(self, origin, connection, response):
+        if not response.will_close:
+            with self._mutex:
+                idle = self._idle.setdefault(origin, [])
+                if len(idle) < self._max_idle:
+                    idle.append(connection)
+                    return
+        connection.close()
+
+    def _send(self, origin, method, target, body, headers):
+        # A pooled connection the server already closed fails on first use;
+        # that attempt is repeated once on a fresh connection. A POST may have
+        # reached Supervisor before the connection dropped, so non-idempotent
+        # methods never go out on a pooled connection and are never repeated.
+        idempotent = method in self.IDEMPOTENT_METHODS
+        while True:
+            connection, reused = self._acquire(origin, reuse=idempotent)
+            try:
+                connection.request(method, target, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except self.STALE_CONNECTION_ERRORS:
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            self._release(origin, connection, response)
+            return response.status, response.reason, data
+
+    def request(self, method, url, body=None, headers=None):
+        """Return the response body as bytes; raise RuntimeError on failure."""
+        parsed = urlparse(url)
+        origin = (parsed.scheme or "http", parsed.hostname, parsed.port)
+        target = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+        request_headers = {"Authorization": f"Bearer {SUPERVISOR_TOKEN}"}
+        request_headers.update(headers or {})
+        attempts = 1 + (self._retries if method == "GET" else 0)
+        last_error = None
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(self._backoff * (2 ** (attempt - 1)))
+            started = time.monotonic()
+            try:
+                status, reason, data = self._send(origin, method, target, body, request_headers)
+                failure = f"HTTP Error {status}: {reason}" if status >= 400 else None
+            except (OSError, http.client.HTTPException) as error:
+                status, data, failure = None, None, str(error) or error.__class__.__name__
+            elapsed_ms = (time.monotonic() - started) * 1000.0
+            with self._mutex:
+                counters = self._endpoint_locked(parsed.path)
+                counters["upstreamRequests"] += 1
+                counters["retries"] += 1 if attempt else 0
+                counters["totalMs"] += elapsed_ms
+                counters["maxMs"] = max(counters["maxMs"], elapsed_ms)
+                counters["lastMs"] = round(elapsed_ms, 1)
+                if failure:
+                    counters["upstreamErrors"] += 1
+            if failure is None:
+                return data
+            last_error = failure
+            if status is not None and status not in self.RETRY_STATUSES:
+                break
+        raise RuntimeError(last_error)
+
+    def get_cached(self, url, ttl, stale_ttl, decode):
+        """GET ``url`` through the cache and return ``decode(body)``.
+
+        ``ttl <= 0`` asks for a fresh value: nothing cached is returned, stale
+        or not, though the caller may share a fetch that is already running.
+        Cached values are shared between callers and must not be mutated.
+        """
+        now = time.monotonic()
+        leader = False
+        with self._mutex:
+            counters = self._endpoint_locked(urlparse(url).path)
+            entry = self._cache.get(url)
+            age = now - entry["fetchedAt"] if entry is not None else None
+            if entry is not None and age < ttl:
+                counters["hits"] += 1
+                return entry["value"]
+            if entry is not None and ttl > 0 and age < ttl + stale_ttl:
+                counters["staleHits"] += 1
+                if url not in self._inflight:
+                    future = self._inflight[url] = Future()
+                    threading.Thread(
+                        target=self._refresh,
+                        args=(url, decode, future),
+                        name="shp-supervisor-refresh",
+                        daemon=True,
+                    ).start()
+                return entry["value"]
+            future = self._inflight.get(url)
+            if future is None:
+                counters["misses"] += 1
+                future = self._inflight[url] = Future()
+                leader = True
+            else:
+                counters["coalesced"] += 1
+        if leader:
+            self._refresh(url, decode, future)
+        return future.result()
+
+    def _refresh(self, url, decode, future):
+        try:
+            value = decode(self.request("GET", url))
+        except BaseException as error:
+            with self._mutex:
+                self._inflight.pop(url, None)
+            future.set_exception(error)
+            return
+        with self._mutex:
+            self._cache[url] = {"value": value, "fetchedAt": time.monotonic()}
+            self._inflight.pop(url, None)
+        future.set_result(value)
+
+    def stats(self):
+        with self._mutex:
+            endpoints = {}
+            for path, counters in self._endpoints.items():
+                lookups = counters["hits"] + counters["staleHits"] + counters["misses"] + counters["coalesced"]
+                requests = counters["upstreamRequests"]
+                endpoints[path] = {
+                    **{key: value for key, value in counters.items() if key not in {"totalMs", "maxMs"}},
+                    "hitRatio": round((counters["hits"] + counters["staleHits"]) / lookups, 3) if lookups else None,
+                    "avgMs": round(counters["totalMs"] / requests, 1) if requests else None,
+                    "maxMs": round(counters["maxMs"], 1),
+                }
+            return {
+                "connectionsOpened": self.connections_opened,
+                "connectionsReused": self.connections_reused,
+                "idleConnections": sum(len(idle) for idle in self._idle.values()),
+                "cachedUrls": len(self._cache),
+                "endpoints": endpoints,
+            }
+
+
+_supervisor_client = _SupervisorClient(retries=SUPERVISOR_REQUEST_RETRIES)
+
+
+def _decode_supervisor_json(body):
+    payload = body.decode("utf-8") or "{}"
     try:
-        completed = subprocess.run(
-            command,
-            check=True,
-            capture_output=True,
-            text=True,
-            timeout=20,
-        )
-    except subprocess.TimeoutExpired as error:
-        raise RuntimeError("Timed out while updating Home Assistant device labels") from error
-    except subprocess.CalledProcessError as error:
-        stderr = (error.stderr or "").strip()
-        stdout = (error.stdout or "").strip()
-        detail = stderr or stdout or str(error)
-        raise RuntimeError(detail) from error
-
-    output = (completed.stdout or "").strip()
-    if not output:
-        return {}
-    try:
-        return json.loads(output)
+        return json.loads(payload)
     except json.JSONDecodeError:
-        return {"raw": output}
+        return {"raw": payload}
 
 
 def _fetch_ha_config():
@@ -570,19 +3316,16 @@ def _fetch_ha_config():
         raise RuntimeError("SUPERVISOR_TOKEN is missing")
     base_url = str(SUPERVISOR_CORE_URL or "http://supervisor/core").rstrip("/")
     url = f"{base_url}/api/config"
-    request = Request(url, headers={"Authorization": f"Bearer {SUPERVISOR_TOKEN}"})
     try:
-        with urlopen(request, timeout=10) as response:
-            payload = response.read().decode("utf-8") or "{}"
+        return _supervisor_client.get_cached(
+            url, HA_CONFIG_CACHE_SECONDS, SUPERVISOR_STALE_SECONDS, _decode_supervisor_json
+        )
     except Exception as error:
         raise RuntimeError(f"Failed to load Home Assistant config: {error}") from error
-    try:
-        return json.loads(payload)
-    except json.JSONDecodeError:
-        return {"raw": payload}
 
 
-def _fetch_supervisor_json(path):
+def _fetch_supervisor_json(path, fresh=False):
+    """GET a Supervisor API path; ``fresh`` skips the TTL and stale cache (the result is still cached)."""
     if not SUPERVISOR_TOKEN:
         raise RuntimeError("SUPERVISOR_TOKEN is missing")
     base_url = str(SUPERVISOR_API_URL or "http://supervisor").rstrip("/")
@@ -590,16 +3333,12 @@ def _fetch_supervisor_json(path):
     if not normalized_path.startswith("/"):
         normalized_path = f"/{normalized_path}"
     url = f"{base_url}{normalized_path}"
-    request = Request(url, headers={"Authorization": f"Bearer {SUPERVISOR_TOKEN}"})
     try:
-        with urlopen(request, timeout=10) as response:
-            payload = response.read().decode("utf-8") or "{}"
+        return _supervisor_client.get_cached(
+            url, 0 if fresh else SUPERVISOR_CACHE_SECONDS, SUPERVISOR_STALE_SECONDS, _decode_supervisor_json
+        )
     except Exception as error:
         raise RuntimeError(f"Failed to load Supervisor data from {normalized_path}: {error}") from error
-    try:
-        return json.loads(payload)
-    except json.JSONDecodeError:
-        return {"raw": payload}
 
 
 def _call_ha_service(domain, service, payload):
@@ -607,18 +3346,9 @@ def _call_ha_service(domain, service, payload):
         return
     base_url = str(SUPERVISOR_CORE_URL or "http://supervisor/core").rstrip("/")
     url = f"{base_url}/api/services/{domain}/{service}"
-    body = json.dumps(payload).encode("utf-8")
-    request = Request(
-        url,
-        data=body,
-        headers={
-            "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
-            "Content-Type": "application/json",
-        },
-        method="POST",
+    _supervisor_client.request(
+        "POST", url, body=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"}
     )
-    with urlopen(request, timeout=10) as response:
-        response.read()
 
 
 def _send_or_dismiss_notification(notification_id, title, message, active):
@@ -637,36 +3367,310 @@ def _send_or_dismiss_notification(notification_id, title, message, active):
         pass
 
 
-def _notif_check_battery(devices, state):
-    """Returns ("send"|"dismiss"|"skip", message, next_state).
-    Tracks overdue vs due-soon devices separately. Fires when new devices appear in either
-    group, and re-fires when a device graduates from due-soon to overdue (respecting dismiss
-    for devices already notified at the same level)."""
-    now = datetime.datetime.now(datetime.timezone.utc)
-    overdue_devices = {}   # id -> name: days_since > duration (past replacement date)
-    soon_devices = {}      # id -> name: 0.8 <= ratio < 1.0 (approaching replacement date)
-    for device in devices:
-        last_str = device.get("lastBatteryChange")
-        if not last_str:
-            continue
-        try:
-            last = datetime.datetime.fromisoformat(str(last_str).replace("Z", "+00:00"))
-            if last.tzinfo is None:
-                last = last.replace(tzinfo=datetime.timezone.utc)
-        except Exception:
-            continue
+def _first_day_reaching_ratio(duration, threshold):
+    """Smallest whole number of days ``d`` with ``d / duration >= threshold``."""
+    days = math.ceil(duration * threshold)
+    while days > 0 and (days - 1) / duration >= threshold:
+        days -= 1
+    while days / duration < threshold:
+        days += 1
+    return days
+
+
+def _utc_midnight(day):
+    return datetime.datetime.combine(day, datetime.time(), tzinfo=datetime.timezone.utc)
+
+
+MAINTENANCE_KINDS = ("battery", "warranty", "test")
+# Warranty entries leave the index views once the warranty has expired;
+# batteries and tests stay listed as due until they are serviced.
+MAINTENANCE_EXPIRING_KINDS = {"warranty"}
+
+
+def _maintenance_entries_for_device(device, device_id):
+    name = device.get("name") or "Unnamed"
+    entries = []
+    last = _parse_datetime_utc(device.get("lastBatteryChange"))
+    try:
         duration = int(device.get("batteryDuration") or 730)
-        if duration <= 0:
-            continue
-        days_since = (now - last).days
-        ratio = days_since / duration
-        device_id = str(device.get("id") or "").strip()
-        if not device_id:
-            continue
-        if ratio >= 1.0:
-            overdue_devices[device_id] = device.get("name") or "Unnamed"
-        elif ratio >= 0.8:
-            soon_devices[device_id] = device.get("name") or "Unnamed"
+    except (TypeError, ValueError):
+        duration = 0
+    try:
+        if last is not None and duration > 0:
+            entries.append(
+                {
+                    "kind": "battery",
+                    "id": device_id,
+                    "name": name,
+                    "alertAt": (last + datetime.timedelta(days=_first_day_reaching_ratio(duration, 0.8))).timestamp(),
+                    "dueAt": (last + datetime.timedelta(days=duration)).timestamp(),
+                }
+            )
+    except OverflowError:
+        pass
+    warranty = str(device.get("warrantyExpiration") or "")
+    try:
+        expires = datetime.date.fromisoformat(warranty[:10]) if warranty else None
+        if expires is not None:
+            entries.append(
+                {
+                    "kind": "warranty",
+                    "id": device_id,
+                    "name": name,
+                    "alertAt": _utc_midnight(expires - datetime.timedelta(days=90)).timestamp(),
+                    # The warranty still covers its expiration day.
+                    "dueAt": _utc_midnight(expires + datetime.timedelta(days=1)).timestamp(),
+                }
+            )
+    except (ValueError, OverflowError):
+        pass
+    return entries
+
+
+def _maintenance_entries_for_test_case(test_case, case_id, latest_run):
+    if test_case.get("enabled") is False:
+        return []
+    try:
+        frequency = int(test_case.get("frequencyDays") or 30)
+    except (TypeError, ValueError):
+        return []
+    entry = {"kind": "test", "id": case_id, "name": test_case.get("name") or "Unnamed", "alertAt": None, "dueAt": None}
+    if latest_run is not None:
+        try:
+            next_due = (latest_run + datetime.timedelta(days=frequency)).date()
+            entry["alertAt"] = _utc_midnight(next_due - datetime.timedelta(days=7)).timestamp()
+            entry["dueAt"] = _utc_midnight(next_due).timestamp()
+        except OverflowError:
+            return []
+    return [entry]
+
+
+def _maintenance_index_after(items, moment):
+    """Position of the first ``(moment, id)`` item strictly later than ``moment``."""
+    # Every entity id sorts below the highest code point.
+    return bisect.bisect_right(items, (moment, chr(0x10FFFF)))
+
+
+def _maintenance_sort_key(moment):
+    # Test cases that never ran have no dates and sort first: they are due now.
+    return -math.inf if moment is None else moment
+
+
+class _MaintenanceIndex:
+    """Due dates for battery, warranty and test-case maintenance, kept sorted per kind.
+
+    Each kind has two lists of ``(moment, entity id)``: one by ``dueAt`` and one by
+    ``alertAt``, the start of its notification window. ``sync`` brings the index up
+    to date with the current storage document. Unchanged collections are skipped.
+    Otherwise only entities whose raw dict changed are parsed again. Test cases
+    are re-evaluated only when the case itself or one of its runs changed.
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._etag = None
+        self._entries = {}
+        self._by_due = {kind: [] for kind in MAINTENANCE_KINDS}
+        self._by_alert = {kind: [] for kind in MAINTENANCE_KINDS}
+        self._devices_source = None
+        self._device_sources = {}
+        self._runs_source = None
+        self._run_sources = {}
+        self._latest_runs = {}
+        self._cases_source = None
+        self._case_sources = {}
+        self.syncs = 0
+        self.reparsed = 0
+
+    def _remove_locked(self, kind, entity_id):
+        entry = self._entries.pop((kind, entity_id), None)
+        if entry is None:
+            return
+        for lists, field in ((self._by_due, "dueAt"), (self._by_alert, "alertAt")):
+            items = lists[kind]
+            item = (_maintenance_sort_key(entry[field]), entity_id)
+            position = bisect.bisect_left(items, item)
+            if position < len(items) and items[position] == item:
+                del items[position]
+
+    def _replace_locked(self, kinds, entity_id, entries):
+        for kind in kinds:
+            self._remove_locked(kind, entity_id)
+        for entry in entries:
+            self._entries[(entry["kind"], entity_id)] = entry
+            bisect.insort(self._by_due[entry["kind"]], (_maintenance_sort_key(entry["dueAt"]), entity_id))
+            bisect.insort(self._by_alert[entry["kind"]], (_maintenance_sort_key(entry["alertAt"]), entity_id))
+        self.reparsed += 1
+
+    def _sync_devices_locked(self, devices):
+        if devices is self._devices_source:
+            return
+        self._devices_source = devices
+        seen = {}
+        for device in devices if isinstance(devices, list) else []:
+            if not isinstance(device, dict):
+                continue
+            device_id = str(device.get("id") or "").strip()
+            if not device_id:
+                continue
+            previous = self._device_sources.get(device_id)
+            seen[device_id] = device
+            if previous is device or (previous is not None and previous == device):
+                continue
+            self._replace_locked(("battery", "warranty"), device_id, _maintenance_entries_for_device(device, device_id))
+        for device_id in self._device_sources.keys() - seen.keys():
+            self._replace_locked(("battery", "warranty"), device_id, [])
+        self._device_sources = seen
+
+    def _sync_runs_locked(self, runs):
+        """Update the latest run per test case; returns the case ids whose runs changed."""
+        if runs is self._runs_source:
+            return set()
+        self._runs_source = runs
+        seen = {}
+        affected = set()
+        for position, run in enumerate(runs if isinstance(runs, list) else []):
+            if not isinstance(run, dict):
+                continue
+            run_key = str(run.get("id") or "").strip() or f"#{position}"
+            previous = self._run_sources.get(run_key)
+            if previous is not None and (previous[0] is run or previous[0] == run):
+                seen[run_key] = previous
+                continue
+            case_id = run.get("testCaseId")
+            case_id = case_id if isinstance(case_id, (str, int)) and case_id else None
+            run_at = _parse_datetime_utc(run.get("runAt") or run.get("createdAt")) if case_id else None
+            seen[run_key] = (run, case_id, run_at)
+            affected.add(case_id)
+            if previous is not None:
+                affected.add(previous[1])
+        for run_key in self._run_sources.keys() - seen.keys():
+            affected.add(self._run_sources[run_key][1])
+        self._run_sources = seen
+        affected.discard(None)
+        if affected:
+            latest = {}
+            for _run, case_id, run_at in seen.values():
+                if case_id in affected and run_at is not None and (case_id not in latest or run_at > latest[case_id]):
+                    latest[case_id] = run_at
+            for case_id in affected:
+                if case_id in latest:
+                    self._latest_runs[case_id] = latest[case_id]
+                else:
+                    self._latest_runs.pop(case_id, None)
+        return affected
+
+    def _sync_test_cases_locked(self, test_cases, affected):
+        if test_cases is self._cases_source and not affected:
+            return
+        self._cases_source = test_cases
+        seen = {}
+        for test_case in test_cases if isinstance(test_cases, list) else []:
+            if not isinstance(test_case, dict) or not test_case.get("id"):
+                continue
+            raw_id = test_case.get("id")
+            case_id = str(raw_id)
+            previous = self._case_sources.get(case_id)
+            seen[case_id] = test_case
+            unchanged = previous is test_case or (previous is not None and previous == test_case)
+            if unchanged and raw_id not in affected:
+                continue
+            latest_run = self._latest_runs.get(raw_id) if isinstance(raw_id, (str, int)) else None
+            self._replace_locked(("test",), case_id, _maintenance_entries_for_test_case(test_case, case_id, latest_run))
+        for case_id in self._case_sources.keys() - seen.keys():
+            self._replace_locked(("test",), case_id, [])
+        self._case_sources = seen
+
+    def sync(self):
+        with self._mutex:
+            with _lock:
+                payload, _, etag = _read_storage_cached()
+            if etag == self._etag:
+                return
+            payload = payload if isinstance(payload, dict) else {}
+            self._sync_devices_locked(payload.get("devices"))
+            affected = self._sync_runs_locked(payload.get("testCaseRuns"))
+            self._sync_test_cases_locked(payload.get("testCases"), affected)
+            self._etag = etag
+            self.syncs += 1
+
+    def alerting(self, kind, now):
+        """Entries of ``kind`` whose notification window is open at ``now``."""
+        self.sync()
+        with self._mutex:
+            items = self._by_alert[kind]
+            end = _maintenance_index_after(items, now)
+            entries = [self._entries[(kind, entity_id)] for _, entity_id in items[:end]]
+        if kind in MAINTENANCE_EXPIRING_KINDS:
+            entries = [entry for entry in entries if now < entry["dueAt"]]
+        return entries
+
+    def upcoming(self, now, horizon, kinds, include_due=True):
+        """Entries due before ``horizon``, merged across ``kinds`` in due order."""
+        self.sync()
+        ranges = []
+        with self._mutex:
+            for kind in kinds:
+                items = self._by_due[kind]
+                if include_due and kind not in MAINTENANCE_EXPIRING_KINDS:
+                    start = 0
+                else:
+                    start = _maintenance_index_after(items, now)
+                end = _maintenance_index_after(items, horizon)
+                ranges.append([(moment, kind, entity_id) for moment, entity_id in items[start:end]])
+            return [self._entries[(kind, entity_id)] for _, kind, entity_id in heapq.merge(*ranges)]
+
+    def changes_after(self, now, kinds, limit):
+        """The next ``limit`` moments after ``now`` at which an entry enters or leaves its window."""
+        self.sync()
+        events = {"battery": ("dueSoon", "overdue"), "warranty": ("expiringSoon", "expired"), "test": ("dueSoon", None)}
+        streams = []
+        with self._mutex:
+            for kind in kinds:
+                alert_event, due_event = events[kind]
+                for lists, event in ((self._by_alert, alert_event), (self._by_due, due_event)):
+                    if event is None:
+                        continue
+                    items = lists[kind]
+                    start = _maintenance_index_after(items, now)
+                    streams.append([(moment, kind, event, entity_id) for moment, entity_id in items[start : start + limit]])
+            return [
+                {
+                    "at": moment,
+                    "kind": kind,
+                    "event": event,
+                    "id": entity_id,
+                    "name": self._entries[(kind, entity_id)]["name"],
+                }
+                for moment, kind, event, entity_id in itertools.islice(heapq.merge(*streams), limit)
+            ]
+
+    def stats(self):
+        with self._mutex:
+            return {
+                "entries": len(self._entries),
+                "byKind": {kind: len(items) for kind, items in self._by_due.items()},
+                "syncs": self.syncs,
+                "reparsedEntities": self.reparsed,
+            }
+
+
+_maintenance_index = _MaintenanceIndex()
+
+
+def _notif_check_battery(state):
+    """Returns ("send"|"dismiss"|"skip", message, next_state).
+    Tracks overdue vs due-soon devices separately. Fires when new devices appear in either
+    group, and re-fires when a device graduates from due-soon to overdue (respecting dismiss
+    for devices already notified at the same level)."""
+    now = time.time()
+    overdue_devices = {}   # id -> name: past the replacement date
+    soon_devices = {}      # id -> name: 0.8 <= ratio < 1.0 (approaching replacement date)
+    for entry in _maintenance_index.alerting("battery", now):
+        if now >= entry["dueAt"]:
+            overdue_devices[entry["id"]] = entry["name"]
+        else:
+            soon_devices[entry["id"]] = entry["name"]
 
     all_alert_ids = set(overdue_devices) | set(soon_devices)
     prev_overdue = set(state.get("overdueIds") or [])
@@ -704,23 +3708,15 @@ def _notif_check_battery(devices, state):
     return "skip", "", next_state
 
 
-def _notif_check_warranty(devices, state):
+def _notif_check_warranty(state):
     """Tracks per-device IDs. Fires only for newly expiring devices."""
-    now = datetime.datetime.now(datetime.timezone.utc).date()
+    now = time.time()
+    today = _utc_midnight(datetime.datetime.now(datetime.timezone.utc).date()).timestamp()
     alert_devices = {}
-    for device in devices:
-        exp_str = device.get("warrantyExpiration")
-        if not exp_str:
-            continue
-        try:
-            exp = datetime.date.fromisoformat(str(exp_str)[:10])
-        except Exception:
-            continue
-        days_until = (exp - now).days
-        if 0 <= days_until <= 90:
-            device_id = str(device.get("id") or "").strip()
-            if device_id:
-                alert_devices[device_id] = (device.get("name") or "Unnamed", days_until)
+    for entry in _maintenance_index.alerting("warranty", now):
+        # dueAt is the midnight after the expiration day.
+        days_until = int((entry["dueAt"] - today) // 86400) - 1
+        alert_devices[entry["id"]] = (entry["name"], days_until)
     alert_ids = set(alert_devices)
     prev_notified = set(state.get("notifiedIds") or [])
     clean_prev = prev_notified & alert_ids
@@ -740,7 +3736,7 @@ def _notif_check_warranty(devices, state):
 def _notif_check_backup(state):
     """7-day cooldown after each send. Re-sends after 7 days if warning persists."""
     try:
-        status = _build_backup_status_payload(write_debug_dump=False)
+        status, _ = _backup_status_cache.get()
     except Exception:
         return "skip", "", state
     stale = not status.get("hasRecentBackup", True)
@@ -769,42 +3765,9 @@ def _notif_check_backup(state):
     return "send", msg, {"lastSentAt": now_str}
 
 
-def _notif_check_tests(storage, state):
+def _notif_check_tests(state):
     """Tracks per-test-case IDs. Fires only for newly overdue/due-soon cases."""
-    test_cases = [tc for tc in (storage.get("testCases") or []) if tc and tc.get("enabled") is not False]
-    test_runs = storage.get("testCaseRuns") or []
-    today = datetime.datetime.now(datetime.timezone.utc).date()
-    runs_by_case = {}
-    for run in test_runs:
-        case_id = run.get("testCaseId")
-        if not case_id:
-            continue
-        run_at_str = run.get("runAt") or run.get("createdAt")
-        if not run_at_str:
-            continue
-        try:
-            run_at = datetime.datetime.fromisoformat(str(run_at_str).replace("Z", "+00:00"))
-            if run_at.tzinfo is None:
-                run_at = run_at.replace(tzinfo=datetime.timezone.utc)
-        except Exception:
-            continue
-        existing = runs_by_case.get(case_id)
-        if existing is None or run_at > existing["runAt"]:
-            runs_by_case[case_id] = {"runAt": run_at}
-    alert_cases = {}
-    for tc in test_cases:
-        tc_id = tc.get("id")
-        if not tc_id:
-            continue
-        frequency = int(tc.get("frequencyDays") or 30)
-        latest_run = runs_by_case.get(tc_id)
-        if latest_run is None:
-            alert_cases[str(tc_id)] = tc.get("name") or "Unnamed"
-            continue
-        next_due = (latest_run["runAt"] + datetime.timedelta(days=frequency)).date()
-        days_until = (next_due - today).days
-        if days_until < 0 or days_until <= 7:
-            alert_cases[str(tc_id)] = tc.get("name") or "Unnamed"
+    alert_cases = {entry["id"]: entry["name"] for entry in _maintenance_index.alerting("test", time.time())}
     alert_ids = set(alert_cases)
     prev_notified = set(state.get("notifiedIds") or [])
     clean_prev = prev_notified & alert_ids
@@ -819,6 +3782,8 @@ def _notif_check_tests(storage, state):
     return "skip", "", {"notifiedIds": sorted(clean_prev)}
 
 
+# Upper bound between notification runs; most runs are scheduled earlier by
+# the thresholds in _compute_notification_wakeups.
 NOTIFICATION_CHECK_INTERVAL_SECONDS = 24 * 60 * 60
 
 
@@ -830,16 +3795,15 @@ def _run_notification_checks():
         return {"skipped": True}
     types = notif_settings.get("types") or {}
     prev_state = dict(notif_settings.get("state") or {})
-    devices = storage.get("devices") or []
     new_state = dict(prev_state)
     results = {}
     state_changed = False
 
     checks = [
-        ("battery",  "shp_battery",  "Smart Home Planner — Batteries", lambda: _notif_check_battery(devices, prev_state.get("battery") or {})),
-        ("warranty", "shp_warranty", "Smart Home Planner — Warranty",  lambda: _notif_check_warranty(devices, prev_state.get("warranty") or {})),
+        ("battery",  "shp_battery",  "Smart Home Planner — Batteries", lambda: _notif_check_battery(prev_state.get("battery") or {})),
+        ("warranty", "shp_warranty", "Smart Home Planner — Warranty",  lambda: _notif_check_warranty(prev_state.get("warranty") or {})),
         ("backup",   "shp_backup",   "Smart Home Planner — Backup",    lambda: _notif_check_backup(prev_state.get("backup") or {})),
-        ("tests",    "shp_tests",    "Smart Home Planner — Tests",     lambda: _notif_check_tests(storage, prev_state.get("tests") or {})),
+        ("tests",    "shp_tests",    "Smart Home Planner — Tests",     lambda: _notif_check_tests(prev_state.get("tests") or {})),
     ]
     checks = [(k, n, t, fn) for k, n, t, fn in checks if types.get(k, True)]
 
@@ -859,23 +3823,241 @@ def _run_notification_checks():
 
     if state_changed:
         with _lock:
-            current = _read_storage()
-            s = current.setdefault("settings", {})
-            n = s.setdefault("notifications", {})
+            # The cached document is shared, so copy the path we modify.
+            current = dict(_read_storage())
+            s = dict(current.get("settings") or {})
+            n = dict(s.get("notifications") or {})
             n["state"] = new_state
+            s["notifications"] = n
+            current["settings"] = s
             _write_storage(current)
 
     return results
 
 
-def _schedule_notification_check():
-    try:
-        _run_notification_checks()
-    except Exception:
-        pass
-    t = threading.Timer(NOTIFICATION_CHECK_INTERVAL_SECONDS, _schedule_notification_check)
-    t.daemon = True
-    t.start()
+def _compute_notification_wakeups(storage, now, limit=50):
+    """Future moments at which a notification check could change its outcome.
+
+    Mirrors the thresholds used by the _notif_check_* functions, so sleeping
+    until the earliest entry never delays a notification.
+    """
+    notif_settings = (storage.get("settings") or {}).get("notifications") or {}
+    if not notif_settings.get("enabled", True):
+        return []
+    types = notif_settings.get("types") or {}
+    wakeups = []
+
+    def add(moment, kind, event, item_id="", name=""):
+        if moment is None or moment <= now:
+            return
+        wakeups.append({"at": moment, "type": kind, "event": event, "id": item_id, "name": name})
+
+    # Notification types are named after the checks; the index uses "test".
+    kinds = [kind for kind in MAINTENANCE_KINDS if types.get("tests" if kind == "test" else kind, True)]
+    for change in _maintenance_index.changes_after(now, kinds, limit):
+        add(change["at"], "tests" if change["kind"] == "test" else change["kind"], change["event"], change["id"], change["name"])
+
+    if types.get("backup", True):
+        try:
+            status, _ = _backup_status_cache.get()
+        except Exception:
+            status = None
+        latest = _parse_datetime_utc(((status or {}).get("latestBackup") or {}).get("date"))
+        if latest is not None:
+            stale_days = int(status.get("staleAfterDays") or 7)
+            add((latest + datetime.timedelta(days=stale_days + 1)).timestamp(), "backup", "stale")
+        backup_state = (notif_settings.get("state") or {}).get("backup") or {}
+        last_sent = _parse_datetime_utc(backup_state.get("lastSentAt"))
+        if last_sent is not None:
+            add((last_sent + datetime.timedelta(days=7)).timestamp(), "backup", "reminder")
+
+    wakeups.sort(key=lambda item: item["at"])
+    return wakeups
+
+
+def _iso_from_timestamp(value):
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).isoformat()
+
+
+# Fields the notification checks and _maintenance_entries_for_* read. A device
+# without either date has no maintenance entries, so it is left out entirely.
+NOTIFICATION_DEVICE_FIELDS = ("name", "lastBatteryChange", "batteryDuration", "warrantyExpiration")
+NOTIFICATION_DEVICE_DATE_FIELDS = ("lastBatteryChange", "warrantyExpiration")
+NOTIFICATION_TEST_CASE_FIELDS = ("name", "enabled", "frequencyDays")
+
+
+def _notification_fields_by_id(items, fields, required=()):
+    result = {}
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, dict) and (not required or any(item.get(field) for field in required)):
+            result[str(item.get("id"))] = tuple(item.get(field) for field in fields)
+    return result
+
+
+def _notification_inputs_changed(previous, payload):
+    """True if a write between these documents can change a notification check's outcome.
+
+    Only notification settings (minus the checks' own ``state``), test runs
+    and the maintenance fields of devices and test cases count. Unchanged
+    collections are the same list object, so most writes compare nothing.
+    """
+    previous = previous if isinstance(previous, dict) else {}
+    payload = payload if isinstance(payload, dict) else {}
+
+    def settings(document):
+        notifications = (document.get("settings") or {}).get("notifications") or {}
+        return {key: value for key, value in notifications.items() if key != "state"}
+
+    if settings(previous) != settings(payload):
+        return True
+    old_runs, new_runs = previous.get("testCaseRuns"), payload.get("testCaseRuns")
+    if old_runs is not new_runs and old_runs != new_runs:
+        return True
+    collections = (
+        ("devices", NOTIFICATION_DEVICE_FIELDS, NOTIFICATION_DEVICE_DATE_FIELDS),
+        ("testCases", NOTIFICATION_TEST_CASE_FIELDS, ()),
+    )
+    for key, fields, required in collections:
+        old_items, new_items = previous.get(key), payload.get(key)
+        if old_items is new_items:
+            continue
+        if _notification_fields_by_id(old_items, fields, required) != _notification_fields_by_id(new_items, fields, required):
+            return True
+    return False
+
+
+class _NotificationScheduler:
+    """Runs the notification checks when their outcome can next change.
+
+    After each run the scheduler sleeps until the earliest threshold crossing
+    from _compute_notification_wakeups. It never sleeps longer than
+    ``max_interval``, which covers backup status changing in Supervisor.
+    Storage writes that change a notification input (see
+    _notification_inputs_changed) wake it early, after a short debounce; its
+    own state write does not. The next wakeup is persisted so a restart
+    neither skips a missed check nor rescans early.
+    """
+
+    def __init__(self, path, max_interval, debounce=2.0, startup_delay=60.0, retry_delay=60.0, listed_wakeups=50):
+        self._path = path
+        self._max_interval = max_interval
+        self._retry_delay = retry_delay
+        self._debounce = debounce
+        self._startup_delay = startup_delay
+        self._listed_wakeups = listed_wakeups
+        self._wake = threading.Event()
+        self._run_lock = threading.Lock()
+        self._mutex = threading.Lock()
+        self._thread = None
+        self._next_at = None
+        self._last_run_at = None
+        self._last_results = None
+        self._wakeups = []
+        self.runs = 0
+
+    def storage_changed(self, previous, payload):
+        if _notification_inputs_changed(previous, payload):
+            self._wake.set()
+
+    def _load(self):
+        try:
+            with open(self._path, "rb") as handle:
+                persisted = _json_decode(handle.read())
+        except (OSError, ValueError):
+            return
+        if not isinstance(persisted, dict):
+            return
+        next_at = _parse_datetime_utc(persisted.get("nextWakeupAt"))
+        last_run_at = _parse_datetime_utc(persisted.get("lastRunAt"))
+        with self._mutex:
+            self._next_at = next_at.timestamp() if next_at else None
+            self._last_run_at = last_run_at.timestamp() if last_run_at else None
+            self._wakeups = [item for item in persisted.get("wakeups") or [] if isinstance(item, dict)]
+
+    def _save(self):
+        try:
+            _write_file_atomic(self._path, _json_encode(self.snapshot()))
+        except OSError as error:
+            print(f"[notifications] unable to persist schedule: {error}", flush=True)
+
+    def run(self):
+        with self._run_lock:
+            results = _run_notification_checks()
+            now = time.time()
+            with _lock:
+                storage = _read_storage()
+            wakeups = _compute_notification_wakeups(storage, now, self._listed_wakeups)
+            # A second of slack keeps whole-day thresholds from being read a
+            # moment too early.
+            next_at = now + self._max_interval
+            if wakeups:
+                next_at = min(next_at, wakeups[0]["at"] + 1.0)
+            with self._mutex:
+                self._last_run_at = now
+                self._last_results = results
+                self._next_at = next_at
+                self._wakeups = [
+                    {**item, "at": _iso_from_timestamp(item["at"])} for item in wakeups[: self._listed_wakeups]
+                ]
+                self.runs += 1
+            self._save()
+            return results
+
+    def _initial_due(self):
+        now = time.time()
+        with self._mutex:
+            next_at, last_run_at = self._next_at, self._last_run_at
+        if next_at is None or last_run_at is None:
+            return now + self._startup_delay
+        # A wakeup missed while the add-on was stopped runs shortly after start.
+        return max(min(next_at, last_run_at + self._max_interval), now + self._startup_delay)
+
+    def _loop(self):
+        due = self._initial_due()
+        failures = 0
+        with self._mutex:
+            self._next_at = due
+        while True:
+            if self._wake.wait(max(0.0, due - time.time())):
+                time.sleep(self._debounce)
+            self._wake.clear()
+            try:
+                self.run()
+                failures = 0
+            except Exception as error:
+                # Retry with exponential backoff; the previous wakeup is
+                # already in the past and would spin the loop.
+                failures += 1
+                delay = min(self._retry_delay * (2 ** (failures - 1)), self._max_interval)
+                print(f"[notifications] check failed, retrying in {delay:.0f}s: {error}", flush=True)
+                with self._mutex:
+                    self._next_at = time.time() + delay
+            with self._mutex:
+                due = self._next_at if self._next_at is not None else time.time() + self._max_interval
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._load()
+        self._wake.clear()
+        self._thread = threading.Thread(target=self._loop, name="shp-notifications", daemon=True)
+        self._thread.start()
+
+    def snapshot(self):
+        with self._mutex:
+            return {
+                "lastRunAt": _iso_from_timestamp(self._last_run_at),
+                "nextWakeupAt": _iso_from_timestamp(self._next_at),
+                "storageChangePending": self._wake.is_set(),
+                "runs": self.runs,
+                "lastResults": self._last_results,
+                "wakeups": list(self._wakeups),
+            }
+
+
+_notification_scheduler = _NotificationScheduler(NOTIFICATION_SCHEDULE_FILE, NOTIFICATION_CHECK_INTERVAL_SECONDS)
 
 
 def _send_ha_test_notification():
@@ -888,18 +4070,8 @@ def _send_ha_test_notification():
         "message": "Test notification from Smart Home Planner debug settings.",
         "notification_id": "shp_test_notification",
     }).encode("utf-8")
-    request = Request(
-        url,
-        data=body,
-        headers={
-            "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
-            "Content-Type": "application/json",
-        },
-        method="POST",
-    )
     try:
-        with urlopen(request, timeout=10) as response:
-            response.read()
+        _supervisor_client.request("POST", url, body=body, headers={"Content-Type": "application/json"})
     except Exception as error:
         raise RuntimeError(f"Failed to send test notification: {error}") from error
 
@@ -1089,7 +4261,35 @@ def _normalize_backup_entry(raw):
     }
 
 
-def _build_backup_status_payload(write_debug_dump=False):
+_backup_entry_cache = {}
+_backup_entry_cache_lock = threading.Lock()
+_supervisor_fetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="shp-supervisor-fetch")
+
+
+def _normalize_backup_entries(backups):
+    """Normalize Supervisor backup entries, reusing the result for slugs whose raw entry is unchanged."""
+    normalized = []
+    seen = {}
+    with _backup_entry_cache_lock:
+        for raw in backups:
+            slug = str(raw.get("slug") or "").strip() if isinstance(raw, dict) else ""
+            cached = _backup_entry_cache.get(slug) if slug else None
+            if cached is not None and (cached[0] is raw or cached[0] == raw):
+                entry = cached[1]
+            else:
+                entry = _normalize_backup_entry(raw)
+            if not entry:
+                continue
+            if slug:
+                seen[slug] = (raw, entry)
+            normalized.append(entry)
+        # Only keep backups Supervisor still reports.
+        _backup_entry_cache.clear()
+        _backup_entry_cache.update(seen)
+    return normalized
+
+
+def _build_backup_status_payload(write_debug_dump=False, fresh=False):
     if not SUPERVISOR_TOKEN:
         raise RuntimeError("SUPERVISOR_TOKEN is missing")
 
@@ -1099,7 +4299,7 @@ def _build_backup_status_payload(write_debug_dump=False):
     def safe_fetch(path):
         nonlocal first_error
         try:
-            payload = _fetch_supervisor_json(path)
+            payload = _fetch_supervisor_json(path, fresh=fresh)
             if write_debug_dump:
                 debug_responses[path] = payload
             return payload
@@ -1108,8 +4308,7 @@ def _build_backup_status_payload(write_debug_dump=False):
                 first_error = error
             return None
 
-    info_payload = safe_fetch("/backups/info")
-    backups_payload = safe_fetch("/backups")
+    info_payload, backups_payload = _supervisor_fetch_executor.map(safe_fetch, ["/backups/info", "/backups"])
 
     backups = _extract_backups_list(backups_payload)
     if not backups:
@@ -1117,8 +4316,9 @@ def _build_backup_status_payload(write_debug_dump=False):
 
     # Legacy fallback for older Supervisor versions that still expose snapshots payloads.
     if not backups:
-        legacy_info_payload = safe_fetch("/snapshots/info")
-        legacy_backups_payload = safe_fetch("/snapshots")
+        legacy_info_payload, legacy_backups_payload = _supervisor_fetch_executor.map(
+            safe_fetch, ["/snapshots/info", "/snapshots"]
+        )
         backups = _extract_backups_list(legacy_backups_payload)
         if not backups:
             backups = _extract_backups_list(legacy_info_payload)
@@ -1131,8 +4331,7 @@ def _build_backup_status_payload(write_debug_dump=False):
                 pass
         raise first_error
 
-    normalized_backups = [_normalize_backup_entry(item) for item in backups]
-    normalized_backups = [item for item in normalized_backups if item]
+    normalized_backups = _normalize_backup_entries(backups)
 
     total_backups = len(normalized_backups)
     total_full_backups = len([item for item in normalized_backups if item.get("type") == "full"])
@@ -1195,67 +4394,1003 @@ def _build_backup_status_payload(write_debug_dump=False):
             "includesSmartHomePlannerAddon": latest_backup.get("includesSmartHomePlannerAddon"),
         }
 
-    result = {
-        "totalBackups": total_backups,
-        "totalFullBackups": total_full_backups,
-        "latestBackup": latest_backup_payload,
-        "latestBackupAgeDays": latest_backup_age_days,
-        "hasRecentBackup": has_recent_backup,
-        "hasRecentBackupWithRequiredAddon": has_recent_backup_with_required_addon,
-        "uniqueLocations": unique_locations,
-        "locationsCount": len(unique_locations),
-        "hasSingleLocation": has_single_location,
-        "staleAfterDays": stale_after_days,
-        "requiredAddonSlug": SMART_HOME_PLANNER_ADDON_SLUG,
-    }
-    if write_debug_dump:
+    result = {
+        "totalBackups": total_backups,
+        "totalFullBackups": total_full_backups,
+        "latestBackup": latest_backup_payload,
+        "latestBackupAgeDays": latest_backup_age_days,
+        "hasRecentBackup": has_recent_backup,
+        "hasRecentBackupWithRequiredAddon": has_recent_backup_with_required_addon,
+        "uniqueLocations": unique_locations,
+        "locationsCount": len(unique_locations),
+        "hasSingleLocation": has_single_location,
+        "staleAfterDays": stale_after_days,
+        "requiredAddonSlug": SMART_HOME_PLANNER_ADDON_SLUG,
+    }
+    if write_debug_dump:
+        try:
+            _write_backups_debug(debug_responses)
+        except Exception:
+            pass
+    return result
+
+
+class _BackupStatusCache:
+    """Backup status kept warm by a background thread.
+
+    Requests get the last successful build and its timestamp without
+    touching Supervisor. A failed refresh keeps serving the previous result.
+    Only the very first request, before any build has finished, waits for
+    one. Concurrent waiters share that single build.
+    """
+
+    def __init__(self, interval):
+        self._interval = interval
+        self._mutex = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._payload = None
+        self._built_at = None
+        self._thread = None
+        self.builds = 0
+        self.last_error = None
+
+    def refresh(self, reuse_existing=False):
+        with self._build_lock:
+            if reuse_existing:
+                with self._mutex:
+                    if self._payload is not None:
+                        return self._payload, self._built_at
+            try:
+                # The cache is this class's job; reading through the Supervisor
+                # client's stale window would publish the previous cycle's data.
+                payload = _build_backup_status_payload(write_debug_dump=False, fresh=True)
+            except Exception as error:
+                self.last_error = str(error)
+                raise
+            with self._mutex:
+                self._payload = payload
+                self._built_at = time.time()
+                self.builds += 1
+                self.last_error = None
+                return self._payload, self._built_at
+
+    def get(self):
+        """Return ``(payload, built_at)``; raises if no build has ever succeeded."""
+        with self._mutex:
+            if self._payload is not None:
+                return self._payload, self._built_at
+        return self.refresh(reuse_existing=True)
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                pass
+            time.sleep(self._interval)
+
+    def start(self):
+        if self._thread is not None or not SUPERVISOR_TOKEN:
+            return
+        self._thread = threading.Thread(target=self._refresh_loop, name="shp-backup-status", daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        with self._mutex:
+            return {
+                "builtAt": self._built_at,
+                "builds": self.builds,
+                "refreshSeconds": self._interval,
+                "lastError": self.last_error,
+            }
+
+
+_backup_status_cache = _BackupStatusCache(BACKUP_STATUS_REFRESH_SECONDS)
+
+
+def _accepts_gzip(accept_encoding_header):
+    for token in str(accept_encoding_header or "").split(","):
+        coding, _, params = token.strip().partition(";")
+        if coding.strip().lower() not in {"gzip", "*"}:
+            continue
+        quality = params.strip().lower()
+        if quality.startswith("q="):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+class _JsonCompressor:
+    """gzip for JSON responses, caching the compressed bytes per named slot.
+
+    A slot (``"storage"``, ``"registry:devices"``) keeps only the bytes for its
+    latest key (storage ETag, registry mtime), so repeated GETs of an unchanged
+    document are served without recompressing.
+    """
+
+    def __init__(self, level, min_bytes):
+        self._level = level
+        self._min_bytes = min_bytes
+        self._mutex = threading.Lock()
+        self._slots = {}
+        self._responses = 0
+        self._cache_hits = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._seconds = 0.0
+
+    def compress(self, body, slot=None, key=None):
+        """Return gzip bytes for ``body``, or ``None`` when it is below the threshold."""
+        if self._min_bytes <= 0 or len(body) < self._min_bytes:
+            return None
+        if slot is not None:
+            with self._mutex:
+                cached = self._slots.get(slot)
+                if cached is not None and cached[0] == key and cached[1] == len(body):
+                    self._responses += 1
+                    self._cache_hits += 1
+                    self._bytes_in += len(body)
+                    self._bytes_out += len(cached[2])
+                    return cached[2]
+        started = time.perf_counter()
+        compressed = gzip.compress(body, compresslevel=self._level, mtime=0)
+        elapsed = time.perf_counter() - started
+        with self._mutex:
+            self._responses += 1
+            self._bytes_in += len(body)
+            self._bytes_out += len(compressed)
+            self._seconds += elapsed
+            if slot is not None:
+                self._slots[slot] = (key, len(body), compressed)
+        return compressed
+
+    def stats(self):
+        with self._mutex:
+            compressed_count = self._responses - self._cache_hits
+            return {
+                "level": self._level,
+                "minBytes": self._min_bytes,
+                "responses": self._responses,
+                "cacheHits": self._cache_hits,
+                "bytesIn": self._bytes_in,
+                "bytesOut": self._bytes_out,
+                "ratio": round(self._bytes_in / self._bytes_out, 2) if self._bytes_out else None,
+                "compressSeconds": round(self._seconds, 4),
+                "avgCompressMs": round(self._seconds * 1000 / compressed_count, 3) if compressed_count else None,
+                "cachedSlots": {slot: len(entry[2]) for slot, entry in self._slots.items()},
+            }
+
+
+_json_compressor = _JsonCompressor(JSON_GZIP_LEVEL, JSON_GZIP_MIN_BYTES)
+
+
+STATIC_COMPRESSIBLE_EXTENSIONS = {".html", ".js", ".css", ".svg", ".json", ".webmanifest", ".txt", ".ico"}
+STATIC_ASSET_REFERENCE_PATTERN = re.compile(r'(\b(?:src|href)=")((?:js|css|img)/[^"?#]+)(")')
+# Minimum gap between walks of WEB_ROOT looking for edited or new files.
+STATIC_RESCAN_INTERVAL_SECONDS = max(0.0, float(os.environ.get("SHP_STATIC_RESCAN_SECONDS", "2")))
+# Rewritten HTML and gzipped variants; rebuilt on start, so kept out of DATA_DIR and exports.
+STATIC_CACHE_DIR = os.environ.get("SHP_STATIC_CACHE_DIR", os.path.join(tempfile.gettempdir(), "shp-static"))
+
+
+class _StaticAssets:
+    """Fingerprint index of WEB_ROOT.
+
+    Only stat keys, hashes and file paths are held in memory; bodies are
+    streamed from disk. HTML pages are rewritten so their js/css/img
+    references carry ``?v=<hash>`` and, like gzipped variants of
+    compressible files, written once to STATIC_CACHE_DIR under their ETag.
+    A request whose ``v`` matches the current hash can be cached as
+    immutable, anything else is revalidated with the ETag. WEB_ROOT is
+    re-walked at most every STATIC_RESCAN_INTERVAL_SECONDS and files whose
+    mtime or size changed are re-hashed, so edits still show up without a
+    restart.
+    """
+
+    def __init__(self, root, cache_dir=STATIC_CACHE_DIR, rescan_interval=STATIC_RESCAN_INTERVAL_SECONDS):
+        self._root = root
+        self._cache_dir = cache_dir
+        self._rescan_interval = rescan_interval
+        self._mutex = threading.Lock()
+        self._assets = None
+        self._scanned_at = None
+
+    def _load_asset(self, rel_path, stat):
+        digest = hashlib.sha256()
+        with open(os.path.join(self._root, rel_path), "rb") as handle:
+            for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return {
+            "key": (stat.st_mtime_ns, stat.st_size),
+            "hash": digest.hexdigest()[:16],
+        }
+
+    def _write_cache_file(self, name, source):
+        """Copy ``source`` (a readable binary file) into the cache as ``name``."""
+        target_path = os.path.join(self._cache_dir, name)
+        os.makedirs(self._cache_dir, exist_ok=True)
+        temp_path = f"{target_path}.{secrets.token_hex(4)}.tmp"
+        try:
+            with open(temp_path, "wb") as handle:
+                shutil.copyfileobj(source, handle, 1024 * 1024)
+            os.replace(temp_path, target_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        return target_path
+
+    def _gzip_cache_file(self, etag, path):
+        target_path = os.path.join(self._cache_dir, f"{etag}.gz")
+        temp_path = f"{target_path}.{secrets.token_hex(4)}.tmp"
+        os.makedirs(self._cache_dir, exist_ok=True)
+        try:
+            with open(path, "rb") as source, open(temp_path, "wb") as raw_handle:
+                with gzip.GzipFile(fileobj=raw_handle, mode="wb", compresslevel=9, mtime=0) as handle:
+                    shutil.copyfileobj(source, handle, 1024 * 1024)
+                smaller = raw_handle.tell() < os.fstat(source.fileno()).st_size
+            if not smaller:
+                os.remove(temp_path)
+                return None
+            os.replace(temp_path, target_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return None
+        return target_path
+
+    def _scan_locked(self):
+        self._scanned_at = time.monotonic()
+        previous = self._assets or {}
+        assets = {}
+        changed = False
+        for root, _dirs, files in os.walk(self._root):
+            for filename in files:
+                full_path = os.path.join(root, filename)
+                rel_path = os.path.relpath(full_path, self._root).replace(os.sep, "/")
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    continue
+                asset = previous.get(rel_path)
+                if asset is None or asset["key"] != (stat.st_mtime_ns, stat.st_size):
+                    try:
+                        asset = self._load_asset(rel_path, stat)
+                    except OSError:
+                        continue
+                    changed = True
+                assets[rel_path] = asset
+        if not changed and assets.keys() == previous.keys():
+            return
+        for rel_path, asset in list(assets.items()):
+            full_path = os.path.join(self._root, rel_path)
+            if rel_path.endswith(".html"):
+                try:
+                    with open(full_path, "rb") as handle:
+                        body = self._fingerprint_references(rel_path, handle.read(), assets)
+                except (OSError, UnicodeDecodeError):
+                    del assets[rel_path]
+                    continue
+                etag = hashlib.sha256(body).hexdigest()[:16]
+                if asset.get("etag") == etag:
+                    continue
+                try:
+                    path = self._write_cache_file(f"{etag}.html", io.BytesIO(body))
+                except OSError:
+                    del assets[rel_path]
+                    continue
+            else:
+                etag = asset["hash"]
+                if asset.get("etag") == etag:
+                    continue
+                path = full_path
+            asset["etag"] = etag
+            asset["path"] = path
+            asset["gzipPath"] = None
+            if os.path.splitext(rel_path)[1].lower() in STATIC_COMPRESSIBLE_EXTENSIONS:
+                asset["gzipPath"] = self._gzip_cache_file(etag, path)
+        self._assets = assets
+        self._prune_cache_locked()
+
+    def _prune_cache_locked(self):
+        live = set()
+        for asset in self._assets.values():
+            live.add(asset["path"])
+            live.add(asset["gzipPath"])
+        try:
+            names = os.listdir(self._cache_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self._cache_dir, name)
+            if path not in live:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _fingerprint_references(rel_path, body, assets):
+        base_dir = os.path.dirname(rel_path)
+
+        def replace(match):
+            target = os.path.normpath(os.path.join(base_dir, match.group(2))).replace(os.sep, "/")
+            asset = assets.get(target)
+            if asset is None:
+                return match.group(0)
+            return f"{match.group(1)}{match.group(2)}?v={asset['hash']}{match.group(3)}"
+
+        return STATIC_ASSET_REFERENCE_PATTERN.sub(replace, body.decode("utf-8")).encode("utf-8")
+
+    def load(self):
+        with self._mutex:
+            self._scan_locked()
+
+    def get(self, url_path, force_scan=False):
+        rel_path = unquote(str(url_path or "")).lstrip("/")
+        if not rel_path or rel_path.endswith("/"):
+            rel_path = f"{rel_path}index.html"
+        rel_path = os.path.normpath(rel_path).replace(os.sep, "/")
+        if rel_path.startswith(".."):
+            return None, None
+        with self._mutex:
+            if force_scan:
+                # The caller found a file that no longer matches its entry;
+                # rebuild everything so cache files are rewritten as well.
+                self._assets = None
+                self._scan_locked()
+            # HTML embeds other files' hashes and misses may be new files, so
+            # both can trigger a walk; the interval keeps page loads and
+            # 404 probes from walking WEB_ROOT on every request.
+            elif self._scanned_at is None or time.monotonic() - self._scanned_at >= self._rescan_interval:
+                asset = (self._assets or {}).get(rel_path)
+                stale = asset is None or rel_path.endswith(".html")
+                if not stale:
+                    try:
+                        stat = os.stat(os.path.join(self._root, rel_path))
+                        stale = asset["key"] != (stat.st_mtime_ns, stat.st_size)
+                    except OSError:
+                        stale = True
+                if stale:
+                    self._scan_locked()
+            asset = (self._assets or {}).get(rel_path)
+        return rel_path, asset
+
+    def open(self, asset, use_gzip=False):
+        """Open the body ``asset`` describes, or None if it changed on disk since the scan."""
+        path = asset["gzipPath"] if use_gzip else asset["path"]
+        try:
+            handle = open(path, "rb")
+        except OSError:
+            return None
+        if path.startswith(self._cache_dir + os.sep):
+            return handle
+        stat = os.fstat(handle.fileno())
+        if (stat.st_mtime_ns, stat.st_size) != asset["key"]:
+            handle.close()
+            return None
+        return handle
+
+
+_static_assets = _StaticAssets(WEB_ROOT)
+
+
+def _request_route_key(path):
+    normalized = str(path or "").split("?", 1)[0] or "/"
+    entity_match = STORAGE_ENTITY_PATH_PATTERN.match(normalized)
+    if entity_match:
+        # The kind is one of a fixed few, so it can stay in the key.
+        return f"/api/storage/{entity_match.group(1)}/{{id}}" if entity_match.group(2) else normalized
+    if DEVICE_UPLOAD_PATH_PATTERN.match(normalized):
+        return "/api/device-files/uploads/{id}"
+    if normalized.startswith("/api/ha/") and normalized[len("/api/ha/"):] in REGISTRY_FILES:
+        return "/api/ha/{registry}"
+    if normalized.startswith("/api/"):
+        return normalized if normalized in KNOWN_API_ROUTES else "/api/*"
+    return "static"
+
+
+class _RequestTracker:
+    """Counts in-flight requests per route so slow routes are visible at a glance."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._started = {}
+        self._completed = {}
+        self._rejected = {}
+
+    def begin(self, method, route):
+        key = f"{method} {route}"
+        token = (key, time.monotonic())
+        with self._lock:
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            self._started.setdefault(key, []).append(token[1])
+        return token
+
+    def end(self, token):
+        key, started_at = token
+        with self._lock:
+            remaining = self._in_flight.get(key, 0) - 1
+            if remaining > 0:
+                self._in_flight[key] = remaining
+            else:
+                self._in_flight.pop(key, None)
+            started = self._started.get(key) or []
+            try:
+                started.remove(started_at)
+            except ValueError:
+                pass
+            if not started:
+                self._started.pop(key, None)
+            self._completed[key] = self._completed.get(key, 0) + 1
+
+    def reject(self, method, route):
+        key = f"{method} {route}"
+        with self._lock:
+            self._rejected[key] = self._rejected.get(key, 0) + 1
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            routes = {}
+            for key in set(self._in_flight) | set(self._completed) | set(self._rejected):
+                started = self._started.get(key) or []
+                routes[key] = {
+                    "inFlight": self._in_flight.get(key, 0),
+                    "oldestSeconds": round(now - min(started), 3) if started else None,
+                    "completed": self._completed.get(key, 0),
+                    "rejected": self._rejected.get(key, 0),
+                }
+        return dict(sorted(routes.items()))
+
+
+_request_tracker = _RequestTracker()
+_bulk_request_slots = threading.BoundedSemaphore(SERVER_BULK_WORKERS)
+
+
+class BoundedThreadingHTTPServer(HTTPServer):
+    """HTTPServer that hands each connection to a fixed worker pool.
+
+    Connections beyond the workers plus ``max_queued`` waiting slots are answered
+    with 503 right away instead of piling up behind a slow request.
+    """
+
+    def __init__(self, server_address, handler_class, workers, max_queued, backlog):
+        self.request_queue_size = backlog
+        self.workers = workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shp-http")
+        self._pending_lock = threading.Lock()
+        self._pending = 0
+        self._active = 0
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        with self._pending_lock:
+            if self._pending >= self.workers + self.max_queued:
+                overloaded = True
+            else:
+                overloaded = False
+                self._pending += 1
+        if overloaded:
+            _request_tracker.reject("*", "overloaded")
+            try:
+                request.sendall(
+                    b"HTTP/1.1 503 Service Unavailable\r\n"
+                    b"Retry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+                )
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self._executor.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        with self._pending_lock:
+            self._active += 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._pending_lock:
+                self._active -= 1
+                self._pending -= 1
+
+    def pool_snapshot(self):
+        with self._pending_lock:
+            return {
+                "workers": self.workers,
+                "active": self._active,
+                "queued": max(0, self._pending - self._active),
+                "maxQueued": self.max_queued,
+            }
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AppHandler(SimpleHTTPRequestHandler):
+    _request_token = None
+    _holds_bulk_slot = False
+    _static_cache_headers_sent = False
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        route = _request_route_key(self.path)
+        if route in BULK_REQUEST_ROUTES:
+            if not _bulk_request_slots.acquire(blocking=False):
+                _request_tracker.reject(self.command, route)
+                self.close_connection = True
+                self.send_response(503)
+                self.send_header("Retry-After", "2")
+                self.send_header("Content-Type", "application/json")
+                body = json.dumps({"error": "Server is busy with other transfers. Try again shortly."}).encode("utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return False
+            self._holds_bulk_slot = True
+        self._request_token = _request_tracker.begin(self.command, route)
+        return True
+
+    def handle_one_request(self):
+        # The handler lives for the whole keep-alive connection; the flag
+        # belongs to a single response.
+        self._static_cache_headers_sent = False
+        try:
+            super().handle_one_request()
+        finally:
+            if self._request_token is not None:
+                _request_tracker.end(self._request_token)
+                self._request_token = None
+            if self._holds_bulk_slot:
+                _bulk_request_slots.release()
+                self._holds_bulk_slot = False
+
+    def end_headers(self):
+        parsed = urlparse(self.path)
+        path = parsed.path or ""
+        if not path.startswith("/api/") and not self._static_cache_headers_sent:
+            ext = os.path.splitext(path)[1].lower()
+            if ext in {".js", ".css"}:
+                self.send_header("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0, private")
+                self.send_header("Pragma", "no-cache")
+                self.send_header("Expires", "0")
+            elif ext == ".html" or path in {"", "/"} or path.endswith("/"):
+                self.send_header("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0, private")
+                self.send_header("Pragma", "no-cache")
+                self.send_header("Expires", "0")
+        super().end_headers()
+
+    def _send_json(self, status, payload, headers=None, compression_slot=None, compression_key=None):
+        self._send_json_bytes(
+            status, _json_encode(payload), headers=headers,
+            compression_slot=compression_slot, compression_key=compression_key,
+        )
+
+    def _send_json_bytes(self, status, body, headers=None, compression_slot=None, compression_key=None):
+        """Send JSON, gzipped when the client accepts it and the body is large enough.
+
+        ``compression_slot``/``compression_key`` let callers with a version for
+        ``body`` (storage ETag, registry mtime) reuse the compressed bytes.
+        """
+        compressed = None
+        if _accepts_gzip(self.headers.get("Accept-Encoding")):
+            compressed = _json_compressor.compress(body, compression_slot, compression_key)
+        if compressed is not None:
+            body = compressed
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if not (isinstance(headers, dict) and "Cache-Control" in headers):
+            self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", str(len(body)))
+        if compressed is not None:
+            self.send_header("Content-Encoding", "gzip")
+        if JSON_GZIP_MIN_BYTES > 0:
+            self.send_header("Vary", "Accept-Encoding")
+        if isinstance(headers, dict):
+            for key, value in headers.items():
+                if value is None:
+                    continue
+                self.send_header(str(key), str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_device_file(self, query, head_only=False):
+        requested_path = (query.get("path") or [""])[0]
+        download_mode = ((query.get("download") or [""])[0]).strip().lower() in {"1", "true", "yes"}
+        try:
+            full_path, safe_path = _resolve_device_file(requested_path)
+        except ValueError as error:
+            self._send_json(400, {"error": str(error)})
+            return
+        except FileNotFoundError:
+            self._send_json(404, {"error": "File not found"})
+            return
+
+        size_name = ((query.get("size") or [""])[0]).strip().lower()
+        # Set when a rendition was requested but the original is served instead.
+        fallback_size = None
+        if size_name and size_name != "original":
+            if size_name not in DERIVATIVE_SIZES:
+                self._send_json(400, {"error": f"Unsupported size: {size_name}"})
+                return
+            try:
+                derivative_path = _derivative_store.get(full_path, size_name)
+            except OSError:
+                derivative_path = None
+            if derivative_path is not None:
+                full_path = derivative_path
+                safe_path = f"{os.path.splitext(safe_path)[0]}{os.path.splitext(derivative_path)[1]}"
+            else:
+                fallback_size = size_name
+
+        try:
+            handle = open(full_path, "rb")
+        except FileNotFoundError:
+            self._send_json(404, {"error": "File not found"})
+            return
+        except OSError as error:
+            self._send_json(500, {"error": f"Unable to read file: {error}"})
+            return
+        with handle:
+            # Validators come from the open descriptor, so a concurrent rename
+            # or delete cannot pair one file's headers with another's bytes.
+            stat = os.fstat(handle.fileno())
+            file_size = stat.st_size
+            etag = _device_file_etag(stat)
+            if fallback_size is not None:
+                # The original standing in for a rendition must not be cached as
+                # that rendition: revalidate every time, so the real thumbnail
+                # replaces it once it can be rendered.
+                etag = f"{etag[:-1]}-{fallback_size}\""
+            file_name = os.path.basename(safe_path).replace('"', "_")
+            content_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+            disposition = "attachment" if download_mode else "inline"
+            if fallback_size is None and UNIQUE_DEVICE_FILE_NAME_PATTERN.search(file_name):
+                cache_control = "private, max-age=31536000, immutable"
+            else:
+                cache_control = "private, no-cache"
+            validators = {
+                "ETag": etag,
+                "Cache-Control": cache_control,
+                "Accept-Ranges": "bytes",
+            }
+            if fallback_size is None:
+                validators["Last-Modified"] = formatdate(stat.st_mtime, usegmt=True)
+
+            if_none_match = self.headers.get("If-None-Match")
+            if (if_none_match and _if_match_allows_current(if_none_match, etag)) or (
+                not if_none_match
+                and fallback_size is None
+                and _not_modified_since(self.headers.get("If-Modified-Since"), stat.st_mtime)
+            ):
+                self.send_response(304)
+                for key, value in validators.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                return
+
+            ranges = None
+            if self.headers.get("Range") and _if_range_allows(self.headers.get("If-Range"), etag, stat.st_mtime):
+                try:
+                    ranges = _parse_byte_ranges(self.headers.get("Range"), file_size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{file_size}")
+                    self.send_header("Content-Length", "0")
+                    for key, value in validators.items():
+                        self.send_header(key, value)
+                    self.end_headers()
+                    return
+
+            parts = []
+            if ranges is None:
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(file_size))
+                parts.append((b"", 0, file_size))
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_response(206)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{file_size}")
+                self.send_header("Content-Length", str(end - start + 1))
+                parts.append((b"", start, end - start + 1))
+            else:
+                boundary = secrets.token_hex(12)
+                for start, end in ranges:
+                    part_header = (
+                        f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n"
+                        f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n"
+                    ).encode("ascii")
+                    parts.append((part_header, start, end - start + 1))
+                closing = f"\r\n--{boundary}--\r\n".encode("ascii")
+                self.send_response(206)
+                self.send_header("Content-Type", f"multipart/byteranges; boundary={boundary}")
+                self.send_header(
+                    "Content-Length",
+                    str(sum(len(prefix) + count for prefix, _start, count in parts) + len(closing)),
+                )
+            self.send_header("Content-Disposition", f'{disposition}; filename="{file_name}"')
+            for key, value in validators.items():
+                self.send_header(key, value)
+            self.end_headers()
+            if head_only:
+                return
+            try:
+                for prefix, start, count in parts:
+                    if prefix:
+                        self.wfile.write(prefix)
+                    # socket.sendfile uses the kernel's sendfile(2) when it can
+                    # and falls back to a read/send loop otherwise.
+                    self.wfile.flush()
+                    self.connection.sendfile(handle, start, count)
+                if len(parts) > 1:
+                    self.wfile.write(closing)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+    def _send_static_asset(self, parsed, head_only=False):
+        """Serve a WEB_ROOT file from the fingerprint index, streaming it from disk; False if unknown."""
+        rel_path, asset = _static_assets.get(parsed.path)
+        if asset is None:
+            return False
+        use_gzip = asset["gzipPath"] is not None and _accepts_gzip(self.headers.get("Accept-Encoding"))
+        handle = _static_assets.open(asset, use_gzip)
+        if handle is None:
+            rel_path, asset = _static_assets.get(parsed.path, force_scan=True)
+            if asset is None:
+                return False
+            use_gzip = asset["gzipPath"] is not None and _accepts_gzip(self.headers.get("Accept-Encoding"))
+            handle = _static_assets.open(asset, use_gzip)
+            if handle is None:
+                return False
+        with handle:
+            requested_version = (parse_qs(parsed.query).get("v") or [""])[0]
+            if requested_version and requested_version == asset["hash"]:
+                cache_control = "public, max-age=31536000, immutable"
+            else:
+                cache_control = "no-cache"
+            etag = f"\"{asset['etag']}{'-gz' if use_gzip else ''}\""
+            self._static_cache_headers_sent = True
+
+            if_none_match = self.headers.get("If-None-Match")
+            if if_none_match and _if_match_allows_current(if_none_match, etag):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", cache_control)
+                self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return True
+
+            size = os.fstat(handle.fileno()).st_size
+            self.send_response(200)
+            self.send_header("Content-Type", self.guess_type(rel_path))
+            self.send_header("Content-Length", str(size))
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", cache_control)
+            self.send_header("Vary", "Accept-Encoding")
+            if use_gzip:
+                self.send_header("Content-Encoding", "gzip")
+            self.end_headers()
+            if head_only:
+                return True
+            try:
+                self.wfile.flush()
+                self.connection.sendfile(handle, 0, size)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+        return True
+
+    def _send_registry(self, name):
+        entry = _registry_cache.get(name)
+        headers = {"ETag": entry["etag"], "Cache-Control": "no-cache"}
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match and _if_match_allows_current(if_none_match, entry["etag"]):
+            self.send_response(304)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            return
+        self._send_json_bytes(
+            200, entry["body"], headers=headers, compression_slot=f"registry:{name}", compression_key=entry["etag"]
+        )
+
+    def _send_registries(self, query):
+        """All (or ``names=``) registries in one response.
+
+        Registries whose ETag the client lists in If-None-Match come back as
+        ``{"etag": ..., "unchanged": true}`` without items; 304 if none changed.
+        """
+        raw_names = ",".join(query.get("names") or []) or ",".join(REGISTRY_FILES)
+        names = [name.strip() for name in raw_names.split(",") if name.strip()]
+        unknown = [name for name in names if name not in REGISTRY_FILES]
+        if unknown:
+            self._send_json(400, {"error": f"Unknown registry: {unknown[0]}"})
+            return
+        entries = {name: _registry_cache.get(name) for name in names}
+        combined_etag = "\"rs-{}\"".format(
+            hashlib.sha256("|".join(f"{name}={entry['etag']}" for name, entry in entries.items()).encode("utf-8"))
+            .hexdigest()[:20]
+        )
+        known = {token.strip() for token in str(self.headers.get("If-None-Match") or "").split(",") if token.strip()}
+        headers = {"ETag": combined_etag, "Cache-Control": "no-cache"}
+        if combined_etag in known or (known and all(entry["etag"] in known for entry in entries.values())):
+            self.send_response(304)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            return
+
+        # Splice the cached per-registry bytes instead of re-encoding them.
+        parts = []
+        for name, entry in entries.items():
+            prefix = _json_encode(name) + b':{"etag":' + _json_encode(entry["etag"])
+            if entry["etag"] in known:
+                parts.append(prefix + b',"unchanged":true}')
+            else:
+                parts.append(prefix + b',"items":' + entry["body"] + b"}")
+        body = b'{"registries":{' + b",".join(parts) + b"}}"
+        self._send_json_bytes(200, body, headers=headers)
+
+    def _update_ha_devices_batch(self):
+        """PUT /api/ha/devices/batch: ``{"operations": [{id, name?, areaId?, labels?}, ...]}``.
+
+        Operations are coalesced per device and run concurrently through the
+        update worker. With ``Accept: application/x-ndjson`` each result is
+        streamed as one line as soon as it finishes, followed by a summary line.
+        """
+        length = int(self.headers.get("Content-Length", "0"))
+        body = self.rfile.read(length) if length else b"{}"
         try:
-            _write_backups_debug(debug_responses)
-        except Exception:
-            pass
-    return result
+            payload = json.loads(body.decode("utf-8") or "{}")
+        except json.JSONDecodeError:
+            self.send_error(400, "Invalid JSON")
+            return
+        operations = payload.get("operations") if isinstance(payload, dict) else payload
+        if not isinstance(operations, list):
+            self._send_json(400, {"error": "Missing required field: operations"})
+            return
+        if len(operations) > MAX_HA_BATCH_OPERATIONS:
+            self._send_json(413, {"error": f"Too many operations. Max allowed is {MAX_HA_BATCH_OPERATIONS}."})
+            return
 
+        updates, rejected = _coalesce_ha_device_operations(operations)
+        summary = {"operations": len(operations), "devices": len(updates), "succeeded": 0, "failed": len(rejected)}
 
-class AppHandler(SimpleHTTPRequestHandler):
-    def end_headers(self):
-        parsed = urlparse(self.path)
-        path = parsed.path or ""
-        if not path.startswith("/api/"):
-            ext = os.path.splitext(path)[1].lower()
-            if ext in {".js", ".css"}:
-                self.send_header("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0, private")
-                self.send_header("Pragma", "no-cache")
-                self.send_header("Expires", "0")
-            elif ext == ".html" or path in {"", "/"} or path.endswith("/"):
-                self.send_header("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0, private")
-                self.send_header("Pragma", "no-cache")
-                self.send_header("Expires", "0")
-        super().end_headers()
+        def count(item):
+            if item.get("ok"):
+                summary["succeeded"] += 1
+            elif "index" not in item:
+                summary["failed"] += 1
+            return item
 
-    def _send_json(self, status, payload, headers=None):
-        body = json.dumps(payload).encode("utf-8")
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json")
+        if "application/x-ndjson" not in str(self.headers.get("Accept") or ""):
+            results = rejected + [count(item) for item in _run_ha_device_batch(updates)]
+            summary["ok"] = summary["failed"] == 0
+            self._send_json(200, {**summary, "results": results})
+            return
+
+        self.protocol_version = "HTTP/1.1"
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
         self.send_header("Cache-Control", "no-store")
-        self.send_header("Content-Length", str(len(body)))
-        if isinstance(headers, dict):
-            for key, value in headers.items():
-                if value is None:
-                    continue
-                self.send_header(str(key), str(value))
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
         self.end_headers()
-        self.wfile.write(body)
+        writer = _ChunkedWriter(self.wfile)
+        try:
+            for item in rejected:
+                writer.write(_json_encode(item) + b"\n")
+            writer.flush()
+            for item in _run_ha_device_batch(updates):
+                writer.write(_json_encode(count(item)) + b"\n")
+                writer.flush()
+            summary["ok"] = summary["failed"] == 0
+            writer.write(_json_encode({"summary": summary}) + b"\n")
+            writer.close()
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+    def _send_maintenance_upcoming(self, query):
+        """GET /api/maintenance/upcoming?days=N&kind=battery,warranty,test&offset=&limit=.
+
+        Items are ordered by due date. Batteries and tests that are already
+        due are included unless ``due=0``; expired warranties are not.
+        """
+        raw_kinds = ",".join(query.get("kind") or []) or ",".join(MAINTENANCE_KINDS)
+        kinds = [kind.strip() for kind in raw_kinds.split(",") if kind.strip()]
+        unknown = [kind for kind in kinds if kind not in MAINTENANCE_KINDS]
+        if unknown:
+            self._send_json(400, {"error": f"Unknown maintenance kind: {unknown[0]}"})
+            return
+        try:
+            days = float((query.get("days") or ["30"])[0])
+            offset = int((query.get("offset") or ["0"])[0])
+            limit = int((query.get("limit") or ["100"])[0])
+        except ValueError:
+            self._send_json(400, {"error": "days, offset and limit must be numbers"})
+            return
+        if not math.isfinite(days) or days < 0 or offset < 0 or limit <= 0:
+            self._send_json(400, {"error": "Invalid days, offset or limit"})
+            return
+        days = min(days, 3650.0)
+        limit = min(limit, 1000)
+        include_due = ((query.get("due") or ["1"])[0]).strip().lower() not in {"0", "false", "no"}
+
+        now = time.time()
+        entries = _maintenance_index.upcoming(now, now + days * 86400, kinds, include_due)
+        items = []
+        for entry in entries[offset : offset + limit]:
+            due_at, alert_at = entry["dueAt"], entry["alertAt"]
+            if due_at is None:
+                status = "neverRun"
+            elif now >= due_at:
+                status = "due"
+            elif now >= alert_at:
+                status = "dueSoon"
+            else:
+                status = "upcoming"
+            items.append(
+                {
+                    "kind": entry["kind"],
+                    "id": entry["id"],
+                    "name": entry["name"],
+                    "dueAt": _iso_from_timestamp(due_at),
+                    "alertAt": _iso_from_timestamp(alert_at),
+                    "daysUntilDue": None if due_at is None else math.floor((due_at - now) / 86400),
+                    "status": status,
+                }
+            )
+        next_offset = offset + limit if offset + limit < len(entries) else None
+        self._send_json(
+            200,
+            {"items": items, "total": len(entries), "offset": offset, "limit": limit, "nextOffset": next_offset},
+        )
+
+    def do_HEAD(self):
+        parsed = urlparse(self.path)
+        if parsed.path == "/api/device-files/content":
+            self._send_device_file(parse_qs(parsed.query), head_only=True)
+            return
+        if not parsed.path.startswith("/api/") and self._send_static_asset(parsed, head_only=True):
+            return
+        super().do_HEAD()
 
     def do_GET(self):
         parsed = urlparse(self.path)
         path = parsed.path
         query = parse_qs(parsed.query)
 
+        entity_match = STORAGE_ENTITY_PATH_PATTERN.match(path)
+        if entity_match:
+            self._handle_storage_entity(entity_match.group(1), entity_match.group(2))
+            return
+
         if path == "/api/storage":
             with _lock:
-                payload = _read_storage()
-                etag = _build_storage_etag(payload)
-            self._send_json(200, payload, headers={"ETag": etag})
+                payload, cache_hit, etag = _read_storage_cached()
+            body = _storage_cache.encoded(payload)
+            self._send_json_bytes(
+                200,
+                body,
+                headers={"ETag": etag, "X-Storage-Cache": "hit" if cache_hit else "miss"},
+                compression_slot="storage",
+                compression_key=etag,
+            )
             return
 
         if path == "/api/runtime":
@@ -1269,6 +5404,34 @@ class AppHandler(SimpleHTTPRequestHandler):
             )
             return
 
+        if path == "/api/server/requests":
+            pool = self.server.pool_snapshot() if hasattr(self.server, "pool_snapshot") else None
+            self._send_json(
+                200,
+                {
+                    "mode": SERVER_MODE,
+                    "pool": pool,
+                    "bulkWorkers": SERVER_BULK_WORKERS,
+                    "routes": _request_tracker.snapshot(),
+                    "storageCache": _storage_cache.stats(),
+                    "jsonCompression": _json_compressor.stats(),
+                    "registryCache": _registry_cache.stats(),
+                    "haUpdateWorker": _ha_update_worker.stats(),
+                    "supervisorClient": _supervisor_client.stats(),
+                    "backupStatus": _backup_status_cache.stats(),
+                    "maintenanceIndex": _maintenance_index.stats(),
+                },
+            )
+            return
+
+        if path == "/api/maintenance/upcoming":
+            self._send_maintenance_upcoming(query)
+            return
+
+        if path == "/api/notifications/schedule":
+            self._send_json(200, _notification_scheduler.snapshot())
+            return
+
         if path == "/api/ha/config":
             try:
                 payload = _fetch_ha_config()
@@ -1284,101 +5447,125 @@ class AppHandler(SimpleHTTPRequestHandler):
             debug_dump = ((query.get("debugDump") or [""])[0]).strip().lower() in {"1", "true", "yes"}
             should_write_debug_dump = bool(debug_dump and IS_LOCAL_RUNTIME)
             try:
-                payload = _build_backup_status_payload(write_debug_dump=should_write_debug_dump)
+                if should_write_debug_dump:
+                    payload, built_at = _build_backup_status_payload(write_debug_dump=True), time.time()
+                else:
+                    payload, built_at = _backup_status_cache.get()
             except RuntimeError as error:
                 message = str(error)
                 status = 503 if "SUPERVISOR_TOKEN" in message else 502
                 self._send_json(status, {"error": message})
                 return
-            self._send_json(200, payload)
-            return
-
-        if path == "/api/ha/areas":
-            with _lock:
-                payload = _read_registry(AREAS_FILE)
-            self._send_json(200, payload)
+            age = max(0.0, time.time() - built_at)
+            self._send_json(
+                200,
+                {
+                    **payload,
+                    "generatedAt": datetime.datetime.fromtimestamp(built_at, datetime.timezone.utc).isoformat(),
+                    "ageSeconds": round(age, 1),
+                },
+                headers={"Age": str(int(age))},
+            )
             return
 
-        if path == "/api/ha/floors":
-            with _lock:
-                payload = _read_registry(FLOORS_FILE)
-            self._send_json(200, payload)
+        if path.startswith("/api/ha/") and path[len("/api/ha/"):] in REGISTRY_FILES:
+            self._send_registry(path[len("/api/ha/"):])
             return
 
-        if path == "/api/ha/devices":
-            with _lock:
-                payload = _read_registry(DEVICES_FILE)
-            self._send_json(200, payload)
+        if path == "/api/ha/registries":
+            self._send_registries(query)
             return
 
-        if path == "/api/ha/labels":
-            with _lock:
-                payload = _read_registry(LABELS_FILE)
-            self._send_json(200, payload)
+        if path == "/api/export/manifest":
+            try:
+                _storage_raw, files, storage_etag = _snapshot_export()
+                # Read-only: only an export's manifest can be a since= base.
+                manifest = _build_export_manifest(files, storage_etag)
+            except Exception as error:
+                self._send_json(500, {"error": f"Unable to build export manifest: {error}"})
+                return
+            self._send_json(200, manifest)
             return
 
         if path == "/api/export":
-            archive_path = ""
             try:
-                with _lock:
-                    archive_path, archive_name = _create_export_archive()
-                archive_size = os.path.getsize(archive_path)
-                self.send_response(200)
-                self.send_header("Content-Type", "application/x-tar")
-                self.send_header("Cache-Control", "no-store")
-                self.send_header("Content-Disposition", f'attachment; filename="{archive_name}"')
-                self.send_header("Content-Length", str(archive_size))
-                self.end_headers()
-                with open(archive_path, "rb") as handle:
-                    while True:
-                        chunk = handle.read(1024 * 64)
-                        if not chunk:
-                            break
-                        self.wfile.write(chunk)
+                archive_format, level = _parse_export_options(query)
+                since = ((query.get("since") or [""])[0]).strip()
+                base_manifest = _load_export_manifest(since) if since else None
+            except ValueError as error:
+                self._send_json(400, {"error": str(error)})
                 return
+            extra_members = []
+            try:
+                storage_raw, files, storage_etag = _snapshot_export()
+                if base_manifest is not None:
+                    files, descriptor, manifest = _plan_incremental_export(files, base_manifest, storage_etag)
+                    extra_members.append((EXPORT_MANIFEST_MEMBER, _json_encode(descriptor)))
+                else:
+                    # A full export is the first since= anchor a client gets.
+                    manifest = _build_export_manifest(files, storage_etag)
+                _store_export_manifest(manifest)
+                manifest_id = manifest["id"]
+                duplicates = _find_duplicate_export_files(files)
             except Exception as error:
                 self._send_json(500, {"error": f"Unable to create export archive: {error}"})
                 return
-            finally:
-                if archive_path:
-                    try:
-                        os.remove(archive_path)
-                    except OSError:
-                        pass
-
-        if path == "/api/device-files/content":
-            requested_path = (query.get("path") or [""])[0]
-            download_mode = ((query.get("download") or [""])[0]).strip().lower() in {"1", "true", "yes"}
+            export_format = EXPORT_FORMATS[archive_format]
+            # Chunked transfer encoding needs an HTTP/1.1 status line; the
+            # connection is still closed once the archive is complete.
+            self.protocol_version = "HTTP/1.1"
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-Type", export_format["contentType"])
+            self.send_header("Cache-Control", "no-store")
+            self.send_header(
+                "Content-Disposition",
+                f'attachment; filename="{_build_export_archive_name(export_format["extension"])}"',
+            )
+            self.send_header("Transfer-Encoding", "chunked")
+            self.send_header("Connection", "close")
+            self.send_header(
+                "X-Export-Uncompressed-Size",
+                str(_estimate_export_tar_size(storage_raw, files, duplicates, extra_members)),
+            )
+            self.send_header("X-Export-File-Count", str(len(files)))
+            self.send_header("X-Export-Deduplicated-Files", str(len(duplicates)))
+            self.send_header("X-Export-Manifest", manifest_id)
+            if since:
+                self.send_header("X-Export-Base-Manifest", since)
+            self.end_headers()
+            writer = _ChunkedWriter(self.wfile)
+            compressor = _MultiMemberCompressor(writer, archive_format, level) if level is not None else None
             try:
-                full_path, safe_path = _resolve_device_file(requested_path)
-            except ValueError as error:
-                self._send_json(400, {"error": str(error)})
-                return
-            except FileNotFoundError:
-                self._send_json(404, {"error": "File not found"})
+                _write_export_archive(compressor or writer, storage_raw, files, duplicates, compressor, extra_members)
+                if compressor is not None:
+                    compressor.close()
+                writer.close()
+            except (BrokenPipeError, ConnectionResetError):
                 return
+            except Exception as error:
+                # Headers are already sent: drop the connection without the final
+                # chunk so the client sees a truncated transfer, not a valid tar.
+                print(f"[export] aborted: {error}", flush=True)
+            return
+
+        if path == "/api/import/status":
+            self._send_json(200, _import_progress.snapshot())
+            return
 
+        upload_match = DEVICE_UPLOAD_PATH_PATTERN.match(path)
+        if upload_match:
             try:
-                file_size = os.path.getsize(full_path)
-                file_name = os.path.basename(safe_path).replace('"', "_")
-                content_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
-                disposition = "attachment" if download_mode else "inline"
-                self.send_response(200)
-                self.send_header("Content-Type", content_type)
-                self.send_header("Cache-Control", "no-store")
-                self.send_header("Content-Disposition", f'{disposition}; filename="{file_name}"')
-                self.send_header("Content-Length", str(file_size))
-                self.end_headers()
-                with open(full_path, "rb") as handle:
-                    while True:
-                        chunk = handle.read(1024 * 64)
-                        if not chunk:
-                            break
-                        self.wfile.write(chunk)
-                return
-            except OSError as error:
-                self._send_json(500, {"error": f"Unable to read file: {error}"})
+                status = _resumable_uploads.status(upload_match.group(1))
+            except FileNotFoundError:
+                self._send_json(404, {"error": "Upload not found"})
                 return
+            self._send_json(200, status, headers={"X-Upload-Offset": status["offset"]})
+            return
+
+        if path == "/api/device-files/content":
+            self._send_device_file(query)
+            return
 
         if path == "/api/debug/files":
             if not IS_LOCAL_RUNTIME:
@@ -1427,6 +5614,8 @@ class AppHandler(SimpleHTTPRequestHandler):
                 self._send_json(500, {"error": f"Unable to read file: {error}"})
                 return
 
+        if not path.startswith("/api/") and self._send_static_asset(parsed):
+            return
         super().do_GET()
 
     def do_POST(self):
@@ -1443,26 +5632,35 @@ class AppHandler(SimpleHTTPRequestHandler):
                 )
                 return
 
+            if not _import_running.acquire(blocking=False):
+                self._send_json(409, {"error": "Another import is already running"})
+                return
             try:
-                body = self.rfile.read(content_length)
-                with _lock:
-                    result = _import_archive_bytes(body)
+                _import_progress.start(content_length)
+                reader = _CountingReader(self.rfile, content_length, _import_progress)
+                result = _import_archive_stream(_open_import_stream(reader), _import_progress)
             except ValueError as error:
+                _import_progress.update(state="failed", error=str(error))
                 self._send_json(400, {"error": str(error)})
                 return
-            except tarfile.ReadError:
+            except (tarfile.TarError, gzip.BadGzipFile, lzma.LZMAError, EOFError, zlib.error):
+                _import_progress.update(state="failed", error="Invalid TAR archive")
                 self._send_json(400, {"error": "Invalid TAR archive"})
                 return
             except OSError as error:
+                _import_progress.update(state="failed", error=str(error))
                 self._send_json(500, {"error": f"Unable to import archive: {error}"})
                 return
+            finally:
+                _import_running.release()
 
+            _import_progress.update(state="done", result=result)
             self._send_json(200, {"ok": True, "result": result})
             return
 
         if parsed.path == "/api/notifications/check":
             try:
-                results = _run_notification_checks()
+                results = _notification_scheduler.run()
             except Exception as error:
                 self._send_json(500, {"error": str(error)})
                 return
@@ -1478,6 +5676,31 @@ class AppHandler(SimpleHTTPRequestHandler):
             self._send_json(200, {"ok": True})
             return
 
+        if parsed.path == "/api/device-files/uploads":
+            query = parse_qs(parsed.query)
+            try:
+                upload_length = int(self.headers.get("X-Upload-Length", "0") or "0")
+            except ValueError:
+                upload_length = 0
+            if upload_length > MAX_UPLOAD_FILE_BYTES:
+                self._send_json(413, {"error": f"File is too large. Max allowed is {MAX_UPLOAD_FILE_BYTES} bytes."})
+                return
+            try:
+                status = _resumable_uploads.create(
+                    (query.get("deviceId") or [""])[0],
+                    unquote(self.headers.get("X-File-Name", "")).strip() or "file",
+                    self.headers.get("X-Upload-Content-Type", "").strip() or "application/octet-stream",
+                    upload_length,
+                )
+            except ValueError as error:
+                self._send_json(400, {"error": str(error)})
+                return
+            except OSError as error:
+                self._send_json(500, {"error": f"Unable to start upload: {error}"})
+                return
+            self._send_json(201, status)
+            return
+
         if parsed.path != "/api/device-files/upload":
             self.send_error(404)
             return
@@ -1497,9 +5720,7 @@ class AppHandler(SimpleHTTPRequestHandler):
             return
 
         try:
-            body = self.rfile.read(content_length)
-            with _lock:
-                payload = _save_device_file(device_id, file_name, content_type, body)
+            payload = _save_device_file(device_id, file_name, content_type, self.rfile, content_length)
         except ValueError as error:
             self._send_json(400, {"error": str(error)})
             return
@@ -1511,6 +5732,11 @@ class AppHandler(SimpleHTTPRequestHandler):
 
     def do_PUT(self):
         parsed = urlparse(self.path)
+        entity_match = STORAGE_ENTITY_PATH_PATTERN.match(parsed.path)
+        if entity_match:
+            self._handle_storage_entity(entity_match.group(1), entity_match.group(2))
+            return
+
         if parsed.path == "/api/device-files/rename":
             length = int(self.headers.get("Content-Length", "0"))
             body = self.rfile.read(length) if length else b"{}"
@@ -1545,6 +5771,10 @@ class AppHandler(SimpleHTTPRequestHandler):
             self._send_json(200, {"ok": True, "file": result})
             return
 
+        if parsed.path == "/api/ha/devices/batch":
+            self._update_ha_devices_batch()
+            return
+
         if parsed.path == "/api/ha/device-name":
             length = int(self.headers.get("Content-Length", "0"))
             body = self.rfile.read(length) if length else b"{}"
@@ -1570,7 +5800,7 @@ class AppHandler(SimpleHTTPRequestHandler):
                 return
             except RuntimeError as error:
                 message = str(error)
-                status = 503 if "SUPERVISOR_TOKEN" in message else 502
+                status = _ha_update_error_status(message)
                 self._send_json(status, {"error": message})
                 return
 
@@ -1599,7 +5829,7 @@ class AppHandler(SimpleHTTPRequestHandler):
                 return
             except RuntimeError as error:
                 message = str(error)
-                status = 503 if "SUPERVISOR_TOKEN" in message else 502
+                status = _ha_update_error_status(message)
                 self._send_json(status, {"error": message})
                 return
 
@@ -1628,7 +5858,7 @@ class AppHandler(SimpleHTTPRequestHandler):
                 return
             except RuntimeError as error:
                 message = str(error)
-                status = 503 if "SUPERVISOR_TOKEN" in message else 502
+                status = _ha_update_error_status(message)
                 self._send_json(status, {"error": message})
                 return
 
@@ -1641,12 +5871,13 @@ class AppHandler(SimpleHTTPRequestHandler):
         length = int(self.headers.get("Content-Length", "0"))
         body = self.rfile.read(length) if length else b"{}"
         try:
-            payload = json.loads(body.decode("utf-8") or "{}")
-        except json.JSONDecodeError:
+            payload = _json_decode(body or b"{}")
+        except (json.JSONDecodeError, UnicodeDecodeError):
             self.send_error(400, "Invalid JSON")
             return
         try:
             _validate_storage_payload(payload)
+            _reject_non_finite_numbers(payload)
         except ValueError as error:
             self._send_json(400, {"error": str(error)})
             return
@@ -1655,33 +5886,262 @@ class AppHandler(SimpleHTTPRequestHandler):
         conflict_payload = None
         conflict_etag = None
         next_etag = None
+        rebased = False
         with _lock:
-            current = _read_storage()
-            current_etag = _build_storage_etag(current)
+            current, cache_hit, current_etag = _read_storage_cached()
             if not _if_match_allows_current(if_match_header, current_etag):
-                conflict_payload = current
-                conflict_etag = current_etag
-            else:
-                _write_storage(payload)
-                next_etag = _build_storage_etag(payload)
+                # Writes to other entities since the client's ETag are not a conflict.
+                base = _storage_base_for_if_match(if_match_header, current)
+                merged = _rebase_storage_write(current, base[0], payload, base[1]) if base else None
+                if merged is None:
+                    conflict_payload = current
+                    conflict_etag = current_etag
+                else:
+                    payload = merged
+                    rebased = True
+            if conflict_payload is None:
+                next_etag = _write_storage(payload)
         if conflict_payload is not None:
+            self._send_storage_conflict(conflict_payload, conflict_etag, cache_hit)
+            return
+        self._send_storage_committed(next_etag, cache_hit, rebased=rebased)
+
+    def _handle_storage_entity(self, kind, raw_entity_id):
+        entity_id = unquote(raw_entity_id or "").strip()
+        if not entity_id:
+            if self.command != "GET":
+                self.send_error(405)
+                return
+            with _lock:
+                payload, cache_hit, etag = _read_storage_cached()
+                items = _storage_cache.entity_index(payload).items(kind)
+            self._send_json(200, items, headers={"ETag": etag, "X-Storage-Cache": "hit" if cache_hit else "miss"})
+            return
+
+        if self.command == "GET":
+            with _lock:
+                payload, cache_hit, _ = _read_storage_cached()
+                entity, entity_etag = _storage_cache.entity_index(payload).get(kind, entity_id)
+            if entity is None:
+                self._send_json(404, {"error": "Entity not found"})
+                return
+            cache_header = "hit" if cache_hit else "miss"
+            if_none_match = self.headers.get("If-None-Match")
+            if if_none_match and _if_match_allows_current(if_none_match, entity_etag):
+                self.send_response(304)
+                self.send_header("ETag", entity_etag)
+                self.send_header("X-Storage-Cache", cache_header)
+                self.end_headers()
+                return
+            self._send_json(200, entity, headers={"ETag": entity_etag, "X-Storage-Cache": cache_header})
+            return
+
+        next_entity = None
+        if self.command == "PUT":
+            length = int(self.headers.get("Content-Length", "0"))
+            body = self.rfile.read(length) if length else b"{}"
+            try:
+                next_entity = _json_decode(body or b"{}")
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                self.send_error(400, "Invalid JSON")
+                return
+            if not isinstance(next_entity, dict):
+                self._send_json(400, {"error": "Entity must be a JSON object"})
+                return
+            body_id = str(next_entity.get("id") or "").strip()
+            if body_id and body_id != entity_id:
+                self._send_json(400, {"error": "Entity id does not match the request path"})
+                return
+            next_entity["id"] = entity_id
+            try:
+                _validate_storage_payload({kind: [next_entity]})
+                _reject_non_finite_numbers(next_entity, "Entity")
+            except ValueError as error:
+                self._send_json(400, {"error": str(error)})
+                return
+
+        if_match_header = str(self.headers.get("If-Match") or "").strip()
+        create_only = str(self.headers.get("If-None-Match") or "").strip() == "*"
+        conflict = None
+        missing = False
+        with _lock:
+            current, cache_hit, previous_etag = _read_storage_cached()
+            index = _storage_cache.entity_index(current)
+            current_entity, current_entity_etag = index.get(kind, entity_id)
+            if current_entity is None:
+                if self.command == "DELETE" and not if_match_header:
+                    missing = True
+                elif if_match_header:
+                    conflict = (None, None)
+            elif create_only or not _if_match_allows_current(if_match_header, current_entity_etag):
+                conflict = (current_entity, current_entity_etag)
+            if conflict is None and not missing:
+                next_payload = _storage_with_entity(current, index, kind, entity_id, next_entity)
+                change = {"op": "entity", "kind": kind, "id": entity_id, "value": next_entity, "before": current_entity}
+                next_storage_etag = _write_storage(next_payload, changes=[change])
+
+        if missing:
+            self._send_json(404, {"error": "Entity not found"})
+            return
+        if conflict is not None:
             self._send_json(
                 409,
                 {
-                    "error": "Storage was modified by another session. Reload and try again.",
-                    "code": "storage_conflict",
-                    "storage": conflict_payload,
+                    "error": "This item was modified by another session. Reload it and try again.",
+                    "code": "entity_conflict",
+                    "entity": conflict[0],
                 },
-                headers={"ETag": conflict_etag},
+                # A deleted entity has no version for the client to retry against.
+                headers={"ETag": conflict[1]} if conflict[1] is not None else None,
             )
             return
         self.send_response(204)
+        if next_entity is not None:
+            self.send_header("ETag", _build_entity_etag(next_entity))
+        self.send_header("X-Storage-ETag", next_storage_etag)
+        self.send_header("X-Storage-Previous-ETag", previous_etag)
+        self.send_header("X-Storage-Cache", "hit" if cache_hit else "miss")
+        self.end_headers()
+
+    def _send_storage_conflict(self, current, current_etag, cache_hit):
+        self._send_json(
+            409,
+            {
+                "error": "Storage was modified by another session. Reload and try again.",
+                "code": "storage_conflict",
+                "storage": current,
+            },
+            headers={"ETag": current_etag, "X-Storage-Cache": "hit" if cache_hit else "miss"},
+        )
+
+    def _send_storage_committed(self, next_etag, cache_hit, rebased=False):
+        self.send_response(204)
         if next_etag:
             self.send_header("ETag", next_etag)
+        self.send_header("X-Storage-Cache", "hit" if cache_hit else "miss")
+        if rebased:
+            # The stored document also holds other sessions' entity writes.
+            self.send_header("X-Storage-Rebased", "1")
         self.end_headers()
 
+    def _append_device_upload(self, upload_id):
+        try:
+            offset = int(self.headers.get("X-Upload-Offset", ""))
+            content_length = int(self.headers.get("Content-Length", "0") or "0")
+        except ValueError:
+            self._send_json(400, {"error": "X-Upload-Offset and Content-Length are required"})
+            return
+        try:
+            status, reference = _resumable_uploads.append(upload_id, offset, self.rfile, content_length)
+        except FileNotFoundError:
+            self._send_json(404, {"error": "Upload not found"})
+            return
+        except DeviceUploadOffsetError as error:
+            self.close_connection = True
+            if error.offset is None:
+                # Another request is still appending, so there is no stable offset to report yet.
+                self._send_json(409, {"error": str(error)})
+                return
+            self._send_json(409, {"error": str(error), "offset": error.offset}, headers={"X-Upload-Offset": error.offset})
+            return
+        except ValueError as error:
+            self._send_json(400, {"error": str(error)})
+            return
+        except OSError as error:
+            self._send_json(500, {"error": f"Unable to save upload: {error}"})
+            return
+        if reference is not None:
+            self._send_json(201, reference)
+            return
+        self._send_json(200, status, headers={"X-Upload-Offset": status["offset"]})
+
+    def do_PATCH(self):
+        parsed = urlparse(self.path)
+        upload_match = DEVICE_UPLOAD_PATH_PATTERN.match(parsed.path)
+        if upload_match:
+            self._append_device_upload(upload_match.group(1))
+            return
+        if parsed.path != "/api/storage":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", "0"))
+        body = self.rfile.read(length) if length else b"{}"
+        try:
+            patch = _json_decode(body or b"{}")
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            self.send_error(400, "Invalid JSON")
+            return
+
+        content_type = self.headers.get("Content-Type", "").split(";", 1)[0].strip().lower()
+        if content_type == "application/json-patch+json" or (
+            content_type != "application/merge-patch+json" and isinstance(patch, list)
+        ):
+            apply_patch = _apply_json_patch
+        elif isinstance(patch, dict):
+            apply_patch = _apply_merge_patch
+        else:
+            self._send_json(400, {"error": "Merge patch must be a JSON object"})
+            return
+        # The current document is already clean, so only the patch needs checking.
+        try:
+            _reject_non_finite_numbers(patch, "Patch")
+        except ValueError as error:
+            self._send_json(400, {"error": str(error)})
+            return
+
+        if_match_header = self.headers.get("If-Match")
+        conflict = False
+        error_response = None
+        next_etag = None
+        rebased = False
+        with _lock:
+            current, cache_hit, current_etag = _read_storage_cached()
+            base = None
+            if not _if_match_allows_current(if_match_header, current_etag):
+                base = _storage_base_for_if_match(if_match_header, current)
+                conflict = base is None
+            if not conflict:
+                try:
+                    next_payload = apply_patch(base[0] if base else current, patch)
+                    _validate_storage_payload(next_payload)
+                except StoragePatchError as error:
+                    error_response = (422, str(error))
+                except ValueError as error:
+                    error_response = (400, str(error))
+                else:
+                    if base:
+                        # Patch the client's version, then carry its edits onto the current one.
+                        next_payload = _rebase_storage_write(current, base[0], next_payload, base[1])
+                        conflict = next_payload is None
+                        rebased = True
+                    if not conflict:
+                        next_etag = _write_storage(next_payload)
+        if conflict:
+            self._send_storage_conflict(current, current_etag, cache_hit)
+            return
+        if error_response is not None:
+            self._send_json(error_response[0], {"error": error_response[1]})
+            return
+        self._send_storage_committed(next_etag, cache_hit, rebased=rebased)
+
     def do_DELETE(self):
         parsed = urlparse(self.path)
+        entity_match = STORAGE_ENTITY_PATH_PATTERN.match(parsed.path)
+        if entity_match:
+            self._handle_storage_entity(entity_match.group(1), entity_match.group(2))
+            return
+
+        upload_match = DEVICE_UPLOAD_PATH_PATTERN.match(parsed.path)
+        if upload_match:
+            try:
+                _resumable_uploads.abort(upload_match.group(1))
+            except FileNotFoundError:
+                self._send_json(404, {"error": "Upload not found"})
+                return
+            self.send_response(204)
+            self.end_headers()
+            return
+
         if parsed.path != "/api/device-files":
             self.send_error(404)
             return
@@ -1709,8 +6169,11 @@ class AppHandler(SimpleHTTPRequestHandler):
         parsed = urlparse(self.path)
         if parsed.path.startswith("/api/"):
             self.send_response(204)
-            self.send_header("Access-Control-Allow-Methods", "GET, POST, PUT, DELETE, OPTIONS")
-            self.send_header("Access-Control-Allow-Headers", "Content-Type, X-File-Name")
+            self.send_header("Access-Control-Allow-Methods", "GET, POST, PUT, PATCH, DELETE, OPTIONS")
+            self.send_header(
+                "Access-Control-Allow-Headers",
+                "Content-Type, X-File-Name, If-Match, X-Upload-Length, X-Upload-Offset, X-Upload-Content-Type",
+            )
             self.end_headers()
             return
         self.send_error(404)
@@ -1720,10 +6183,39 @@ def main():
     mode_label = "LOCAL DEVELOPMENT" if IS_LOCAL_RUNTIME else "PRODUCTION"
     print(f"[runtime] HOSTNAME={HOSTNAME} | Mode: {mode_label}", flush=True)
     handler = partial(AppHandler, directory=WEB_ROOT)
-    server = HTTPServer((HOST, PORT), handler)
-    init_timer = threading.Timer(60, _schedule_notification_check)
-    init_timer.daemon = True
-    init_timer.start()
+    if SERVER_MODE == "single":
+        server = HTTPServer((HOST, PORT), handler)
+    else:
+        server = BoundedThreadingHTTPServer(
+            (HOST, PORT),
+            handler,
+            workers=SERVER_WORKERS,
+            max_queued=SERVER_MAX_QUEUED,
+            backlog=SERVER_LISTEN_BACKLOG,
+        )
+        print(
+            f"[server] workers={SERVER_WORKERS} bulkWorkers={SERVER_BULK_WORKERS} maxQueued={SERVER_MAX_QUEUED}",
+            flush=True,
+        )
+    _cleanup_import_staging()
+    _start_blob_maintenance(remove_temp_files=True)
+    _resumable_uploads.expire()
+    _static_assets.load()
+    _backup_status_cache.start()
+    # Replay any journal left by a previous run before serving requests.
+    with _lock:
+        _read_storage_cached()
+        if _storage_cache.needs_compaction():
+            _storage_cache.compact()
+    # Entity writes are journaled even in snapshot mode, so the compactor always runs.
+    compactor = threading.Thread(
+        target=_storage_compactor_loop,
+        args=(threading.Event(),),
+        name="shp-storage-compactor",
+        daemon=True,
+    )
+    compactor.start()
+    _notification_scheduler.start()
     server.serve_forever()
 
 
@@ -18,12 +18,16 @@ function buildAppUrl(path) {
 }
 
 const STORAGE_API_URL = buildAppUrl('api/storage');
-const HA_AREAS_API_URL = buildAppUrl('api/ha/areas');
-const HA_FLOORS_API_URL = buildAppUrl('api/ha/floors');
 const HA_DEVICES_API_URL = buildAppUrl('api/ha/devices');
-const HA_LABELS_API_URL = buildAppUrl('api/ha/labels');
 const HA_CONFIG_API_URL = buildAppUrl('api/ha/config');
 const HA_BACKUPS_STATUS_API_URL = buildAppUrl('api/ha/backups-status');
+const HA_REGISTRIES_API_URL = buildAppUrl('api/ha/registries');
+const DEVICE_FILES_UPLOADS_API_URL = buildAppUrl('api/device-files/uploads');
+// Files at or above this size are sent in resumable chunks so a dropped
+// connection only costs the current chunk.
+const RESUMABLE_UPLOAD_THRESHOLD_BYTES = 8 * 1024 * 1024;
+const RESUMABLE_UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024;
+const RESUMABLE_UPLOAD_MAX_RETRIES = 5;
 
 function isIngressRuntime() {
     const pathname = window.location.pathname || '';
@@ -306,6 +310,35 @@ async function loadHaRegistry(url) {
     }
 }
 
+// name -> { etag, items }; lets repeat loads ask only for registries that changed.
+const haRegistryCache = new Map();
+
+async function loadHaRegistries(names) {
+    const requested = (Array.isArray(names) ? names : []).filter(Boolean);
+    const knownEtags = requested.map((name) => haRegistryCache.get(name)?.etag).filter(Boolean);
+    try {
+        const headers = knownEtags.length ? { 'If-None-Match': knownEtags.join(', ') } : {};
+        const response = await fetch(`${HA_REGISTRIES_API_URL}?names=${encodeURIComponent(requested.join(','))}`, {
+            cache: 'no-store',
+            headers
+        });
+        if (response.status !== 304) {
+            if (!response.ok) {
+                throw new Error(`Registry request failed: ${response.status}`);
+            }
+            const payload = await response.json();
+            Object.entries(payload?.registries || {}).forEach(([name, entry]) => {
+                if (entry && Array.isArray(entry.items)) {
+                    haRegistryCache.set(name, { etag: entry.etag, items: entry.items });
+                }
+            });
+        }
+    } catch (error) {
+        console.error('Failed to load HA registries:', error);
+    }
+    return Object.fromEntries(requested.map((name) => [name, haRegistryCache.get(name)?.items || []]));
+}
+
 let haConfigPromise = null;
 let haBackupsStatusPromise = null;
 
@@ -527,6 +560,66 @@ async function parseJsonSafely(response) {
     }
 }
 
+async function uploadDeviceFileResumable(file, deviceId, fileName) {
+    const createResponse = await fetch(`${DEVICE_FILES_UPLOADS_API_URL}?deviceId=${encodeURIComponent(deviceId)}`, {
+        method: 'POST',
+        headers: {
+            'X-File-Name': encodeURIComponent(fileName || file.name || 'file'),
+            'X-Upload-Length': String(file.size),
+            'X-Upload-Content-Type': file.type || 'application/octet-stream'
+        }
+    });
+    const session = await parseJsonSafely(createResponse);
+    if (!createResponse.ok || !session?.uploadId) {
+        throw new Error(session?.error || `Upload failed (${createResponse.status})`);
+    }
+
+    const sessionUrl = `${DEVICE_FILES_UPLOADS_API_URL}/${encodeURIComponent(session.uploadId)}`;
+    let offset = 0;
+    let failures = 0;
+    while (true) {
+        let response = null;
+        try {
+            response = await fetch(sessionUrl, {
+                method: 'PATCH',
+                headers: {
+                    'Content-Type': 'application/octet-stream',
+                    'X-Upload-Offset': String(offset)
+                },
+                body: file.slice(offset, offset + RESUMABLE_UPLOAD_CHUNK_BYTES)
+            });
+        } catch (_error) {
+            // Network failure: ask the server how much arrived and resume there.
+        }
+        const payload = response ? await parseJsonSafely(response) : null;
+        if (response?.status === 201) {
+            return payload;
+        }
+        if (response?.ok) {
+            offset = Number(payload?.offset) || 0;
+            failures = 0;
+            continue;
+        }
+        if (response && response.status !== 409 && response.status < 500) {
+            throw new Error(payload?.error || `Upload failed (${response.status})`);
+        }
+
+        failures += 1;
+        if (failures > RESUMABLE_UPLOAD_MAX_RETRIES) {
+            throw new Error(payload?.error || 'Upload failed after several retries');
+        }
+        await new Promise((resolve) => setTimeout(resolve, 1000 * failures));
+        const statusResponse = await fetch(sessionUrl, { cache: 'no-store' }).catch(() => null);
+        if (statusResponse?.status === 404) {
+            throw new Error('Upload session expired. Please try again.');
+        }
+        const status = statusResponse?.ok ? await parseJsonSafely(statusResponse) : null;
+        if (Number.isFinite(Number(status?.offset))) {
+            offset = Number(status.offset);
+        }
+    }
+}
+
 async function showStorageConflictAlert(message) {
     const detail = String(message || '').trim() || STORAGE_CONFLICT_DEFAULT_MESSAGE;
     if (storageConflictAlertPromise) {
@@ -562,6 +655,12 @@ async function putStoragePayload(payload) {
         headers,
         body: JSON.stringify(payload)
     });
+    return handleStorageWriteResponse(response);
+}
+
+// Resolves to true when the server merged the write with other sessions'
+// entity edits, i.e. the stored document is no longer what this tab sent.
+async function handleStorageWriteResponse(response) {
     if (response.status === 409) {
         const conflictPayload = await parseJsonSafely(response);
         const nextEtag = parseStorageEtag(response);
@@ -578,6 +677,7 @@ async function putStoragePayload(payload) {
     if (nextEtag) {
         storageEtag = nextEtag;
     }
+    return response.headers.get('X-Storage-Rebased') === '1';
 }
 
 async function loadStorage() {
@@ -610,18 +710,45 @@ async function loadStorage() {
 async function saveStorage(nextStorage) {
     return enqueueStorageWrite(async () => {
         const payload = mergeStorage(nextStorage);
-        await putStoragePayload(payload);
-        storageCache = payload;
+        const rebased = await putStoragePayload(payload);
+        // A rebased write must be reloaded before it is used as the base of another.
+        storageCache = rebased ? null : payload;
         return payload;
     });
 }
 
+async function sendStoragePatch(operations) {
+    const headers = { 'Content-Type': 'application/json-patch+json' };
+    if (storageEtag) {
+        headers['If-Match'] = storageEtag;
+    }
+    const response = await fetch(STORAGE_API_URL, {
+        method: 'PATCH',
+        headers,
+        body: JSON.stringify(operations)
+    });
+    return handleStorageWriteResponse(response);
+}
+
 async function patchStorage(patch) {
     return enqueueStorageWrite(async () => {
         const storage = await loadStorage();
-        const payload = mergeStorage({ ...storage, ...(patch || {}) });
-        await putStoragePayload(payload);
-        storageCache = payload;
+        const merged = mergeStorage({ ...storage, ...(patch || {}) });
+        const keys = Object.keys(patch || {}).filter((key) => merged[key] !== undefined);
+        // Only the touched top-level keys travel; "add" replaces an existing member.
+        const operations = keys.map((key) => ({
+            op: 'add',
+            path: `/${key.replace(/~/g, '~0').replace(/\//g, '~1')}`,
+            value: merged[key]
+        }));
+        const rebased = operations.length ? await sendStoragePatch(operations) : false;
+        // Mirror the server: the old document plus exactly the keys that were sent.
+        // mergeStorage may have re-normalized other keys, but those never left the tab.
+        const payload = { ...storage };
+        keys.forEach((key) => {
+            payload[key] = merged[key];
+        });
+        storageCache = rebased ? null : payload;
         return payload;
     });
 }
@@ -758,12 +885,10 @@ async function loadData() {
     const testCaseRuns = Array.isArray(storage.testCaseRuns) ? storage.testCaseRuns : [];
     let networks = Array.isArray(storage.networks) ? storage.networks : [];
     let isps = Array.isArray(storage.isps) ? storage.isps : [];
-    const rawAreas = await loadHaRegistry(HA_AREAS_API_URL);
-    const rawFloors = await loadHaRegistry(HA_FLOORS_API_URL);
-    const rawLabels = await loadHaRegistry(HA_LABELS_API_URL);
-    const areas = normalizeAreas(rawAreas);
-    const floors = normalizeFloors(rawFloors);
-    const labels = normalizeLabels(rawLabels);
+    const registries = await loadHaRegistries(['areas', 'floors', 'labels']);
+    const areas = normalizeAreas(registries.areas);
+    const floors = normalizeFloors(registries.floors);
+    const labels = normalizeLabels(registries.labels);
     let didUpdate = false;
 
     if (!Array.isArray(networks) || networks.length === 0) {
@@ -2573,6 +2698,8 @@ window.clearMapImagePositions = clearMapImagePositions;
 window.getUiPreference = getUiPreference;
 window.setUiPreference = setUiPreference;
 window.isStorageConflictError = isStorageConflictError;
+window.uploadDeviceFileResumable = uploadDeviceFileResumable;
+window.RESUMABLE_UPLOAD_THRESHOLD_BYTES = RESUMABLE_UPLOAD_THRESHOLD_BYTES;
 window.syncDateInputs = syncDateInputs;
 window.APP_BASE_PATH = APP_BASE_PATH;
 window.buildAppUrl = buildAppUrl;
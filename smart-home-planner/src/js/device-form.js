@@ -239,11 +239,12 @@ function escapeFileParam(value) {
     return encodeURIComponent(String(value || ''));
 }
 
-function getDeviceFileContentUrl(path, download = false) {
+function getDeviceFileContentUrl(path, download = false, size = '') {
     const safePath = String(path || '').trim();
     if (!safePath) return '#';
     const downloadSuffix = download ? '&download=1' : '';
-    return `${DEVICE_FILES_CONTENT_API_URL}?path=${escapeFileParam(safePath)}${downloadSuffix}`;
+    const sizeSuffix = size ? `&size=${encodeURIComponent(size)}` : '';
+    return `${DEVICE_FILES_CONTENT_API_URL}?path=${escapeFileParam(safePath)}${downloadSuffix}${sizeSuffix}`;
 }
 
 function formatFileSize(size) {
@@ -908,7 +909,7 @@ function openDeviceFilePreviewModal(filePath, fileName = '') {
     if (!modal || !modal.root || !modal.image || !modal.title) return;
 
     modal.title.textContent = String(fileName || 'Image Preview').trim() || 'Image Preview';
-    modal.image.src = getDeviceFileContentUrl(normalizedPath);
+    modal.image.src = getDeviceFileContentUrl(normalizedPath, false, 'preview');
     modal.image.alt = modal.title.textContent;
     modal.root.classList.remove('is-hidden');
     modal.root.setAttribute('aria-hidden', 'false');
@@ -1055,7 +1056,7 @@ function renderDeviceFiles() {
         const fileMeta = [formatFileSize(file.size), file.mimeType || 'Unknown type'].join(' • ');
         const preview = file.isImage
             ? `<button type="button" class="device-file-preview" data-device-file-view="${escapeHtml(file.path)}" data-device-file-name="${displayName}" title="View image">
-                    <img src="${escapeHtml(getDeviceFileContentUrl(file.path))}" alt="${displayName}" loading="lazy">
+                    <img src="${escapeHtml(getDeviceFileContentUrl(file.path, false, 'thumb'))}" alt="${displayName}" loading="lazy">
                </button>`
             : `<div class="device-file-preview-static">
                     <span class="device-file-icon" aria-hidden="true">
@@ -1151,6 +1152,10 @@ async function uploadFilesForDevice(files) {
 }
 
 async function uploadDeviceFile(file) {
+    if (typeof window.uploadDeviceFileResumable === 'function' && file.size >= window.RESUMABLE_UPLOAD_THRESHOLD_BYTES) {
+        const payload = await window.uploadDeviceFileResumable(file, activeDeviceId, file.name || 'file');
+        return normalizeDeviceFiles([payload])[0] || null;
+    }
     const uploadUrl = `${DEVICE_FILES_UPLOAD_API_URL}?deviceId=${escapeFileParam(activeDeviceId)}`;
     const response = await fetch(uploadUrl, {
         method: 'POST',
@@ -1300,7 +1305,7 @@ function setDevicePhotoPreview(src, isApiPath, options = {}) {
     const sourceKind = options.sourceKind === 'type' ? 'type' : 'custom';
     if (src) {
         img.src = isApiPath
-            ? `${DEVICE_FILES_CONTENT_API_URL}?path=${encodeURIComponent(src)}`
+            ? `${DEVICE_FILES_CONTENT_API_URL}?path=${encodeURIComponent(src)}&size=preview`
             : src;
         img.alt = sourceKind === 'type'
             ? `${options.typeLabel || 'Device type'} icon`
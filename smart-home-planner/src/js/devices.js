@@ -7,7 +7,7 @@ const _DEVICE_FILES_CONTENT_URL =
 
 function getDeviceImageSrc(device) {
     if (device.deviceImage && device.deviceImage.path) {
-        return `${_DEVICE_FILES_CONTENT_URL}?path=${encodeURIComponent(device.deviceImage.path)}`;
+        return `${_DEVICE_FILES_CONTENT_URL}?path=${encodeURIComponent(device.deviceImage.path)}&size=thumb`;
     }
     if (device.type) {
         return `img/devices/${encodeURIComponent(device.type)}.svg`;
@@ -36,10 +36,8 @@ let currentPageDeviceIds = [];
 let bulkEditVisible = false;
 const DEVICE_FILES_DELETE_API_URL =
     typeof window.buildAppUrl === 'function' ? window.buildAppUrl('api/device-files') : '/api/device-files';
-const HA_DEVICE_AREA_SYNC_API_URL =
-    typeof window.buildAppUrl === 'function' ? window.buildAppUrl('api/ha/device-area') : '/api/ha/device-area';
-const HA_DEVICE_LABELS_SYNC_API_URL =
-    typeof window.buildAppUrl === 'function' ? window.buildAppUrl('api/ha/device-labels') : '/api/ha/device-labels';
+const HA_DEVICES_BATCH_SYNC_API_URL =
+    typeof window.buildAppUrl === 'function' ? window.buildAppUrl('api/ha/devices/batch') : '/api/ha/devices/batch';
 const DUPLICATE_DEVICE_DRAFT_SESSION_KEY = 'smartHomeDuplicateDeviceDraft';
 
 const VIEW_STORAGE_KEYS = {
@@ -566,68 +564,31 @@ async function deleteDevice(id) {
     deviceFilters.applyFilters(); // Reapply filters to update filteredDevices
 }
 
-async function syncDeviceAreaToHa(deviceId, areaId) {
-    const normalizedId = String(deviceId || '').trim();
-    const normalizedAreaId = String(areaId || '').trim();
-    if (!normalizedId) {
-        return;
+// Sends every Home Assistant update in one request; the server coalesces them
+// per device and runs them concurrently. Resolves to the per-device results.
+async function syncDevicesToHaBatch(operations) {
+    if (!operations.length) {
+        return [];
     }
 
-    const response = await fetch(HA_DEVICE_AREA_SYNC_API_URL, {
+    const response = await fetch(HA_DEVICES_BATCH_SYNC_API_URL, {
         method: 'PUT',
         headers: {
             'Content-Type': 'application/json'
         },
-        body: JSON.stringify({
-            id: normalizedId,
-            areaId: normalizedAreaId
-        })
+        body: JSON.stringify({ operations })
     });
 
-    if (!response.ok) {
-        let errorMessage = `Failed to update Home Assistant device area (${response.status})`;
-        try {
-            const payload = await response.json();
-            if (payload && payload.error) {
-                errorMessage = payload.error;
-            }
-        } catch (error) {
-            // Ignore JSON parsing errors and keep the default message.
-        }
-        throw new Error(errorMessage);
-    }
-}
-
-async function syncDeviceLabelsToHa(deviceId, labelIds) {
-    const normalizedId = String(deviceId || '').trim();
-    if (!normalizedId) {
-        return;
+    let payload = null;
+    try {
+        payload = await response.json();
+    } catch (error) {
+        // Ignore JSON parsing errors and keep the default message.
     }
-    const normalizedLabels = normalizeLabelList(labelIds);
-
-    const response = await fetch(HA_DEVICE_LABELS_SYNC_API_URL, {
-        method: 'PUT',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({
-            id: normalizedId,
-            labels: normalizedLabels
-        })
-    });
-
     if (!response.ok) {
-        let errorMessage = `Failed to update Home Assistant device labels (${response.status})`;
-        try {
-            const payload = await response.json();
-            if (payload && payload.error) {
-                errorMessage = payload.error;
-            }
-        } catch (error) {
-            // Ignore JSON parsing errors and keep the default message.
-        }
-        throw new Error(errorMessage);
+        throw new Error(payload?.error || `Failed to update Home Assistant devices (${response.status})`);
     }
+    return Array.isArray(payload?.results) ? payload.results : [];
 }
 
 async function handleBulkApply() {
@@ -715,25 +676,43 @@ async function handleBulkApply() {
             .map(device => [String(device.id), device])
     );
     if (shouldSyncArea || shouldSyncLabels) {
+        const operations = [];
         for (const id of ids) {
             const device = persistedById.get(String(id));
             if (!device) continue;
             if (!isHomeAssistantLinked(device.homeAssistant)) continue;
-            try {
-                if (shouldSyncArea) {
-                    const areaValue = field === 'installed-area' ? device.area : device.controlledArea;
-                    await syncDeviceAreaToHa(device.id, areaValue);
-                }
-                if (shouldSyncLabels) {
-                    await syncDeviceLabelsToHa(device.id, device.labels);
-                }
-            } catch (error) {
+            const operation = { id: String(device.id).trim() };
+            if (!operation.id) continue;
+            if (shouldSyncArea) {
+                const areaValue = field === 'installed-area' ? device.area : device.controlledArea;
+                operation.areaId = String(areaValue || '').trim();
+            }
+            if (shouldSyncLabels) {
+                operation.labels = normalizeLabelList(device.labels);
+            }
+            operations.push(operation);
+        }
+        const nameFor = (deviceId) => {
+            const device = persistedById.get(String(deviceId));
+            return device?.name || deviceId;
+        };
+        try {
+            const results = await syncDevicesToHaBatch(operations);
+            results.filter(item => !item.ok).forEach((item) => {
                 haFailures.push({
-                    id: device.id,
-                    name: device.name || device.id,
+                    id: item.id,
+                    name: nameFor(item.id),
+                    error: item.error || 'Unknown error'
+                });
+            });
+        } catch (error) {
+            operations.forEach((operation) => {
+                haFailures.push({
+                    id: operation.id,
+                    name: nameFor(operation.id),
                     error: error?.message || String(error)
                 });
-            }
+            });
         }
     }
 
@@ -109,7 +109,7 @@ window.DeviceMap = (() => {
         if (!imagePath) return '';
         const cacheToken = String(device?.updatedAt || '').trim();
         const tokenQuery = cacheToken ? `&t=${encodeURIComponent(cacheToken)}` : '';
-        return `${DEVICE_FILES_CONTENT_URL}?path=${encodeURIComponent(imagePath)}${tokenQuery}`;
+        return `${DEVICE_FILES_CONTENT_URL}?path=${encodeURIComponent(imagePath)}&size=thumb${tokenQuery}`;
     }
 
     function getDevicePhotoCacheKey(device) {
@@ -1437,7 +1437,9 @@ window.DeviceMap = (() => {
         if (!diagramBackgroundFile || !diagramBackgroundFile.path) return '';
         const backgroundPath = String(diagramBackgroundFile.path);
         if (!diagramBackgroundImageUrl || backgroundPath !== diagramBackgroundImagePath) {
-            const cacheToken = Date.now();
+            // Uploaded paths are unique, so a stable token lets the browser
+            // reuse its cached copy across map views.
+            const cacheToken = encodeURIComponent(String(diagramBackgroundFile.uploadedAt || diagramBackgroundFile.size || ''));
             diagramBackgroundImageUrl = `${DEVICE_FILES_CONTENT_URL}?path=${encodeURIComponent(backgroundPath)}&t=${cacheToken}`;
             diagramBackgroundImagePath = backgroundPath;
         }
@@ -1636,6 +1638,14 @@ window.DeviceMap = (() => {
     }
 
     async function uploadDiagramBackground(file) {
+        if (typeof window.uploadDeviceFileResumable === 'function' && file.size >= window.RESUMABLE_UPLOAD_THRESHOLD_BYTES) {
+            const payload = await window.uploadDeviceFileResumable(
+                file,
+                DIAGRAM_BACKGROUND_DEVICE_ID,
+                file.name || 'diagram-background'
+            );
+            return normalizeDiagramBackgroundPayload(payload);
+        }
         const response = await fetch(`${DEVICE_FILES_UPLOAD_URL}?deviceId=${encodeURIComponent(DIAGRAM_BACKGROUND_DEVICE_ID)}`, {
             method: 'POST',
             headers: {
@@ -0,0 +1,29 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+class SupervisorClientCacheTest(unittest.TestCase):
+    URL = "http://supervisor/backups"
+
+    def setUp(self):
+        self.client = server._SupervisorClient(retries=0)
+        self.bodies = iter([b"1", b"2", b"3"])
+        self.client.request = lambda method, url, body=None, headers=None: next(self.bodies)
+
+    def test_zero_ttl_never_serves_stale(self):
+        self.assertEqual(self.client.get_cached(self.URL, 0, 300, int), 1)
+        self.assertEqual(self.client.get_cached(self.URL, 0, 300, int), 2)
+
+    def test_positive_ttl_serves_stale_while_refreshing(self):
+        self.assertEqual(self.client.get_cached(self.URL, 60, 300, int), 1)
+        self.client._cache[self.URL]["fetchedAt"] -= 61
+        self.assertEqual(self.client.get_cached(self.URL, 60, 300, int), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()